@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""Check that importing hither, loggery and etconf stays fast
+
+Usage:
+    python benchmarks/check_import_time.py [--budget-ms 60]
+
+For each import (in a fresh interpreter), checks that it succeeds, that
+none of the slow dependencies that should only load on first use (pymongo,
+kachery, urllib.request, asyncio, concurrent.futures) were imported, and
+that the import took less than the budget (the median of several runs, minus the
+startup time of the interpreter). The exit code is 1 if a check fails.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+from typing import List
+
+_this_dir = os.path.dirname(os.path.abspath(__file__))
+
+# what is imported, e.g., by a short-lived process with a cached result, or
+# by the scripts that run inside containers (see run_function_in_container)
+_imports = [
+    'import hither',
+    'import hither; hither.function',
+    # a submodule as an attribute (e.g., hither.core), resolved by __getattr__
+    'import hither; hither.core',
+    'import hither.serialization, hither.instrumentation',
+    'import loggery',
+    'import etconf'
+]
+
+_slow_modules = ['pymongo', 'kachery', 'urllib.request', 'asyncio', 'concurrent.futures']
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that importing hither, loggery and etconf stays fast')
+    parser.add_argument('--budget-ms', help='Maximum import time of each statement', type=float, default=60)
+    parser.add_argument('--repeat', help='Number of runs of each statement', type=int, default=7)
+    args = parser.parse_args()
+
+    t_interpreter = statistics.median([_run('pass')['elapsed'] for _ in range(args.repeat)])
+    failures: List[str] = []
+    for statement in _imports:
+        try:
+            runs = [_run(statement) for _ in range(args.repeat)]
+        except subprocess.CalledProcessError:
+            print('{:<55} {:>8} ms   {}'.format(statement, '-', 'failed'))
+            failures.append(statement)
+            continue
+        elapsed_ms = (statistics.median([r['elapsed'] for r in runs]) - t_interpreter) * 1000
+        loaded = [m for m in _slow_modules if m in runs[0]['modules']]
+        status = 'ok'
+        if len(loaded) > 0:
+            status = 'imports {}'.format(', '.join(loaded))
+            failures.append(statement)
+        elif elapsed_ms > args.budget_ms:
+            status = 'over budget ({} ms)'.format(args.budget_ms)
+            failures.append(statement)
+        print('{:<55} {:>8.1f} ms   {}'.format(statement, elapsed_ms, status))
+    if len(failures) > 0:
+        sys.exit(1)
+
+def _run(statement: str) -> dict:
+    # the elapsed time includes the interpreter startup (subtracted by the caller)
+    code = statement + '\nimport sys, json\nprint(json.dumps(sorted(sys.modules.keys())))'
+    env = dict(os.environ)
+    # so that this working tree is checked
+    env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(_this_dir)] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    timer = time.time()
+    output = subprocess.check_output([sys.executable, '-c', code], env=env)
+    elapsed = time.time() - timer
+    return dict(elapsed=elapsed, modules=json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+
+"""Benchmarks for the overhead of hither and loggery
+
+Usage:
+    python benchmarks/run_benchmarks.py [--output results.json] [--baseline baseline.json] [--tolerance 0.25] [--only cache_hit ...] [--quick]
+
+Each benchmark runs against scratch directories (hither directory, kachery
+storage and a local SQLite loggery database) that are removed afterwards.
+The results are written as JSON. With --baseline, they are compared with
+the results of an earlier run (e.g., on the main branch, on the same
+machine) and the exit code is 1 if any metric is worse by more than the
+tolerance. Use --save-baseline to store the results as the new baseline.
+
+Benchmarks:
+    import_time       time to import hither (in a fresh interpreter)
+    cache_hit         latency of execute() when the result is cached
+    cache_miss        latency of execute() for a trivial in-process function
+    container_launch  latency of a trivial container job, with the subprocess runtime as a stub (cold and warm workers)
+    input_hashing     throughput of hashing input files of several sizes
+    console_capture   throughput of ConsoleCapture under heavy printing
+    loggery           insert and find rates against the local SQLite backend
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+import contextlib
+from typing import Callable, Dict, List, Union
+
+_this_dir = os.path.dirname(os.path.abspath(__file__))
+# so that the benchmarks measure this working tree
+sys.path.insert(0, os.path.dirname(_this_dir))
+
+import hither
+
+# at the top level of this file, so that it can run in a container
+@hither.function('benchmark_add', '0.1.0')
+@hither.container(default='docker://benchmark/stub')
+def benchmark_add(x, y):
+    return x + y
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the overhead of hither and loggery')
+    parser.add_argument('--output', help='Write the results (JSON) to this file', default=None)
+    parser.add_argument('--baseline', help='Compare with the results in this file', default=None)
+    parser.add_argument('--save-baseline', help='Also write the results to this file (the new baseline)', default=None)
+    parser.add_argument('--tolerance', help='Allowed relative slowdown before a metric counts as a regression', type=float, default=0.25)
+    parser.add_argument('--only', help='Names of the benchmarks to run', nargs='+', default=None)
+    parser.add_argument('--quick', help='Fewer iterations (for a smoke test)', action='store_true')
+    args = parser.parse_args()
+
+    names = args.only if args.only is not None else list(_benchmarks.keys())
+    for name in names:
+        if name not in _benchmarks:
+            raise Exception('Unknown benchmark: {}'.format(name))
+
+    results = dict(
+        metadata=_metadata(),
+        metrics=dict()
+    )
+    with _scratch_environment():
+        for name in names:
+            print('Running {}...'.format(name))
+            for m in _benchmarks[name](quick=args.quick):
+                key = '{}.{}'.format(name, m['name'])
+                results['metrics'][key] = dict(value=m['value'], unit=m['unit'], higher_is_better=m['higher_is_better'])
+                print('    {:<40} {:>14.4f} {}'.format(key, m['value'], m['unit']))
+
+    for path in [args.output, args.save_baseline]:
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = _compare(results, baseline, tolerance=args.tolerance)
+        if len(regressions) > 0:
+            print('{} regression(s) relative to {}'.format(len(regressions), args.baseline))
+            sys.exit(1)
+
+def _compare(results: dict, baseline: dict, *, tolerance: float) -> List[str]:
+    # A metric regresses if it is worse than the baseline by more than the
+    # tolerance (e.g., 0.25 means 25% slower or 25% less throughput)
+    regressions = []
+    print('')
+    print('{:<40} {:>14} {:>14} {:>10}'.format('metric', 'baseline', 'current', 'slowdown'))
+    for key, m in results['metrics'].items():
+        b = baseline['metrics'].get(key, None)
+        if b is None or b['value'] <= 0 or m['value'] <= 0:
+            print('{:<40} {:>14} {:>14.4f}'.format(key, '-', m['value']))
+            continue
+        if m['higher_is_better']:
+            slowdown = b['value'] / m['value']
+        else:
+            slowdown = m['value'] / b['value']
+        flag = ''
+        if slowdown > 1 + tolerance:
+            regressions.append(key)
+            flag = '  REGRESSION'
+        print('{:<40} {:>14.4f} {:>14.4f} {:>9.2f}x{}'.format(key, b['value'], m['value'], slowdown, flag))
+    return regressions
+
+
+######################################################################
+# Benchmarks
+#
+# Each returns a list of metrics: dict(name, value, unit, higher_is_better)
+
+def bench_import_time(*, quick: bool) -> List[dict]:
+    n = 3 if quick else 10
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([p for p in sys.path if p]))
+    def run(code: str) -> float:
+        timer = time.time()
+        subprocess.run([sys.executable, '-c', code], env=env, check=True)
+        return time.time() - timer
+    t_interpreter = _median([run('pass') for _ in range(n)])
+    t_hither = _median([run('import hither') for _ in range(n)])
+    t_loggery = _median([run('import loggery') for _ in range(n)])
+    return [
+        _metric('hither', (t_hither - t_interpreter) * 1000, 'ms'),
+        _metric('loggery', (t_loggery - t_interpreter) * 1000, 'ms')
+    ]
+
+def bench_cache_hit(*, quick: bool) -> List[dict]:
+    n = 50 if quick else 500
+    with _quiet():
+        benchmark_add.execute(x=1, y=2)
+        times = _time_each(lambda: benchmark_add.execute(x=1, y=2), n)
+    return [_metric('latency', _median(times) * 1000, 'ms')]
+
+def bench_cache_miss(*, quick: bool) -> List[dict]:
+    n = 20 if quick else 200
+    counter = [time.time()]
+    def run():
+        counter[0] = counter[0] + 1
+        benchmark_add.execute(x=counter[0], y=0)
+    with _quiet():
+        times = _time_each(run, n)
+    return [_metric('latency', _median(times) * 1000, 'ms')]
+
+def bench_container_launch(*, quick: bool) -> List[dict]:
+    from hither.containerworker import shutdown_warm_workers
+    n = 3 if quick else 20
+    ret = []
+    for label, use_warm_workers in [('cold', False), ('warm', True)]:
+        hither.set_config(container_runtime='subprocess', use_warm_workers=use_warm_workers)
+        counter = [time.time()]
+        def run():
+            counter[0] = counter[0] + 1
+            benchmark_add.execute(x=counter[0], y=0, _container='docker://benchmark/stub')
+        try:
+            with _quiet():
+                # the first run builds the source bundle (and starts the warm worker)
+                run()
+                times = _time_each(run, n)
+        finally:
+            hither.set_config(container_runtime='singularity', use_warm_workers=False)
+            shutdown_warm_workers()
+        ret.append(_metric('{}_latency'.format(label), _median(times) * 1000, 'ms'))
+    return ret
+
+def bench_input_hashing(*, quick: bool) -> List[dict]:
+    from hither.filehashcache import get_file_hash
+    sizes_mb = [1, 16] if quick else [1, 16, 128]
+    n = 2 if quick else 5
+    ret = []
+    for size_mb in sizes_mb:
+        times = []
+        for _ in range(n):
+            # a new file each time, so that the hash is not remembered
+            path = os.path.join(tempfile.gettempdir(), 'hither_benchmark_input.dat')
+            with open(path, 'wb') as f:
+                for _ in range(size_mb):
+                    f.write(os.urandom(1024 * 1024))
+            timer = time.time()
+            get_file_hash(path, algorithm='sha1')
+            times.append(time.time() - timer)
+            os.unlink(path)
+        ret.append(_metric('{}mb'.format(size_mb), size_mb / _median(times), 'MB/s', higher_is_better=True))
+    return ret
+
+def bench_console_capture(*, quick: bool) -> List[dict]:
+    from hither.consolecapture import ConsoleCapture
+    num_lines = 20000 if quick else 200000
+    line = 'x' * 79
+    with _quiet():
+        timer = time.time()
+        with ConsoleCapture() as cc:
+            for _ in range(num_lines):
+                print(line)
+        elapsed = time.time() - timer
+        cc.cleanup()
+    return [_metric('print', num_lines * 80 / elapsed / 1e6, 'MB/s', higher_is_better=True)]
+
+def bench_loggery(*, quick: bool) -> List[dict]:
+    import loggery
+    n = 2000 if quick else 20000
+    n_single = 100 if quick else 1000
+    messages = [dict(name='benchmark', index=i, value='x' * 100) for i in range(n)]
+    loggery.declare_index([('message.index', 1)])
+
+    timer = time.time()
+    for i in range(0, n, 500):
+        loggery.insert_many(messages[i:i + 500])
+    insert_many_rate = n / (time.time() - timer)
+
+    timer = time.time()
+    for i in range(n_single):
+        loggery.insert_one(dict(name='benchmark_single', index=i))
+    insert_one_rate = n_single / (time.time() - timer)
+
+    timer = time.time()
+    for i in range(n_single):
+        loggery.find_one({'message.name': 'benchmark', 'message.index': i * (n // n_single)})
+    find_one_rate = n_single / (time.time() - timer)
+
+    timer = time.time()
+    num_found = len(list(loggery.find({'message.name': 'benchmark'})))
+    find_rate = num_found / (time.time() - timer)
+
+    return [
+        _metric('insert_many', insert_many_rate, 'messages/s', higher_is_better=True),
+        _metric('insert_one', insert_one_rate, 'messages/s', higher_is_better=True),
+        _metric('find_one_indexed', find_one_rate, 'queries/s', higher_is_better=True),
+        _metric('find_all', find_rate, 'documents/s', higher_is_better=True)
+    ]
+
+_benchmarks: Dict[str, Callable[..., List[dict]]] = dict(
+    import_time=bench_import_time,
+    cache_hit=bench_cache_hit,
+    cache_miss=bench_cache_miss,
+    container_launch=bench_container_launch,
+    input_hashing=bench_input_hashing,
+    console_capture=bench_console_capture,
+    loggery=bench_loggery
+)
+
+
+######################################################################
+# Helpers
+
+@contextlib.contextmanager
+def _scratch_environment():
+    scratch = tempfile.mkdtemp(prefix='hither_benchmarks_')
+    saved_env = dict(os.environ)
+    try:
+        os.environ['HITHER_DIR'] = os.path.join(scratch, 'hither')
+        os.environ['KACHERY_STORAGE_DIR'] = os.path.join(scratch, 'kachery-storage')
+        os.makedirs(os.environ['KACHERY_STORAGE_DIR'])
+        import loggery
+        hither.set_config(hither_dir=os.environ['HITHER_DIR'])
+        loggery.set_config(url='sqlite://' + os.path.join(scratch, 'loggery.db'), database='benchmarks', collection='benchmarks')
+        yield scratch
+        loggery.flush()
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_env)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+@contextlib.contextmanager
+def _quiet():
+    # hither reports each cached result on stdout
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            yield
+
+def _time_each(fn: Callable[[], None], n: int) -> List[float]:
+    times = []
+    for _ in range(n):
+        timer = time.time()
+        fn()
+        times.append(time.time() - timer)
+    return times
+
+def _median(x: List[float]) -> float:
+    return statistics.median(x)
+
+def _metric(name: str, value: float, unit: str, *, higher_is_better: bool=False) -> dict:
+    return dict(name=name, value=value, unit=unit, higher_is_better=higher_is_better)
+
+def _metadata() -> dict:
+    return dict(
+        time=time.time(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpu_count=os.cpu_count(),
+        git_commit=_git_commit()
+    )
+
+def _git_commit() -> Union[str, None]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=_this_dir, stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,6 @@ import os
 import stat
 import json
 from typing import Optional, List, Union
-import urllib.request as request
 from .filelock import FileLock
 
 class ETConf:
@@ -14,6 +13,10 @@ class ETConf:
         self._config = deepcopy(self._defaults)
         self._preset_config = None
         self._preset_config_url = preset_config_url
+        # the resolved config and the environment variables it was resolved with
+        self._resolved_config = None
+        self._resolved_env = None
+        self._version = 0
     def set_config(self, preset=None, **kwargs):
         if preset is not None:
             self._load_preset_config_if_needed()
@@ -23,7 +26,30 @@ class ETConf:
         for k, v in kwargs.items():
             if v is not None:
                 self._config[k] = deepcopy(v)
-    def get_config(self):
+        self._version = self._version + 1
+        self._resolved_config = None
+    def get_config(self, *, copy: bool=True):
+        """Return the configuration with environment variable references resolved
+
+        The resolved configuration is cached until the next set_config (or a
+        change in one of the referenced environment variables). With
+        copy=False, the cached dict itself is returned and must not be modified.
+        """
+        resolved = self._resolved_config
+        if resolved is None or self._resolved_env != self._referenced_env():
+            resolved = self._resolve_config()
+        if copy:
+            return deepcopy(resolved)
+        return resolved
+    def _referenced_env(self):
+        return tuple([
+            os.environ.get(v['env'], None)
+            for v in self._config.values()
+            if type(v) == dict and 'env' in v
+        ])
+    def _resolve_config(self):
+        version = self._version
+        env = self._referenced_env()
         ret = dict()
         for k, v in self._config.items():
             if type(v) == dict and 'env' in v:
@@ -33,6 +59,10 @@ class ETConf:
                 else:
                     raise Exception('You need to set the {} environment variable'.format(env0))
             ret[k] = deepcopy(v)
+        if version == self._version:
+            # not cached if set_config was called in the meantime (another thread)
+            self._resolved_env = env
+            self._resolved_config = ret
         return ret
     def _load_preset_config_if_needed(self):
         if self._preset_config is not None:
@@ -80,6 +110,8 @@ def _http_get_json(url: str, use_cache_on_success: bool=False, verbose: Optional
         verbose = (os.environ.get('HTTP_VERBOSE', '') == 'TRUE')
     if verbose:
         print('_http_get_json::: ' + url)
+    # imported here because it is slow to import and only needed for the preset configurations
+    import urllib.request as request
     try:
         req = request.urlopen(url)
     except:
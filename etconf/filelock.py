@@ -1,26 +1,48 @@
+import os
+import time
 import fcntl
 import errno
-import time
-import random
-from typing import IO, Optional
+import threading
+import functools
+from collections import OrderedDict
+from typing import Any, Dict, List, Union
 
 
 class FileLock():
-    def __init__(self, path: str, exclusive: bool=True, _disable_lock: bool=False):
+    def __init__(self, path: str, exclusive: bool=True, _disable_lock: bool=False, *, timeout: Union[float, None]=None):
         """Lock a file via fcntl.flock using an exclusive or non-exclusive lock.
-        
+
         Example usage:
         ```
         with FileLock('some_file.txt.lock', exclusive=True):
             # Do something with some_file.txt
+
+        async with FileLock('some_file.txt.lock', exclusive=False, timeout=10):
+            # Read some_file.txt
         ```
-        
+
         Rather than locking a file directly, it is helpful to lock an adjacent
         .lock file.
 
         Exclusive locks are useful for read/write access whereas non-exclusive
         locks are useful for readonly access.
 
+        Acquisition blocks (without polling) until the lock is available or
+        the timeout has passed, in which case TimeoutError is raised.
+
+        Within a process, the locks on the same file share one open file:
+        threads that want a shared lock while another thread of the process
+        holds it do not touch the kernel, and the other threads wait on a
+        condition variable rather than on the file. The locks are reentrant
+        per thread (or per asyncio task, for async acquisition), so a thread
+        that holds an exclusive lock may acquire the same lock again (shared
+        or exclusive). Upgrading a shared lock to an exclusive one is an
+        error. See get_lock_stats for contention statistics.
+
+        The holder of an exclusive lock may remove the lock file before
+        releasing it: the callers that were waiting for it then lock the file
+        that is created in its place.
+
         Parameters
         ----------
         path : str
@@ -29,36 +51,385 @@ class FileLock():
             Whether the lock should be exclusive, by default True
         _disable_lock : bool, optional
             For testing purposes, do not actually lock, by default False
+        timeout : Union[float, None], optional
+            Maximum number of seconds to wait for the lock, by default None
+            (wait indefinitely)
         """
         self._path = path
-        self._file: Optional[IO] = None
         self._disable_lock = _disable_lock
         self._exclusive = exclusive
+        self._timeout = timeout
+        # (owner, _SharedLock) of the acquisitions made through this object
+        self._owners: List[tuple] = []
+        self._owners_lock = threading.Lock()
 
-    def __enter__(self) -> None:
+    def acquire(self, *, timeout: Union[float, None]=None) -> None:
+        """Wait for the lock (timeout defaults to the one of the constructor)"""
         if self._disable_lock:
             return
-        self._file = open(self._path, 'w+')
-        num_tries = 0
-        while True:
-            try:
-                if self._exclusive:
-                    fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                else:
-                    fcntl.flock(self._file, fcntl.LOCK_SH | fcntl.LOCK_NB)
-                if num_tries > 10:
-                    print('Locked file {} after {} tries (exclusive={})...'.format(self._path, num_tries, self._exclusive))
-                break
-            except IOError as e:
-                if e.errno != errno.EAGAIN:
-                    raise
-                else:
-                    num_tries = num_tries + 1
-                    time.sleep(random.uniform(0, 0.1))
+        self._acquire(owner=threading.get_ident(), timeout=timeout if timeout is not None else self._timeout)
 
-    def __exit__(self, type, value: object, traceback) -> None:
+    def release(self) -> None:
+        if self._disable_lock:
+            return
+        with self._owners_lock:
+            if len(self._owners) == 0:
+                raise Exception('Cannot release a lock that is not held: {}'.format(self._path))
+            # the most recent acquisition, preferably of this thread
+            index = len(self._owners) - 1
+            for i in reversed(range(len(self._owners))):
+                if self._owners[i][0] == threading.get_ident():
+                    index = i
+                    break
+            owner, shared_lock = self._owners.pop(index)
+        shared_lock.release(owner=owner)
+        _put_shared_lock(shared_lock)
+
+    async def acquire_async(self, *, timeout: Union[float, None]=None) -> None:
+        """Like acquire, but the waiting happens in the default executor of the event loop"""
+        # imported here because asyncio is slow to import
+        import asyncio
         if self._disable_lock:
             return
-        if self._file is not None:
-            fcntl.flock(self._file, fcntl.LOCK_UN)
-            self._file.close()
+        owner = asyncio.current_task()
+        if self._acquire(owner=owner, timeout=0, record_timeout=False):
+            return
+        if timeout is None:
+            timeout = self._timeout
+        future = asyncio.get_running_loop().run_in_executor(None, functools.partial(self._acquire, owner=owner, timeout=timeout))
+        try:
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # release the lock if the executor gets it after all
+            def _release_if_acquired(future):
+                if not future.cancelled() and future.exception() is None:
+                    self.release()
+            future.add_done_callback(_release_if_acquired)
+            raise
+
+    def __enter__(self) -> 'FileLock':
+        self.acquire()
+        return self
+
+    def __exit__(self, type, value: object, traceback) -> None:
+        self.release()
+
+    async def __aenter__(self) -> 'FileLock':
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, type, value: object, traceback) -> None:
+        self.release()
+
+    def _acquire(self, *, owner: Any, timeout: Union[float, None], record_timeout: bool=True) -> bool:
+        timer = time.time()
+        shared_lock = _get_shared_lock(self._path)
+        try:
+            acquired, contended, used_kernel = shared_lock.acquire(owner=owner, exclusive=self._exclusive, timeout=timeout)
+        except BaseException:
+            _put_shared_lock(shared_lock)
+            raise
+        if acquired:
+            with self._owners_lock:
+                self._owners.append((owner, shared_lock))
+        else:
+            _put_shared_lock(shared_lock)
+            if not record_timeout:
+                return False
+        _record_stats(shared_lock.path, acquired=acquired, contended=contended, used_kernel=used_kernel, wait_sec=time.time() - timer)
+        if not acquired:
+            raise TimeoutError('Timed out after {} sec waiting for lock: {}'.format(timeout, self._path))
+        return True
+
+
+def get_lock_stats(path: Union[str, None]=None) -> dict:
+    """Contention statistics of the file locks of this process
+
+    For each lock file (or for path only): num_acquisitions,
+    num_kernel_locks (acquisitions that needed a flock call rather than
+    joining the shared lock of another thread), num_contended (acquisitions
+    that had to wait), num_timeouts, wait_sec (total) and max_wait_sec.
+    """
+    with _stats_lock:
+        if path is not None:
+            return dict(_stats.get(_realpath(path), _empty_stats()))
+        return {k: dict(v) for k, v in _stats.items()}
+
+def reset_lock_stats() -> None:
+    with _stats_lock:
+        _stats.clear()
+
+
+class _SharedLock():
+    def __init__(self, path: str):
+        # The state of the lock on one file in this process
+        self.path = path
+        self.fd: Union[int, None] = None
+        self.cond = threading.Condition(threading.Lock())
+        # 'exclusive', 'shared' or None (the kernel lock that is held)
+        self.mode: Union[str, None] = None
+        self.exclusive_owner: Any = None
+        self.exclusive_count = 0
+        self.shared_owners: Dict[Any, int] = dict()
+        self.num_exclusive_waiting = 0
+        # whether a thread is waiting for the kernel lock
+        self.busy = False
+        # acquisitions that are waiting or held (see _get_shared_lock)
+        self.num_users = 0
+
+    def acquire(self, *, owner: Any, exclusive: bool, timeout: Union[float, None]) -> tuple:
+        # returns (acquired, contended, used_kernel)
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.cond:
+            if self.exclusive_owner == owner and self.exclusive_count > 0:
+                self.exclusive_count = self.exclusive_count + 1
+                return (True, False, False)
+            if owner in self.shared_owners:
+                if exclusive:
+                    raise Exception('Cannot acquire an exclusive lock while holding a shared lock: {}'.format(self.path))
+                self.shared_owners[owner] = self.shared_owners[owner] + 1
+                return (True, False, False)
+            contended = False
+            if exclusive:
+                self.num_exclusive_waiting = self.num_exclusive_waiting + 1
+            try:
+                while True:
+                    if not self.busy and self.exclusive_count == 0:
+                        if exclusive and len(self.shared_owners) == 0:
+                            break
+                        # shared locks wait for the exclusive ones that are waiting
+                        if not exclusive and self.num_exclusive_waiting == 0:
+                            if self.mode == 'shared':
+                                self.shared_owners[owner] = 1
+                                return (True, contended, False)
+                            break
+                    contended = True
+                    if deadline is None:
+                        self.cond.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return (False, contended, False)
+                        self.cond.wait(remaining)
+            finally:
+                if exclusive:
+                    self.num_exclusive_waiting = self.num_exclusive_waiting - 1
+            self.busy = True
+        # no other thread of this process holds the lock, so wait for the
+        # other processes (without holding the condition)
+        acquired = False
+        try:
+            op = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+            while True:
+                remaining = max(0.0, deadline - time.time()) if deadline is not None else None
+                fd, waited = _flock(self.path, self._open(), op=op, timeout=remaining)
+                contended = contended or waited
+                if fd is None:
+                    break
+                if fd != self.fd:
+                    # acquired on the file opened by the helper thread
+                    os.close(self.fd)
+                    self.fd = fd
+                if _refers_to(self.path, fd):
+                    acquired = True
+                    break
+                # the previous holder removed the file, so try again on the
+                # file that the other processes lock now
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            with self.cond:
+                self.busy = False
+                if acquired:
+                    if exclusive:
+                        self.mode = 'exclusive'
+                        self.exclusive_owner = owner
+                        self.exclusive_count = 1
+                    else:
+                        self.mode = 'shared'
+                        self.shared_owners[owner] = 1
+                self.cond.notify_all()
+        return (acquired, contended, True)
+
+    def release(self, *, owner: Any) -> None:
+        with self.cond:
+            if self.exclusive_owner == owner and self.exclusive_count > 0:
+                self.exclusive_count = self.exclusive_count - 1
+                if self.exclusive_count == 0:
+                    self.exclusive_owner = None
+            elif owner in self.shared_owners:
+                self.shared_owners[owner] = self.shared_owners[owner] - 1
+                if self.shared_owners[owner] == 0:
+                    del self.shared_owners[owner]
+            else:
+                raise Exception('Cannot release a lock that is not held: {}'.format(self.path))
+            if self.exclusive_count == 0 and len(self.shared_owners) == 0:
+                assert self.fd is not None
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+                self.mode = None
+                self.cond.notify_all()
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _open(self) -> int:
+        # The file stays open between acquisitions, unless it was removed or
+        # replaced in the meantime (then the lock would not be on the file
+        # that the other processes lock)
+        if self.fd is not None:
+            if _refers_to(self.path, self.fd):
+                return self.fd
+            os.close(self.fd)
+            self.fd = None
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        return self.fd
+
+
+def _refers_to(path: str, fd: int) -> bool:
+    # whether path (still) refers to the open file fd
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return False
+    st_fd = os.fstat(fd)
+    return (st.st_dev, st.st_ino) == (st_fd.st_dev, st_fd.st_ino)
+
+def _flock(path: str, fd: int, *, op: int, timeout: Union[float, None]) -> tuple:
+    # Returns (the file descriptor that holds the lock, whether it had to
+    # wait), where the file descriptor is fd or, if a helper thread waited
+    # for the lock, another one on the same file, or None on timeout
+    try:
+        fcntl.flock(fd, op | fcntl.LOCK_NB)
+        return (fd, False)
+    except OSError as e:
+        if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
+            raise
+    if timeout is None:
+        fcntl.flock(fd, op)
+        return (fd, True)
+    if timeout <= 0:
+        return (None, True)
+    return (_KernelWaiter(path, op=op).wait(timeout), True)
+
+class _KernelWaiter():
+    def __init__(self, path: str, *, op: int):
+        # A blocking flock cannot be interrupted without signals, so it
+        # happens in a helper thread, on its own open file. If the caller
+        # gives up, the helper releases the lock as soon as it gets it.
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        self._op = op
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._abandoned = False
+        self._error: Union[BaseException, None] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def wait(self, timeout: float) -> Union[int, None]:
+        self._done.wait(timeout)
+        with self._lock:
+            if not self._done.is_set():
+                self._abandoned = True
+                return None
+        if self._error is not None:
+            raise self._error
+        return self._fd
+
+    def _run(self) -> None:
+        try:
+            fcntl.flock(self._fd, self._op)
+        except BaseException as e:
+            self._error = e
+        with self._lock:
+            if not self._abandoned:
+                self._done.set()
+                if self._error is not None:
+                    os.close(self._fd)
+                return
+        if self._error is None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+
+
+# The locks of this process by real path, including up to _max_idle_files
+# that are not in use (whose files are kept open for reuse)
+_shared_locks: Dict[str, _SharedLock] = dict()
+_idle_shared_locks: 'OrderedDict[str, _SharedLock]' = OrderedDict()
+_shared_locks_lock = threading.Lock()
+_max_idle_files = 64
+
+_realpaths: Dict[str, str] = dict()
+
+def _realpath(path: str) -> str:
+    # os.path.realpath stats every component of the path, which would cost
+    # more than the lock itself
+    abspath = os.path.abspath(path)
+    ret = _realpaths.get(abspath, None)
+    if ret is None:
+        ret = os.path.realpath(abspath)
+        if len(_realpaths) >= 4096:
+            _realpaths.clear()
+        _realpaths[abspath] = ret
+    return ret
+
+def _get_shared_lock(path: str) -> _SharedLock:
+    realpath = _realpath(path)
+    with _shared_locks_lock:
+        shared_lock = _shared_locks.get(realpath, None)
+        if shared_lock is None:
+            shared_lock = _SharedLock(realpath)
+            _shared_locks[realpath] = shared_lock
+        _idle_shared_locks.pop(realpath, None)
+        shared_lock.num_users = shared_lock.num_users + 1
+        return shared_lock
+
+def _put_shared_lock(shared_lock: _SharedLock) -> None:
+    with _shared_locks_lock:
+        shared_lock.num_users = shared_lock.num_users - 1
+        if shared_lock.num_users > 0:
+            return
+        _idle_shared_locks[shared_lock.path] = shared_lock
+        while len(_idle_shared_locks) > _max_idle_files:
+            _, oldest = _idle_shared_locks.popitem(last=False)
+            del _shared_locks[oldest.path]
+            oldest.close()
+
+def _after_fork_in_child() -> None:
+    # The open files are shared with the parent (and so are their locks)
+    global _shared_locks_lock, _stats_lock
+    _shared_locks_lock = threading.Lock()
+    _stats_lock = threading.Lock()
+    for shared_lock in _shared_locks.values():
+        try:
+            shared_lock.close()
+        except OSError:
+            pass
+    _shared_locks.clear()
+    _idle_shared_locks.clear()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+_stats: Dict[str, dict] = dict()
+_stats_lock = threading.Lock()
+
+def _empty_stats() -> dict:
+    return dict(num_acquisitions=0, num_kernel_locks=0, num_contended=0, num_timeouts=0, wait_sec=0.0, max_wait_sec=0.0)
+
+def _record_stats(realpath: str, *, acquired: bool, contended: bool, used_kernel: bool, wait_sec: float) -> None:
+    with _stats_lock:
+        if realpath not in _stats:
+            _stats[realpath] = _empty_stats()
+        s = _stats[realpath]
+        if acquired:
+            s['num_acquisitions'] = s['num_acquisitions'] + 1
+            if used_kernel:
+                s['num_kernel_locks'] = s['num_kernel_locks'] + 1
+        else:
+            s['num_timeouts'] = s['num_timeouts'] + 1
+        if contended:
+            s['num_contended'] = s['num_contended'] + 1
+            s['wait_sec'] = s['wait_sec'] + wait_sec
+            s['max_wait_sec'] = max(s['max_wait_sec'], wait_sec)
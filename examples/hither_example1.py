@@ -44,10 +44,14 @@ def main():
     num_chars = count_chars.execute(fname=hash_url, _container=container, _force_run=force_run)
     print(num_chars.retval)
 
-    r = append_files.execute(path1=ka.store_text('test1:'), path2=ka.store_text('test2'), path_out=hither.File(), _container=container, _force_run=force_run)
+    # The jobs of a pipeline run in parallel as soon as their inputs are
+    # available, and intermediate files are passed on by hash
+    with hither.Pipeline(container=container, force_run=force_run):
+        r = append_files.execute(path1=ka.store_text('test1:'), path2=ka.store_text('test2'), path_out=hither.File())
+        num_chars = count_chars.execute(fname=r.outputs.path_out)
+        total = addem.execute(x=num_chars.retval, y=result.retval)
     print(ka.load_text(r.outputs.path_out._path))
-    num_chars = count_chars.execute(fname=r.outputs.path_out, _container=container, _force_run=force_run)
-    print(num_chars.retval)
+    print(num_chars.retval, total.retval)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,2 +1,64 @@
-from .core import function, input_file, output_file, container
-from .core import File
+from typing import TYPE_CHECKING
+
+# The submodules are imported on first access of their names (PEP 562), so
+# that "import hither" is fast (e.g., for short-lived processes and the
+# scripts that run inside containers)
+_exports = dict(
+    function='.core',
+    input_file='.core',
+    output_file='.core',
+    container='.core',
+    File='.core',
+    execute_many='.batch',
+    set_config='.config',
+    get_config='.config',
+    pin_result='.resultindex',
+    unpin_result='.resultindex',
+    evict_results='.resultindex',
+    get_file_hash='.filehashcache',
+    evict_file_hashes='.filehashcache',
+    clear_source_bundle_cache='.sourcebundle',
+    evict_source_bundles='.sourcebundle',
+    resources='.scheduler',
+    LocalScheduler='.scheduler',
+    set_scheduler='.scheduler',
+    get_scheduler='.scheduler',
+    Pipeline='.pipeline',
+    PendingResult='.pipeline',
+    prefetch_containers='.containerimages',
+    evict_container_images='.containerimages',
+    ContainerRuntime='.runtimes',
+    register_container_runtime='.runtimes',
+    add_execution_hook='.instrumentation',
+    remove_execution_hook='.instrumentation'
+)
+
+__all__ = list(_exports.keys())
+
+def __getattr__(name: str):
+    import importlib.util
+    if name not in _exports:
+        # e.g., hither.core (which used to be imported with the package)
+        if not name.startswith('_') and importlib.util.find_spec('.' + name, __name__) is not None:
+            return importlib.import_module('.' + name, __name__)
+        raise AttributeError('module {} has no attribute {}'.format(__name__, name))
+    value = getattr(importlib.import_module(_exports[name], __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(list(globals().keys()) + __all__)
+
+if TYPE_CHECKING:
+    from .core import function, input_file, output_file, container
+    from .core import File
+    from .batch import execute_many
+    from .config import set_config, get_config
+    from .resultindex import pin_result, unpin_result, evict_results
+    from .filehashcache import get_file_hash, evict_file_hashes
+    from .sourcebundle import clear_source_bundle_cache, evict_source_bundles
+    from .scheduler import resources, LocalScheduler, set_scheduler, get_scheduler
+    from .pipeline import Pipeline, PendingResult
+    from .containerimages import prefetch_containers, evict_container_images
+    from .runtimes import ContainerRuntime, register_container_runtime
+    from .instrumentation import add_execution_hook, remove_execution_hook
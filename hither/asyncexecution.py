@@ -0,0 +1,84 @@
+import asyncio
+import functools
+import contextvars
+
+from .core import _prepare_job, _load_result, _load_cached_result, _run_job, _prepare_run, _resolve_container, _create_console_capture, _finalize_job
+from .config import get_config_value
+from .scheduler import get_scheduler, get_function_resources
+from .run_function_in_container import run_function_in_container_async
+from .singleflight import SingleFlight
+from .instrumentation import record_execution, phase
+
+async def execute_async(f, kwargs: dict, *, force_run: bool=False, container=None, priority: int=0):
+    """The asyncio version of f.execute(**kwargs)
+
+    Container runs await the container process in the event loop, so many
+    jobs can run concurrently without a thread each. Hashing, cache lookups
+    and storing results are short blocking steps that run in the default
+    executor. In-process runs (no container) and warm-worker runs execute in
+    the default executor.
+    """
+    with record_execution(f._hither_name) as record:
+        with phase('hash_inputs'):
+            job = await _in_executor(_prepare_job, f=f, name=f._hither_name, version=f._hither_version, kwargs=kwargs)
+        if not force_run:
+            with phase('cache_lookup'):
+                result_serialized = await _in_executor(_load_result, hash_object=job.hash_object)
+            if result_serialized is not None:
+                with phase('load_cached'):
+                    record.result = await _in_executor(_load_cached_result, job=job, result_serialized=result_serialized)
+                if record.result is not None:
+                    return record.result
+            if get_config_value('use_single_flight'):
+                record.result = await _run_job_once_async(job=job, container=container, priority=priority)
+                return record.result
+        record.result = await _run_job_async(job=job, container=container, priority=priority)
+        return record.result
+
+async def _run_job_once_async(*, job, container, priority: int):
+    # See _run_job_once. The flight is acquired and released in the default
+    # executor because waiting for it blocks.
+    import kachery as ka
+    flight = SingleFlight(ka.get_object_hash(job.hash_object))
+    with phase('single_flight_wait'):
+        await _in_executor(flight.acquire, is_done=lambda: _load_result(hash_object=job.hash_object) is not None)
+    try:
+        result_serialized = await _in_executor(_load_result, hash_object=job.hash_object)
+        if result_serialized is not None:
+            with phase('load_cached'):
+                result0 = await _in_executor(_load_cached_result, job=job, result_serialized=result_serialized)
+            if result0 is not None:
+                return result0
+        return await _run_job_async(job=job, container=container, priority=priority)
+    finally:
+        await _in_executor(flight.release)
+
+async def _run_job_async(*, job, container, priority: int):
+    f = job.f
+    container = _resolve_container(f, container)
+    if container is None or get_config_value('use_warm_workers'):
+        return await _in_executor(_run_job, job=job, container=container, priority=priority)
+
+    scheduler = get_scheduler()
+    resources = get_function_resources(f)
+    if scheduler is not None:
+        with phase('scheduler_wait'):
+            await scheduler.acquire_async(resources, priority=priority)
+    try:
+        with phase('resolve_inputs'):
+            resolved_kwargs = await _in_executor(_prepare_run, job=job)
+        with _create_console_capture(redirect=False) as cc:
+            returnval = await run_function_in_container_async(
+                name=job.name, function=f, input_file_keys=job.input_file_keys, output_file_keys=job.output_file_keys,
+                container=container, keyword_args=resolved_kwargs, console_capture=cc
+            )
+    finally:
+        if scheduler is not None:
+            scheduler.release(resources)
+    return await _in_executor(_finalize_job, job=job, cc=cc, returnval=returnval)
+
+def _in_executor(fn, **kw):
+    # in the default executor, with the context of the calling task (so that
+    # the phases are recorded in its execution record)
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(None, functools.partial(context.run, fn, **kw))
@@ -0,0 +1,155 @@
+import os
+import time
+import functools
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from threading import Lock
+from typing import List, Tuple, Any, Union
+
+from .core import _prepare_job, _load_results, _load_cached_result, _run_job, _run_job_once, _allocate_resources
+from .config import set_config
+from .scheduler import get_scheduler
+from .pipeline import _resolve_placeholders
+from .instrumentation import ExecutionRecord, activate_record, phase, with_record, finish_record_with_future
+
+_shared_executor: Union[ThreadPoolExecutor, None] = None
+_shared_executor_lock = Lock()
+
+def execute_many(jobs: List[Tuple[Any, dict]], *, max_workers: Union[int, None]=None, use_processes: bool=False, force_run: bool=False, container=None, priority: int=0) -> list:
+    """Execute a batch of hither functions concurrently and return the results in order
+
+    Each job is a tuple (f, kwargs) where f is a @hither.function. The kwargs
+    may include _force_run, _container and _priority to override the
+    batch-wide values. The cache lookups for the whole batch are done up
+    front, and only the jobs that miss the cache are dispatched to the thread
+    (or process) pool. At most max_workers jobs run at a time. If a scheduler
+    is active (see hither.set_config), each of them also waits for its
+    declared resources, and the misses are dispatched in order of priority.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if use_processes:
+        executor: Any = ProcessPoolExecutor(max_workers=max_workers)
+    else:
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hither')
+    # threads that hold the scheduler resources of the jobs that run in
+    # processes (see _run_in_process)
+    holders = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hither') if use_processes and get_scheduler() is not None else None
+    try:
+        with executor:
+            futures = _submit_many(jobs, executor=executor, holders=holders, use_processes=use_processes, force_run=force_run, container=container, priority=priority)
+            return [fut.result() for fut in futures]
+    finally:
+        if holders is not None:
+            holders.shutdown()
+
+def submit_job(f, kwargs: dict, *, force_run: bool=False, container=None, priority: int=0) -> Future:
+    return _get_shared_executor().submit(f.execute, _force_run=force_run, _container=container, _priority=priority, **kwargs)
+
+def _submit_many(jobs, *, executor, holders, use_processes: bool, force_run: bool, container, priority: int) -> List[Future]:
+    scheduler = get_scheduler()
+    futures: List[Future] = []
+    prepared = []
+    records = dict()
+    for f, kwargs in jobs:
+        kwargs = dict(kwargs)
+        job_force_run = kwargs.pop('_force_run', force_run)
+        job_container = kwargs.pop('_container', container)
+        job_priority = kwargs.pop('_priority', priority)
+        fut: Future = Future()
+        futures.append(fut)
+        records[id(fut)] = ExecutionRecord(f._hither_name)
+        finish_record_with_future(records[id(fut)], fut)
+        try:
+            kwargs = _resolve_placeholders(kwargs)
+            with activate_record(records[id(fut)]), phase('hash_inputs'):
+                job = _prepare_job(f=f, name=f._hither_name, version=f._hither_version, kwargs=kwargs)
+        except Exception as e:
+            fut.set_exception(e)
+            continue
+        prepared.append((fut, f, kwargs, job, job_force_run, job_container, job_priority))
+
+    to_check = [p for p in prepared if not p[4]]
+    timer = time.time()
+    results_serialized = _load_results(hash_objects=[p[3].hash_object for p in to_check])
+    cached = dict()
+    for p, result_serialized in zip(to_check, results_serialized):
+        # the time of the batched lookup
+        records[id(p[0])].add_phase_time('cache_lookup', time.time() - timer)
+        if result_serialized is not None:
+            cached[id(p[0])] = result_serialized
+
+    if scheduler is not None:
+        # the pool takes the jobs in order, so the resources go to the jobs
+        # with the highest priority first (stable for equal priorities)
+        prepared.sort(key=lambda p: -p[6])
+    for fut, f, kwargs, job, job_force_run, job_container, job_priority in prepared:
+        record = records[id(fut)]
+        if id(fut) in cached:
+            try:
+                with activate_record(record), phase('load_cached'):
+                    result0 = _load_cached_result(job=job, result_serialized=cached[id(fut)])
+            except Exception as e:
+                fut.set_exception(e)
+                continue
+            if result0 is not None:
+                fut.set_result(result0)
+                continue
+        # a forced run does not wait for (or share) an identical run elsewhere
+        run_job = _run_job if job_force_run else _run_job_once
+        if use_processes and holders is not None:
+            fut0 = holders.submit(with_record, record, _run_in_process, executor, f, kwargs, job=job, container=job_container, force_run=job_force_run, priority=job_priority)
+        elif use_processes:
+            # the phases of the run are recorded in the process (see _execute_in_process)
+            fut0 = executor.submit(_execute_in_process, f, kwargs, job_container, job_force_run)
+        else:
+            # with a scheduler, _run_job waits for the resources in the pool thread
+            fut0 = executor.submit(with_record, record, run_job, job=job, container=job_container, priority=job_priority)
+        _chain_future(fut0, fut)
+    return futures
+
+def _execute_in_process(f, kwargs, container, force_run, use_scheduler=None):
+    # we already know that this is a cache miss
+    if use_scheduler is not None:
+        # the processes of the pool only run these jobs
+        set_config(use_scheduler=use_scheduler)
+    with activate_record(ExecutionRecord(f._hither_name)):
+        job = _prepare_job(f=f, name=f._hither_name, version=f._hither_version, kwargs=kwargs)
+        if force_run:
+            result = _run_job(job=job, container=container)
+        else:
+            result = _run_job_once(job=job, container=container)
+    # the processes of the pool exit without the atexit flush of loggery
+    import loggery
+    loggery.flush()
+    return result
+
+def _run_in_process(executor, f, kwargs, *, job, container, force_run: bool, priority: int):
+    # The single flight is also waited for here, before the resources are
+    # allocated (see _run_job_once), rather than in the process
+    if force_run:
+        return _run_allocated_in_process(executor, f, kwargs, job=job, container=container, priority=priority)
+    return _run_job_once(job=job, container=container, priority=priority, run_job=functools.partial(_run_allocated_in_process, executor, f, kwargs))
+
+def _run_allocated_in_process(executor, f, kwargs, *, job, container, priority: int):
+    # Holds the scheduler resources of the job in this process while it runs
+    # in a process of executor. There are as many of these threads as
+    # processes, so a job never waits for a free process while holding them.
+    with _allocate_resources(job, priority=priority):
+        # the process neither waits for the flight nor allocates the resources again
+        return executor.submit(_execute_in_process, f, kwargs, container, True, False).result()
+
+def _chain_future(source: Future, dest: Future) -> None:
+    def _done(source: Future):
+        e = source.exception()
+        if e is not None:
+            dest.set_exception(e)
+        else:
+            dest.set_result(source.result())
+    source.add_done_callback(_done)
+
+def _get_shared_executor() -> ThreadPoolExecutor:
+    global _shared_executor
+    with _shared_executor_lock:
+        if _shared_executor is None:
+            _shared_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='hither')
+        return _shared_executor
@@ -0,0 +1,101 @@
+import os
+from copy import deepcopy
+from typing import Union
+
+def _default_hither_dir() -> str:
+    return os.environ.get('HITHER_DIR', os.path.join(os.path.expanduser('~'), '.hither'))
+
+_config = dict(
+    hither_dir=_default_hither_dir(),
+    use_result_index=True,
+    result_index_max_bytes=2 * 1024 * 1024 * 1024,
+    result_index_max_age_sec=None,
+    show_cached_console=True,
+    file_hash_max_workers=4,
+    file_hash_cache_max_entries=100000,
+    use_warm_workers=False,
+    warm_worker_idle_timeout_sec=600,
+    warm_worker_max_count=8,
+    console_spool_threshold=1000000,
+    console_max_head=None,
+    console_max_tail=None,
+    console_passthrough_max_rate=None,
+    job_log_dir=None,
+    use_scheduler=False,
+    use_single_flight=True,
+    single_flight_lease_sec=None,
+    retval_inline_max_bytes=100000,
+    container_runtime='singularity',
+    staging_dir=None,
+    use_container_image_cache=True,
+    container_image_cache_max_bytes=50 * 1024 * 1024 * 1024,
+    source_bundle_max_count=200
+)
+
+def set_config(
+        *,
+        hither_dir: Union[str, None]=None,
+        use_result_index: Union[bool, None]=None,
+        result_index_max_bytes: Union[int, None]=None,
+        result_index_max_age_sec: Union[float, None]=None,
+        show_cached_console: Union[bool, None]=None,
+        file_hash_max_workers: Union[int, None]=None,
+        file_hash_cache_max_entries: Union[int, None]=None,
+        use_warm_workers: Union[bool, None]=None,
+        warm_worker_idle_timeout_sec: Union[float, None]=None,
+        warm_worker_max_count: Union[int, None]=None,
+        console_spool_threshold: Union[int, None]=None,
+        console_max_head: Union[int, None]=None,
+        console_max_tail: Union[int, None]=None,
+        console_passthrough_max_rate: Union[float, None]=None,
+        job_log_dir: Union[str, None]=None,
+        use_scheduler: Union[bool, None]=None,
+        use_single_flight: Union[bool, None]=None,
+        single_flight_lease_sec: Union[float, None]=None,
+        retval_inline_max_bytes: Union[int, None]=None,
+        container_runtime: Union[str, None]=None,
+        staging_dir: Union[str, None]=None,
+        use_container_image_cache: Union[bool, None]=None,
+        container_image_cache_max_bytes: Union[int, None]=None,
+        source_bundle_max_count: Union[int, None]=None
+) -> None:
+    kwargs = dict(
+        hither_dir=hither_dir,
+        use_result_index=use_result_index,
+        result_index_max_bytes=result_index_max_bytes,
+        result_index_max_age_sec=result_index_max_age_sec,
+        show_cached_console=show_cached_console,
+        file_hash_max_workers=file_hash_max_workers,
+        file_hash_cache_max_entries=file_hash_cache_max_entries,
+        use_warm_workers=use_warm_workers,
+        warm_worker_idle_timeout_sec=warm_worker_idle_timeout_sec,
+        warm_worker_max_count=warm_worker_max_count,
+        console_spool_threshold=console_spool_threshold,
+        console_max_head=console_max_head,
+        console_max_tail=console_max_tail,
+        console_passthrough_max_rate=console_passthrough_max_rate,
+        job_log_dir=job_log_dir,
+        use_scheduler=use_scheduler,
+        use_single_flight=use_single_flight,
+        single_flight_lease_sec=single_flight_lease_sec,
+        retval_inline_max_bytes=retval_inline_max_bytes,
+        container_runtime=container_runtime,
+        staging_dir=staging_dir,
+        use_container_image_cache=use_container_image_cache,
+        container_image_cache_max_bytes=container_image_cache_max_bytes,
+        source_bundle_max_count=source_bundle_max_count
+    )
+    for k, v in kwargs.items():
+        if v is not None:
+            _config[k] = v
+
+def get_config() -> dict:
+    return deepcopy(_config)
+
+def get_config_value(key: str):
+    return _config[key]
+
+def get_hither_dir(*subdirs: str) -> str:
+    path = os.path.join(_config['hither_dir'], *subdirs)
+    os.makedirs(path, exist_ok=True)
+    return path
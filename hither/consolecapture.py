@@ -1,31 +1,201 @@
-from typing import Any
+from typing import Any, List, Union
 import sys
 import time
 import io
 import os
+import hashlib
+import tempfile
+import threading
+from collections import deque
 
-class Logger2():
-    def __init__(self, file1: Any, file2: Any):
-        self.file1 = file1
-        self.file2 = file2
+class _RoutingStream():
+    # Installed in place of sys.stdout / sys.stderr while any capture is active.
+    # Writes are passed through to the original stream and also routed to the
+    # captures of the writing thread, so that concurrent jobs do not
+    # interleave their captured output.
+    def __init__(self, original: Any, stream_name: str):
+        self._original = original
+        self._stream_name = stream_name
 
     def write(self, data: str) -> None:
-        self.file1.write(data)
-        self.file2.write(data)
+        captures = _captures_for_current_thread()
+        for cc in captures:
+            cc._stream(self._stream_name).write(data)
+        if len(captures) == 0 or captures[-1]._passthrough_allowed(len(data), self._original):
+            self._original.write(data)
 
     def flush(self) -> None:
-        self.file1.flush()
-        self.file2.flush()
+        self._original.flush()
+
+    def __getattr__(self, attr):
+        return getattr(self._original, attr)
+
+
+_lock = threading.Lock()
+_local = threading.local()
+_active_captures: List['ConsoleCapture'] = []
+_original_streams: dict = dict()
+
+def _captures_for_current_thread() -> List['ConsoleCapture']:
+    captures = getattr(_local, 'captures', None)
+    if captures:
+        return captures
+    # Output from threads that did not start a capture (e.g., worker threads
+    # spawned by the function itself) goes to the capture if there is only one
+    with _lock:
+        if len(_active_captures) == 1:
+            return list(_active_captures)
+    return []
+
+
+def current_console_capture() -> Union['ConsoleCapture', None]:
+    """Return the innermost console capture of the current thread (if any)"""
+    captures = getattr(_local, 'captures', None)
+    if captures:
+        return captures[-1]
+    return None
+
+
+class _CapturedStream():
+    def __init__(self, *, spool_threshold: int, max_head: Union[int, None], max_tail: Union[int, None], spool_dir: Union[str, None]):
+        # Kept in memory until spool_threshold characters have been written,
+        # and then in a temporary file (in spool_dir). If max_head is set,
+        # only the first max_head and the last max_tail characters are kept.
+        self._spool_threshold = spool_threshold
+        self._spool_dir = spool_dir
+        self._max_head = max_head
+        self._max_tail = max_tail if max_tail is not None else 0
+        self._memory: Union[io.StringIO, None] = io.StringIO()
+        self._file: Any = None
+        self._file_path: Union[str, None] = None
+        self._size = 0
+        self._hasher = hashlib.sha1()
+        self._tail: deque = deque()
+        self._tail_size = 0
+        self._num_omitted = 0
+        self._finalized = False
+        self._lock = threading.Lock()
+
+    def write(self, data: str) -> None:
+        with self._lock:
+            if self._finalized:
+                return
+            if self._max_head is not None and self._size + len(data) > self._max_head:
+                n = max(0, self._max_head - self._size)
+                if n > 0:
+                    self._store(data[:n])
+                self._add_to_tail(data[n:])
+            else:
+                self._store(data)
+
+    def finalize(self) -> None:
+        with self._lock:
+            if self._finalized:
+                return
+            if self._num_omitted > 0:
+                self._store('\n[... {} characters omitted by hither ...]\n'.format(self._num_omitted))
+            if self._tail_size > 0:
+                self._store(''.join(self._tail))
+                self._tail.clear()
+                self._tail_size = 0
+            if self._file is not None:
+                self._file.close()
+            self._finalized = True
+
+    def text(self) -> str:
+        if self._memory is not None:
+            return self._memory.getvalue()
+        if self._file is not None and not self._file.closed:
+            self._file.flush()
+        with open(self._file_path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def path(self) -> Union[str, None]:
+        # the temporary file holding the content, if it was spooled to disk
+        # (its sha1 is in info(), so the file may be moved into the kachery
+        # storage without reading it again)
+        return self._file_path
+
+    def info(self) -> dict:
+        return dict(
+            size=self._size,
+            sha1=self._hasher.hexdigest(),
+            num_omitted=self._num_omitted
+        )
+
+    def cleanup(self) -> None:
+        self.finalize()
+        if self._file_path is not None and os.path.exists(self._file_path):
+            os.unlink(self._file_path)
+
+    def _store(self, data: str) -> None:
+        # hashed incrementally so that the content does not need to be read again
+        self._hasher.update(data.encode('utf-8', errors='replace'))
+        self._size = self._size + len(data)
+        if self._memory is not None:
+            self._memory.write(data)
+            if self._memory.tell() > self._spool_threshold:
+                # no newline translation, so that the file has the hashed bytes
+                self._file = tempfile.NamedTemporaryFile('w', encoding='utf-8', errors='replace', newline='', prefix='hither_console_', suffix='.txt', dir=self._spool_dir, delete=False)
+                self._file_path = self._file.name
+                self._file.write(self._memory.getvalue())
+                self._memory = None
+        else:
+            self._file.write(data)
+
+    def _add_to_tail(self, data: str) -> None:
+        if self._max_tail == 0:
+            self._num_omitted = self._num_omitted + len(data)
+            return
+        self._tail.append(data)
+        self._tail_size = self._tail_size + len(data)
+        while self._tail_size > self._max_tail:
+            excess = self._tail_size - self._max_tail
+            if len(self._tail[0]) <= excess:
+                x = self._tail.popleft()
+                self._tail_size = self._tail_size - len(x)
+                self._num_omitted = self._num_omitted + len(x)
+            else:
+                self._tail[0] = self._tail[0][excess:]
+                self._tail_size = self._tail_size - excess
+                self._num_omitted = self._num_omitted + excess
 
 
 class ConsoleCapture():
-    def __init__(self):
-        self._stdout = None
-        self._stderr = None
+    def __init__(self, *, spool_threshold: int=1000000, max_head: Union[int, None]=None, max_tail: Union[int, None]=None, passthrough_max_rate: Union[float, None]=None, redirect: bool=True, spool_dir: Union[str, None]=None):
+        """Capture stdout and stderr while still passing them through to the console
+
+        Parameters
+        ----------
+        spool_threshold : int, optional
+            Number of characters kept in memory before spooling to a temporary file
+        max_head : int or None, optional
+            If set, only keep the first max_head characters (plus the tail)
+        max_tail : int or None, optional
+            With max_head, also keep the last max_tail characters
+        passthrough_max_rate : float or None, optional
+            If set, limit the output passed through to the console (characters per second)
+        redirect : bool, optional
+            Whether to capture what the current thread writes to sys.stdout
+            and sys.stderr, by default True. If False, output only arrives
+            through write() (e.g., from a subprocess awaited in an event loop).
+        spool_dir : str or None, optional
+            Directory of the temporary files, by default the system temporary
+            directory
+        """
+        self._spool_threshold = spool_threshold
+        self._max_head = max_head
+        self._max_tail = max_tail
+        self._passthrough_max_rate = passthrough_max_rate
+        self._redirect = redirect
+        self._spool_dir = spool_dir
+        self._passthrough_allowance = passthrough_max_rate
+        self._passthrough_last_time = None
+        self._num_suppressed = 0
+        self._stdout: Union[_CapturedStream, None] = None
+        self._stderr: Union[_CapturedStream, None] = None
         self._time_start = None
         self._time_stop = None
-        self._original_stdout = sys.stdout
-        self._original_stderr = sys.stderr
 
     def __enter__(self):
         self._start_capturing()
@@ -34,23 +204,99 @@ class ConsoleCapture():
     def __exit__(self, type, value, traceback):
         self._stop_capturing()
 
+    def __del__(self):
+        self.cleanup()
+
+    def write(self, stream_name: str, data: str) -> None:
+        """Add output to this capture from any thread (e.g., the output of a subprocess)
+
+        The data is also passed through to the original console.
+        """
+        self._stream(stream_name).write(data)
+        original = _original_streams.get(stream_name, None)
+        if original is None:
+            original = sys.stdout if stream_name == 'stdout' else sys.stderr
+        if self._passthrough_allowed(len(data), original):
+            original.write(data)
+            original.flush()
+
+    def stream(self, stream_name: str) -> _CapturedStream:
+        assert self._time_start is not None
+        return self._stream(stream_name)
+
+    def cleanup(self) -> None:
+        # remove any temporary files (call once the captured output has been stored)
+        for x in [self._stdout, self._stderr]:
+            if x is not None:
+                x.cleanup()
+
+    def _stream(self, stream_name: str) -> _CapturedStream:
+        return self._stdout if stream_name == 'stdout' else self._stderr
+
+    def _passthrough_allowed(self, num_chars: int, original: Any) -> bool:
+        if self._passthrough_max_rate is None:
+            return True
+        # token bucket allowing bursts of up to one second of output
+        now = time.time()
+        if self._passthrough_last_time is not None:
+            self._passthrough_allowance = min(
+                self._passthrough_max_rate,
+                self._passthrough_allowance + (now - self._passthrough_last_time) * self._passthrough_max_rate
+            )
+        self._passthrough_last_time = now
+        if self._passthrough_allowance < num_chars:
+            self._num_suppressed = self._num_suppressed + num_chars
+            return False
+        self._passthrough_allowance = self._passthrough_allowance - num_chars
+        self._report_suppressed(original)
+        return True
+
+    def _report_suppressed(self, original: Any) -> None:
+        if self._num_suppressed > 0:
+            original.write('[hither: {} characters of console output not shown]\n'.format(self._num_suppressed))
+            self._num_suppressed = 0
+
     def _start_capturing(self) -> None:
         self._time_start = time.time()
-        self._stdout = io.StringIO()
-        self._stderr = io.StringIO()
-        sys.stdout = Logger2(self._stdout, self._original_stdout)
-        sys.stderr = Logger2(self._stderr, self._original_stderr)
+        self._stdout = _CapturedStream(spool_threshold=self._spool_threshold, max_head=self._max_head, max_tail=self._max_tail, spool_dir=self._spool_dir)
+        self._stderr = _CapturedStream(spool_threshold=self._spool_threshold, max_head=self._max_head, max_tail=self._max_tail, spool_dir=self._spool_dir)
+        if not self._redirect:
+            return
+        if not hasattr(_local, 'captures'):
+            _local.captures = []
+        _local.captures.append(self)
+        with _lock:
+            if len(_active_captures) == 0:
+                _original_streams['stdout'] = sys.stdout
+                _original_streams['stderr'] = sys.stderr
+                sys.stdout = _RoutingStream(sys.stdout, 'stdout')
+                sys.stderr = _RoutingStream(sys.stderr, 'stderr')
+            _active_captures.append(self)
 
     def _stop_capturing(self) -> None:
         self._time_stop = time.time()
-        sys.stdout = self._original_stdout
-        sys.stderr = self._original_stderr
+        if self._redirect:
+            _local.captures.remove(self)
+            with _lock:
+                _active_captures.remove(self)
+                if len(_active_captures) == 0:
+                    sys.stdout = _original_streams['stdout']
+                    sys.stderr = _original_streams['stderr']
+        self._report_suppressed(sys.stderr)
+        self._stdout.finalize()
+        self._stderr.finalize()
 
-    def runtime_info(self) -> dict:
+    def runtime_info(self, include_output: bool=True) -> dict:
         assert self._time_start is not None
-        return dict(
+        ret = dict(
             start_time=self._time_start - 0,
             end_time=self._time_stop - 0,
-            stdout=self._stdout.getvalue(),
-            stderr=self._stderr.getvalue()
+            console=dict(
+                stdout=self._stdout.info(),
+                stderr=self._stderr.info()
+            )
         )
+        if include_output:
+            ret['stdout'] = self._stdout.text()
+            ret['stderr'] = self._stderr.text()
+        return ret
@@ -0,0 +1,167 @@
+import os
+import uuid
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Union
+
+from .config import get_config_value, get_hither_dir
+from .shellscript import ShellScript
+
+# References that singularity would otherwise pull (and convert) on every run
+_REMOTE_PREFIXES = ['docker://', 'docker-daemon://', 'shub://', 'library://', 'oras://']
+
+def get_container_image(container: str) -> str:
+    """Return the local image to run for a container reference
+
+    Remote references (e.g., docker://python:3.7) are converted to a SIF
+    image in the local cache the first time they are used. Local images are
+    returned unchanged.
+    """
+    if not get_config_value('use_container_image_cache') or not _is_remote(container):
+        return container
+    return _get_cache().get(container)
+
+def prefetch_containers(containers: list, *, max_workers: int=4) -> Dict[str, str]:
+    """Convert container images ahead of time (e.g., before submitting many jobs)
+
+    Parameters
+    ----------
+    containers : list
+        Container references and/or hither functions (for all of the
+        containers declared with @hither.container)
+    max_workers : int, optional
+        Number of concurrent conversions, by default 4
+
+    Returns
+    -------
+    dict
+        The local image for each container reference
+    """
+    refs: List[str] = []
+    for x in containers:
+        if isinstance(x, str):
+            refs.append(x)
+        else:
+            refs.extend(getattr(x, '_hither_containers', dict()).values())
+    refs = sorted(set(refs))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        paths = list(executor.map(get_container_image, refs))
+    return dict(zip(refs, paths))
+
+def evict_container_images(*, max_bytes: Union[int, None]=None) -> int:
+    """Remove the least recently used images until the cache fits in max_bytes
+    (by default the container_image_cache_max_bytes config value).
+    Returns the number of images removed."""
+    return _get_cache().evict(max_bytes=max_bytes)
+
+
+class _ContainerImageCache():
+    def __init__(self, directory: str):
+        # Each image is <key>.sif, where the key is the digest for references
+        # pinned by digest and a hash of the reference otherwise. The mtime of
+        # an image is its last use (for the LRU eviction).
+        self._directory = directory
+        self._locks: Dict[str, threading.Lock] = dict()
+        self._locks_lock = threading.Lock()
+
+    def directory(self) -> str:
+        return self._directory
+
+    def get(self, ref: str) -> str:
+        # imported here because hither is also imported inside the containers
+        from etconf.filelock import FileLock
+        path = os.path.join(self._directory, _image_key(ref) + '.sif')
+        if not os.path.exists(path):
+            # single flight: one conversion per image, across threads and processes
+            with self._thread_lock(path):
+                with FileLock(path + '.lock', exclusive=True):
+                    if not os.path.exists(path):
+                        self._build(ref, path)
+            self.evict(keep=path)
+        _touch(path)
+        return path
+
+    def evict(self, *, max_bytes: Union[int, None]=None, keep: Union[str, None]=None) -> int:
+        from etconf.filelock import FileLock
+        if max_bytes is None:
+            max_bytes = get_config_value('container_image_cache_max_bytes')
+        images = []
+        for fname in os.listdir(self._directory):
+            if fname.endswith('.sif'):
+                path = os.path.join(self._directory, fname)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                images.append((st.st_mtime, st.st_size, path))
+        images.sort()
+        total_size = sum([x[1] for x in images])
+        num_removed = 0
+        for _, size, path in images:
+            if total_size <= max_bytes:
+                break
+            if path == keep:
+                continue
+            with FileLock(path + '.lock', exclusive=True):
+                if os.path.exists(path):
+                    # a container that is running from this image keeps it open
+                    os.unlink(path)
+                    num_removed = num_removed + 1
+            total_size = total_size - size
+        return num_removed
+
+    def _build(self, ref: str, path: str) -> None:
+        print('Converting container image {}'.format(ref))
+        tmp_path = '{}.tmp.{}.sif'.format(path, uuid.uuid4().hex[:8])
+        try:
+            ss = ShellScript('''
+                #!/bin/bash
+                set -e
+
+                singularity build {tmp_path} {ref}
+            '''.format(tmp_path=tmp_path, ref=ref), keep_temp_files=False)
+            ss.start()
+            retcode = ss.wait()
+            if retcode != 0 or not os.path.exists(tmp_path):
+                raise Exception('Unable to convert container image {} (exit code {})'.format(ref, retcode))
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def _thread_lock(self, path: str) -> threading.Lock:
+        # so that the threads of this process wait on a lock rather than polling the file lock
+        with self._locks_lock:
+            if path not in self._locks:
+                self._locks[path] = threading.Lock()
+            return self._locks[path]
+
+
+def _is_remote(container: str) -> bool:
+    for prefix in _REMOTE_PREFIXES:
+        if container.startswith(prefix):
+            return True
+    return False
+
+def _image_key(ref: str) -> str:
+    if '@sha256:' in ref:
+        return 'sha256-' + ref.split('@sha256:')[1]
+    return 'ref-' + hashlib.sha1(ref.encode('utf-8')).hexdigest()
+
+def _touch(path: str) -> None:
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+_global_cache: Union[_ContainerImageCache, None] = None
+_global_cache_lock = threading.Lock()
+
+def _get_cache() -> _ContainerImageCache:
+    global _global_cache
+    directory = get_hither_dir('container_images')
+    with _global_cache_lock:
+        if _global_cache is None or _global_cache.directory() != directory:
+            _global_cache = _ContainerImageCache(directory)
+        return _global_cache
@@ -0,0 +1,413 @@
+import os
+import json
+import time
+import uuid
+import select
+import shutil
+import atexit
+import threading
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+from .temporarydirectory import TemporaryDirectory
+from .shellscript import ShellScript
+from .linkfile import clone_or_copy_file, move_file
+from .kacherystore import get_staging_dir
+from .instrumentation import phase, add_phase_time, add_resources, read_usage_file
+from .config import get_config_value
+from .run_function_in_container import _runtime_script, _run_function_in_new_container, _output_streaming_kwargs
+from .shellscript import _LineBuffer
+from .runtimes import get_container_runtime
+from .serialization import write_object, read_or_store_object
+from .sourcebundle import get_source_bundle, bundle_pythonpath, BUNDLE_PATH_INSIDE_CONTAINER
+
+
+class ContainerWorker():
+    def __init__(self, *, name: str, container: str, bundle_path: str):
+        """A long-lived container process that runs jobs for a single hither function
+
+        The source bundle (see get_source_bundle) is mounted and the container is started once. Jobs
+        are then sent over a pair of named pipes in the bind-mounted working
+        directory, so the interpreter and the imported module are reused.
+        Input files are staged into a per-job directory inside the working
+        directory (cloned when possible), because bind mounts cannot be
+        added to a running container. The output of a job is written to files
+        in its directory, which are followed while the job runs.
+        """
+        self._name = name
+        self._container = container
+        self._temp_dir = TemporaryDirectory(remove=True, prefix='tmp_hither_worker_' + name, dir=get_staging_dir())
+        self._temp_path = self._temp_dir.__enter__()
+        self._lock = threading.Lock()
+        self._last_used = time.time()
+        self._response_buffer = b''
+        # set while a request has no response yet (see run_job)
+        self._broken = False
+        self._runtime = get_container_runtime()
+        # without bind mounts (e.g., the subprocess runtime), the worker uses the host paths
+        self._run_dir = '/run_in_container' if self._runtime.uses_bind_mounts else self._temp_path
+
+        os.mkdir(os.path.join(self._temp_path, 'jobs'))
+        os.mkfifo(os.path.join(self._temp_path, 'requests.fifo'))
+        os.mkfifo(os.path.join(self._temp_path, 'responses.fifo'))
+        # Opening both ends read/write means that neither open blocks and that
+        # the pipes stay valid if the worker goes away
+        self._requests_fd = os.open(os.path.join(self._temp_path, 'requests.fifo'), os.O_RDWR)
+        self._responses_fd = os.open(os.path.join(self._temp_path, 'responses.fifo'), os.O_RDWR)
+
+        worker_py_script = """
+            #!/usr/bin/env python
+
+            from function_src import {function_name}
+            from hither.serialization import read_object, write_object
+            from hither.instrumentation import ResourceMeter
+            import sys
+            import os
+            import json
+            import traceback
+
+            def run_job(job):
+                job_dir = '{run_dir}/jobs/' + job['job_id']
+                sys.stdout.flush()
+                sys.stderr.flush()
+                saved_fds = (os.dup(1), os.dup(2))
+                with open(job_dir + '/stdout.txt', 'w') as fout, open(job_dir + '/stderr.txt', 'w') as ferr:
+                    os.dup2(fout.fileno(), 1)
+                    os.dup2(ferr.fileno(), 2)
+                    try:
+                        kwargs = read_object(job_dir + '/kwargs.pkl')
+                        # the jobs of a worker run one at a time, so this is the usage of
+                        # the job (except for the peak memory, see run_job)
+                        with ResourceMeter(scope='process') as meter:
+                            retval = {function_name}(**kwargs)
+                        write_object(retval, job_dir + '/retval.pkl')
+                        meter.write(job_dir + '/usage.json')
+                        success = True
+                    except:
+                        traceback.print_exc()
+                        success = False
+                    finally:
+                        sys.stdout.flush()
+                        sys.stderr.flush()
+                        os.dup2(saved_fds[0], 1)
+                        os.dup2(saved_fds[1], 2)
+                        os.close(saved_fds[0])
+                        os.close(saved_fds[1])
+                return success
+
+            def main():
+                with open('{run_dir}/requests.fifo', 'r') as requests:
+                    with open('{run_dir}/responses.fifo', 'w') as responses:
+                        for line in requests:
+                            job = json.loads(line)
+                            if job.get('shutdown', False):
+                                break
+                            success = run_job(job)
+                            responses.write(json.dumps(dict(job_id=job['job_id'], success=success)) + '\\n')
+                            responses.flush()
+
+            if __name__ == "__main__":
+                main()
+        """.format(
+            function_name=name,
+            run_dir=self._run_dir
+        )
+        ShellScript(worker_py_script).write(os.path.join(self._temp_path, 'worker.py'))
+
+        if self._runtime.uses_bind_mounts:
+            binds = {
+                '$KACHERY_STORAGE_DIR': '/kachery-storage',
+                self._temp_path: '/run_in_container',
+                bundle_path: BUNDLE_PATH_INSIDE_CONTAINER + ':ro'
+            }
+            env_vars_inside_container = dict(KACHERY_STORAGE_DIR='/kachery-storage', PYTHONPATH=bundle_pythonpath(BUNDLE_PATH_INSIDE_CONTAINER))
+        else:
+            binds = dict()
+            env_vars_inside_container = dict(PYTHONPATH=bundle_pythonpath(bundle_path))
+
+        run_inside_script = """
+            #!/bin/bash
+            set -e
+
+            {env_vars} {python} {run_dir}/worker.py
+        """.format(
+            env_vars=' '.join(['{}={}'.format(k, v) for k, v in env_vars_inside_container.items()]),
+            python=self._runtime.python_executable,
+            run_dir=self._run_dir
+        )
+        ShellScript(run_inside_script).write(os.path.join(self._temp_path, 'run.sh'))
+
+        run_outside_script = _runtime_script(runtime=self._runtime, container=container, binds=binds, command='bash {}/run.sh'.format(self._run_dir))
+        self._script = ShellScript(run_outside_script, keep_temp_files=False)
+        self._script.start()
+
+    def try_acquire(self) -> bool:
+        return self._lock.acquire(blocking=False)
+
+    def release(self) -> None:
+        self._last_used = time.time()
+        self._lock.release()
+
+    def idle_time(self) -> float:
+        return time.time() - self._last_used
+
+    def is_alive(self) -> bool:
+        return not self._broken and self._script.isRunning()
+
+    def run_job(self, *, keyword_args: dict, input_file_keys: list, output_file_keys: list) -> Any:
+        # the caller must hold the lock (see try_acquire)
+        stage_time = time.time()
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(self._temp_path, 'jobs', job_id)
+        job_dir_inside = '{}/jobs/{}'.format(self._run_dir, job_id)
+        os.mkdir(job_dir)
+        os.mkdir(os.path.join(job_dir, 'inputs'))
+        os.mkdir(os.path.join(job_dir, 'outputs'))
+        try:
+            keyword_args_adjusted = dict(keyword_args)
+            kachery_storage_dir = os.environ.get('KACHERY_STORAGE_DIR', None)
+            for iname in input_file_keys:
+                if iname in keyword_args.keys():
+                    fname_outside = keyword_args[iname]
+                    if not self._runtime.uses_bind_mounts:
+                        # the worker sees the host filesystem
+                        continue
+                    if kachery_storage_dir and _is_within_directory(fname_outside, kachery_storage_dir):
+                        # already visible in the container
+                        keyword_args_adjusted[iname] = '/kachery-storage/' + os.path.relpath(os.path.realpath(fname_outside), os.path.realpath(kachery_storage_dir))
+                    else:
+                        _, ext = os.path.splitext(fname_outside)
+                        clone_or_copy_file(fname_outside, os.path.join(job_dir, 'inputs', iname + ext))
+                        keyword_args_adjusted[iname] = '{}/inputs/{}{}'.format(job_dir_inside, iname, ext)
+            outputs_to_copy = dict()
+            for oname in output_file_keys:
+                if oname in keyword_args.keys():
+                    fname_outside = keyword_args[oname]
+                    _, ext = os.path.splitext(fname_outside)
+                    keyword_args_adjusted[oname] = '{}/outputs/{}{}'.format(job_dir_inside, oname, ext)
+                    outputs_to_copy[os.path.join(job_dir, 'outputs', oname + ext)] = fname_outside
+
+            # protocol 4, which can also be read by older versions of python in the container
+            write_object(keyword_args_adjusted, os.path.join(job_dir, 'kwargs.pkl'), protocol=4)
+            request_time = time.time()
+            add_phase_time('stage', request_time - stage_time)
+            output = _JobOutput(job_dir, **_output_streaming_kwargs(self._name))
+            # If the response to this request is not read (e.g., because of an
+            # exception), it would be taken for the response to the next job,
+            # so the worker is not used again (see is_alive)
+            self._broken = True
+            try:
+                os.write(self._requests_fd, (json.dumps(dict(job_id=job_id)) + '\n').encode('utf-8'))
+                response = self._wait_for_response(on_poll=output.poll)
+                if response['job_id'] == job_id:
+                    self._broken = False
+            finally:
+                output.close()
+            usage = read_usage_file(os.path.join(job_dir, 'usage.json'))
+            if usage is not None:
+                add_phase_time('container_start', usage['start_time'] - request_time)
+                add_phase_time('compute', usage['end_time'] - usage['start_time'])
+                add_phase_time('container_exit', time.time() - usage['end_time'])
+                resources = dict(usage['resources'])
+                if 'max_rss_bytes' in resources:
+                    # the peak of the worker process, which may have been
+                    # reached by an earlier job
+                    resources['worker_max_rss_bytes'] = resources.pop('max_rss_bytes')
+                add_resources(resources)
+            else:
+                add_phase_time('compute', time.time() - request_time)
+
+            if response['job_id'] != job_id:
+                raise Exception('Unexpected response from warm worker for {}'.format(self._name))
+            if not response['success']:
+                raise Exception('Error running {} in warm worker for container {}'.format(self._name, self._container))
+
+            with phase('collect_outputs'):
+                # large return values are not loaded here (see Result.retval)
+                retval = read_or_store_object(os.path.join(job_dir, 'retval.pkl'), max_read_bytes=get_config_value('retval_inline_max_bytes'))
+                for a, b in outputs_to_copy.items():
+                    move_file(a, b)
+            return retval
+        finally:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+    def shutdown(self) -> None:
+        if self._script.isRunning():
+            try:
+                os.write(self._requests_fd, (json.dumps(dict(shutdown=True)) + '\n').encode('utf-8'))
+            except OSError:
+                pass
+            if self._script.wait(timeout=5) is None:
+                self._script.stop()
+        os.close(self._requests_fd)
+        os.close(self._responses_fd)
+        self._temp_dir.__exit__(None, None, None)
+
+    def _wait_for_response(self, *, on_poll: Callable[[], None]) -> dict:
+        while b'\n' not in self._response_buffer:
+            ready, _, _ = select.select([self._responses_fd], [], [], _OUTPUT_POLL_INTERVAL_SEC)
+            on_poll()
+            if ready:
+                self._response_buffer = self._response_buffer + os.read(self._responses_fd, 65536)
+            elif not self._script.isRunning():
+                raise Exception('Warm worker for {} exited unexpectedly (container {})'.format(self._name, self._container))
+        line, self._response_buffer = self._response_buffer.split(b'\n', 1)
+        return json.loads(line.decode('utf-8'))
+
+
+_OUTPUT_POLL_INTERVAL_SEC = 0.2
+
+class _JobOutput():
+    # Delivers the output files of a job as they grow, in the same way as the
+    # output of a container process (see _output_streaming_kwargs)
+    def __init__(self, job_dir: str, *, on_stdout: Callable[[str], None], on_stderr: Callable[[str], None], log_path: Union[str, None]):
+        self._log_file = open(log_path, 'a', encoding='utf-8') if log_path is not None else None
+        # [path, open file or None (until the worker creates it), line buffer]
+        self._streams: List[list] = [
+            [os.path.join(job_dir, fname), None, _LineBuffer(callback=callback, log_file=self._log_file)]
+            for fname, callback in [('stdout.txt', on_stdout), ('stderr.txt', on_stderr)]
+        ]
+
+    def poll(self) -> None:
+        for stream in self._streams:
+            if stream[1] is None:
+                try:
+                    stream[1] = open(stream[0], 'rb')
+                except FileNotFoundError:
+                    continue
+            while True:
+                data = stream[1].read(65536)
+                if not data:
+                    break
+                stream[2].feed(data)
+
+    def close(self) -> None:
+        try:
+            self.poll()
+            for stream in self._streams:
+                stream[2].feed(b'', final=True)
+        finally:
+            for stream in self._streams:
+                if stream[1] is not None:
+                    stream[1].close()
+            if self._log_file is not None:
+                self._log_file.close()
+
+
+_workers: Dict[Tuple, List[ContainerWorker]] = dict()
+_workers_lock = threading.Lock()
+# workers that are being started (counted toward warm_worker_max_count)
+_num_starting = 0
+_reaper_thread: Union[threading.Thread, None] = None
+
+def run_function_in_warm_worker(*, name: str, function, container: str, keyword_args: dict, input_file_keys: list, output_file_keys: list, additional_files: list=[], local_modules: list=[]) -> Any:
+    # includes starting the container if there is no idle worker
+    with phase('container_start'):
+        worker = _acquire_worker(name=name, function=function, container=container, additional_files=additional_files, local_modules=local_modules)
+    if worker is None:
+        # warm_worker_max_count workers are busy
+        return _run_function_in_new_container(
+            name=name, function=function, container=container, keyword_args=keyword_args,
+            input_file_keys=input_file_keys, output_file_keys=output_file_keys,
+            additional_files=additional_files, local_modules=local_modules
+        )
+    try:
+        return worker.run_job(keyword_args=keyword_args, input_file_keys=input_file_keys, output_file_keys=output_file_keys)
+    finally:
+        if worker.is_alive():
+            worker.release()
+        else:
+            with _workers_lock:
+                for ws in _workers.values():
+                    if worker in ws:
+                        ws.remove(worker)
+            worker.shutdown()
+
+def shutdown_warm_workers() -> None:
+    with _workers_lock:
+        workers = [w for ws in _workers.values() for w in ws]
+        _workers.clear()
+    for w in workers:
+        w.shutdown()
+
+def _acquire_worker(*, name: str, function, container: str, additional_files: list, local_modules: list) -> Union[ContainerWorker, None]:
+    # Returns None if there is no idle worker for the key and no room for
+    # another one, even after shutting down the least recently used idle
+    # worker (for another key)
+    global _num_starting
+    bundle_path = get_source_bundle(name=name, function=function, additional_files=additional_files, local_modules=local_modules)
+    key = (get_config_value('container_runtime'), container, bundle_path, name)
+    max_count = get_config_value('warm_worker_max_count')
+    _reap_workers()
+    to_shutdown = []
+    has_room = True
+    with _workers_lock:
+        worker: Union[ContainerWorker, None] = None
+        for w in _workers.get(key, []):
+            if w.try_acquire():
+                worker = w
+                break
+        if worker is None and max_count is not None:
+            num_workers = _num_starting + sum([len(ws) for ws in _workers.values()])
+            if num_workers >= max_count:
+                for w in sorted([w for ws in _workers.values() for w in ws], key=lambda w: w.idle_time(), reverse=True):
+                    if w.try_acquire():
+                        for ws in _workers.values():
+                            if w in ws:
+                                ws.remove(w)
+                        to_shutdown.append(w)
+                        num_workers = num_workers - 1
+                        break
+            has_room = num_workers < max_count
+        if worker is None and has_room:
+            _num_starting = _num_starting + 1
+    for w in to_shutdown:
+        w.shutdown()
+    if worker is None and has_room:
+        try:
+            worker = ContainerWorker(name=name, container=container, bundle_path=bundle_path)
+            worker.try_acquire()
+            with _workers_lock:
+                _workers.setdefault(key, []).append(worker)
+        finally:
+            with _workers_lock:
+                _num_starting = _num_starting - 1
+        _start_reaper()
+    return worker
+
+def _reap_workers() -> None:
+    # Shuts down the workers that died or have been idle for longer than
+    # warm_worker_idle_timeout_sec
+    idle_timeout = get_config_value('warm_worker_idle_timeout_sec')
+    to_shutdown = []
+    with _workers_lock:
+        for ws in _workers.values():
+            for w in list(ws):
+                if (not w.is_alive() or w.idle_time() > idle_timeout) and w.try_acquire():
+                    ws.remove(w)
+                    to_shutdown.append(w)
+    for w in to_shutdown:
+        w.shutdown()
+
+def _start_reaper() -> None:
+    # so that idle workers are shut down even if no other job comes
+    global _reaper_thread
+    with _workers_lock:
+        if _reaper_thread is not None and _reaper_thread.is_alive():
+            return
+        _reaper_thread = threading.Thread(target=_run_reaper, name='hither-warm-worker-reaper', daemon=True)
+        _reaper_thread.start()
+
+def _run_reaper() -> None:
+    while True:
+        time.sleep(min(60.0, max(1.0, get_config_value('warm_worker_idle_timeout_sec') / 4)))
+        try:
+            _reap_workers()
+        except Exception as e:
+            print('Warning: error shutting down idle warm workers: {}'.format(e))
+
+def _is_within_directory(path: str, dirname: str) -> bool:
+    path = os.path.realpath(path)
+    dirname = os.path.realpath(dirname)
+    return os.path.commonpath([path, dirname]) == dirname
+
+atexit.register(shutdown_warm_workers)
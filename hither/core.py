@@ -6,151 +6,359 @@ from functools import wraps
 from typing import Union, List
 import json
 import time
+import contextlib
 
 from .consolecapture import ConsoleCapture
-from .run_function_in_container import run_function_in_container
+from .resultindex import get_result_index
+from .config import get_config_value
+from .linkfile import clone_or_copy_file, unlink_if_shared
+from .filehashcache import get_file_hashes
+from .scheduler import get_scheduler, get_function_resources
+from .serialization import StoredObject, store_object, sign_object_url, is_signed_object_url
+from .kacherystore import get_staging_dir, store_file_by_move, store_file_by_copy
+from .singleflight import SingleFlight
+from .instrumentation import record_execution, current_record, phase, add_phase_time, add_resources, ResourceMeter
 
 def function(name, version):
     def wrap(f):
-        def execute(_force_run=False, _container=None, **kwargs):
-            import kachery as ka
-            hash_object = dict(
-                api_version='0.1.0',
-                name=name,
-                version=version,
-                input_files=dict(),
-                output_files=dict(),
-                parameters=dict()
-            )
-            resolved_kwargs = dict()
-            hither_input_files = getattr(f, '_hither_input_files', [])
-            hither_output_files = getattr(f, '_hither_output_files', [])
-            hither_parameters = getattr(f, '_hither_parameters', [])
-
-            # Let's make sure the input and output files are all coming in as File objects
-            for input_file in hither_input_files:
-                iname = input_file['name']
-                if iname in kwargs:
-                    if type(kwargs[iname]) == str:
-                        kwargs[iname] = File(kwargs[iname])
-            for output_file in hither_output_files:
-                oname = output_file['name']
-                if oname in kwargs:
-                    if type(kwargs[oname]) == str:
-                        kwargs[oname] = File(kwargs[oname])
-
-            input_file_keys = []
-            for input_file in hither_input_files:
-                iname = input_file['name']
-                if iname not in kwargs or kwargs[iname] is None:
-                    if input_file['required']:
-                        raise Exception('Missing required input file: {}'.format(iname))
-                else:
-                    x = kwargs[iname]
-                    # a hither File object
-                    if x._path is None:
-                        raise Exception('Input file has no path: {}'.format(iname))
-                    # we really want the path
-                    x2 = x._path
-                    if _is_hash_url(x2):
-                        # a hash url
-                        y = ka.load_file(x2)
-                        if y is None:
-                            raise Exception('Unable to load input file {}: {}'.format(iname, x))
-                        x2 = y
-                    info0 = ka.get_file_info(x2)
-                    if info0 is None:
-                        raise Exception('Unable to get info for input file {}: {}'.format(iname, x2))
-                    tmp0 = dict()
-                    for field0 in ['sha1', 'md5']:
-                        if field0 in info0:
-                            tmp0[field0] = info0[field0]
-                    hash_object['input_files'][iname] = tmp0
-                    input_file_keys.append(iname)
-                    resolved_kwargs[iname] = x2
-            
-            output_file_keys = []
-            for output_file in hither_output_files:
-                oname = output_file['name']
-                if oname not in kwargs or kwargs[oname] is None:
-                    if output_file['required']:
-                        raise Exception('Missing required output file: {}'.format(oname))
+        def execute(_force_run=False, _container=None, _priority=0, **kwargs):
+            from .pipeline import current_pipeline, _resolve_placeholders
+            pipeline = current_pipeline()
+            if pipeline is not None:
+                # a placeholder for the result, computed when the pipeline runs
+                return pipeline.add(f, kwargs, force_run=_force_run, container=_container, priority=_priority)
+            kwargs = _resolve_placeholders(kwargs)
+            with record_execution(name) as record:
+                with phase('hash_inputs'):
+                    job = _prepare_job(f=f, name=name, version=version, kwargs=kwargs)
+                if not _force_run:
+                    with phase('cache_lookup'):
+                        result_serialized = _load_result(hash_object=job.hash_object)
+                    with phase('load_cached'):
+                        record.result = _load_cached_result(job=job, result_serialized=result_serialized)
+                    if record.result is None:
+                        record.result = _run_job_once(job=job, container=_container, priority=_priority)
                 else:
-                    x = kwargs[oname]
-                    x2 = x._path
-                    if _is_hash_url(x2):
-                        raise Exception('Output file {} cannot be a hash URI: {}'.format(oname, x2))
-                    resolved_kwargs[oname] = x2
-                    if oname in resolved_kwargs:
-                        hash_object['output_files'][oname] = True
-                        output_file_keys.append(oname)
-
-            for parameter in hither_parameters:
-                pname = parameter['name']
-                if pname not in kwargs or kwargs[pname] is None:
-                    if parameter['required']:
-                        raise Exception('Missing required parameter: {}'.format(pname))
-                    if 'default' in parameter:
-                        resolved_kwargs[pname] = parameter['default']
-                else:
-                    resolved_kwargs[pname] = kwargs[pname]
-                hash_object['parameters'][pname] = resolved_kwargs[pname]
-
-            for k, v in kwargs.items():
-                if k not in resolved_kwargs:
-                    hash_object['parameters'][k] = v
-                    resolved_kwargs[k] = v
-
-            if not _force_run:
-                result_serialized: Union[dict, None] = _load_result(hash_object=hash_object)
-                if result_serialized is not None:
-                    result0 = _deserialize_result(result_serialized)
-                    if result0 is not None:
-                        for output_file in hither_output_files:
-                            oname = output_file['name']
-                            if oname in resolved_kwargs:
-                                shutil.copyfile(getattr(result0.outputs, oname)._path, resolved_kwargs[oname])
-                        _handle_temporary_outputs([getattr(result0.outputs, oname) for oname in output_file_keys])
-                        if result0.runtime_info['stdout']:
-                            sys.stdout.write(result0.runtime_info['stdout'])
-                        if result0.runtime_info['stderr']:
-                            sys.stderr.write(result0.runtime_info['stderr'])
-                        print('===== Hither: using cached result for {}'.format(name))
-                        return result0
-
-            with ConsoleCapture() as cc:
-                if _container is None:
-                    returnval = f(**resolved_kwargs)
-                else:
-                    if hasattr(f, '_hither_containers'):
-                        if _container in getattr(f, '_hither_containers'):
-                            _container = getattr(f, '_hither_containers')[_container]
-                    returnval = run_function_in_container(name=name, function=f, input_file_keys=input_file_keys, output_file_keys=output_file_keys, container=_container, keyword_args=resolved_kwargs)
-
-            result = Result()
-            result.outputs = Outputs()
-            for oname in hash_object['output_files'].keys():
-                setattr(result.outputs, oname, kwargs[k])
-                result._output_names.append(oname)
-            result.runtime_info = cc.runtime_info()
-            result.hash_object = hash_object
-            result.retval = returnval
-            _handle_temporary_outputs([getattr(result.outputs, oname) for oname in output_file_keys])
-            _store_result(serialized_result=_serialize_result(result))
-            return result
+                    record.result = _run_job(job=job, container=_container, priority=_priority)
+                return record.result
+        def submit(_force_run=False, _container=None, _priority=0, **kwargs):
+            from .batch import submit_job
+            return submit_job(f, kwargs, force_run=_force_run, container=_container, priority=_priority)
+        def map(kwargs_list, *, max_workers=None, use_processes=False, _force_run=False, _container=None, _priority=0):
+            from .pipeline import current_pipeline
+            pipeline = current_pipeline()
+            if pipeline is not None:
+                return [pipeline.add(f, kwargs, force_run=_force_run, container=_container, priority=_priority) for kwargs in kwargs_list]
+            from .batch import execute_many
+            return execute_many(
+                [(f, kwargs) for kwargs in kwargs_list],
+                max_workers=max_workers,
+                use_processes=use_processes,
+                force_run=_force_run,
+                container=_container,
+                priority=_priority
+            )
+        async def execute_async(_force_run=False, _container=None, _priority=0, **kwargs):
+            from .asyncexecution import execute_async
+            return await execute_async(f, kwargs, force_run=_force_run, container=_container, priority=_priority)
         setattr(f, 'execute', execute)
+        setattr(f, 'execute_async', execute_async)
+        setattr(f, 'submit', submit)
+        setattr(f, 'map', map)
+        setattr(f, '_hither_name', name)
+        setattr(f, '_hither_version', version)
         return f
     return wrap
 
-def _handle_temporary_outputs(outputs):
+class _Job():
+    def __init__(self, *, f, name, hash_object, kwargs, resolved_kwargs, input_file_keys, output_file_keys):
+        self.f = f
+        self.name = name
+        self.hash_object = hash_object
+        self.kwargs = kwargs
+        self.resolved_kwargs = resolved_kwargs
+        self.input_file_keys = input_file_keys
+        self.output_file_keys = output_file_keys
+
+def _prepare_job(*, f, name, version, kwargs) -> _Job:
+    import kachery as ka
+    kwargs = dict(kwargs)
+    hash_object = dict(
+        api_version='0.1.0',
+        name=name,
+        version=version,
+        input_files=dict(),
+        output_files=dict(),
+        parameters=dict()
+    )
+    resolved_kwargs = dict()
+    hither_input_files = getattr(f, '_hither_input_files', [])
+    hither_output_files = getattr(f, '_hither_output_files', [])
+    hither_parameters = getattr(f, '_hither_parameters', [])
+
+    # Let's make sure the input and output files are all coming in as File objects
+    for input_file in hither_input_files:
+        iname = input_file['name']
+        if iname in kwargs:
+            if type(kwargs[iname]) == str:
+                kwargs[iname] = File(kwargs[iname])
+    for output_file in hither_output_files:
+        oname = output_file['name']
+        if oname in kwargs:
+            if type(kwargs[oname]) == str:
+                kwargs[oname] = File(kwargs[oname])
+
+    input_file_keys = []
+    local_input_files = []
+    for input_file in hither_input_files:
+        iname = input_file['name']
+        if iname not in kwargs or kwargs[iname] is None:
+            if input_file['required']:
+                raise Exception('Missing required input file: {}'.format(iname))
+        else:
+            x = kwargs[iname]
+            # a hither File object
+            if x._path is None:
+                raise Exception('Input file has no path: {}'.format(iname))
+            # we really want the path
+            x2 = x._path
+            # Input files are identified by their sha1 hash only, however they
+            # are passed, so that the same content gives the same job hash
+            tmp0 = _hash_info_from_url(x2) if _is_hash_url(x2) else None
+            if tmp0 is not None:
+                # a sha1 url is passed through and only loaded if the job actually runs
+                hash_object['input_files'][iname] = tmp0
+            else:
+                if _is_hash_url(x2):
+                    y = ka.load_file(x2)
+                    if y is None:
+                        raise Exception('Unable to load input file {}: {}'.format(iname, x))
+                    x2 = y
+                if os.path.isdir(x2):
+                    raise Exception('Input file {} is a directory, which is not supported: {}'.format(iname, x2))
+                if not os.path.isfile(x2):
+                    raise Exception('Unable to get info for input file {}: {}'.format(iname, x2))
+                local_input_files.append((iname, x2))
+            input_file_keys.append(iname)
+            resolved_kwargs[iname] = x2
+    # hashes of unchanged local files are remembered between calls
+    local_hashes = get_file_hashes([x2 for _, x2 in local_input_files], algorithm='sha1')
+    for (iname, _), hash0 in zip(local_input_files, local_hashes):
+        hash_object['input_files'][iname] = dict(sha1=hash0)
+    hash_object['input_files'] = {iname: hash_object['input_files'][iname] for iname in input_file_keys}
+
+    output_file_keys = []
+    for output_file in hither_output_files:
+        oname = output_file['name']
+        if oname not in kwargs or kwargs[oname] is None:
+            if output_file['required']:
+                raise Exception('Missing required output file: {}'.format(oname))
+        else:
+            x = kwargs[oname]
+            x2 = x._path
+            if _is_hash_url(x2):
+                raise Exception('Output file {} cannot be a hash URI: {}'.format(oname, x2))
+            resolved_kwargs[oname] = x2
+            if oname in resolved_kwargs:
+                hash_object['output_files'][oname] = True
+                output_file_keys.append(oname)
+
+    for parameter in hither_parameters:
+        pname = parameter['name']
+        if pname not in kwargs or kwargs[pname] is None:
+            if parameter['required']:
+                raise Exception('Missing required parameter: {}'.format(pname))
+            if 'default' in parameter:
+                resolved_kwargs[pname] = parameter['default']
+        else:
+            resolved_kwargs[pname] = kwargs[pname]
+        hash_object['parameters'][pname] = resolved_kwargs[pname]
+
+    for k, v in kwargs.items():
+        if k not in resolved_kwargs:
+            hash_object['parameters'][k] = v
+            resolved_kwargs[k] = v
+
+    return _Job(
+        f=f,
+        name=name,
+        hash_object=hash_object,
+        kwargs=kwargs,
+        resolved_kwargs=resolved_kwargs,
+        input_file_keys=input_file_keys,
+        output_file_keys=output_file_keys
+    )
+
+def _load_cached_result(*, job: _Job, result_serialized: Union[dict, None]):
+    import kachery as ka
+    if result_serialized is None:
+        return None
+    result0 = _deserialize_result(result_serialized)
+    if result0 is None:
+        return None
+    if get_config_value('show_cached_console'):
+        runtime_info = result0.runtime_info
+        if runtime_info['stdout'] is None or runtime_info['stderr'] is None:
+            return None
+    output_urls = dict()
+    for oname in job.output_file_keys:
+        if not hasattr(result0.outputs, oname):
+            return None
+        output_urls[oname] = getattr(result0.outputs, oname)._path
+    # Only materialize the outputs that the caller asked to have at a
+    # particular path. Temporary outputs simply refer to the stored file.
+    for oname in job.output_file_keys:
+        x = job.kwargs[oname]
+        if not x._is_temporary:
+            path0 = ka.load_file(output_urls[oname])
+            if path0 is None:
+                return None
+            clone_or_copy_file(path0, job.resolved_kwargs[oname])
+    for oname in job.output_file_keys:
+        x = job.kwargs[oname]
+        if x._is_temporary:
+            if os.path.exists(x._path):
+                os.unlink(x._path)
+            x._path = output_urls[oname]
+            x._is_temporary = False
+    if get_config_value('show_cached_console'):
+        if result0.runtime_info['stdout']:
+            sys.stdout.write(result0.runtime_info['stdout'])
+        if result0.runtime_info['stderr']:
+            sys.stderr.write(result0.runtime_info['stderr'])
+    print('===== Hither: using cached result for {}'.format(job.name))
+    result0._from_cache = True
+    return result0
+
+def _run_job(*, job: _Job, container, priority: int=0):
+    f = job.f
+    timer = time.time()
+    with _allocate_resources(job, priority=priority):
+        add_phase_time('scheduler_wait', time.time() - timer)
+        with phase('resolve_inputs'):
+            resolved_kwargs = _prepare_run(job)
+        container = _resolve_container(f, container)
+        with _create_console_capture() as cc:
+            if container is None:
+                with phase('compute'), ResourceMeter(scope='thread') as meter:
+                    returnval = f(**resolved_kwargs)
+                add_resources(meter.usage())
+            else:
+                # imported here, so that in-process runs and cache hits do not pay for it
+                from .run_function_in_container import run_function_in_container
+                returnval = run_function_in_container(name=job.name, function=f, input_file_keys=job.input_file_keys, output_file_keys=job.output_file_keys, container=container, keyword_args=resolved_kwargs)
+    return _finalize_job(job=job, cc=cc, returnval=returnval)
+
+def _run_job_once(*, job: _Job, container, priority: int=0, run_job=_run_job):
+    # Same as run_job (by default _run_job), except that if the same job is
+    # already running elsewhere, wait for it and use its result (see
+    # SingleFlight). The scheduler resources are only allocated by run_job,
+    # so they are not held while waiting.
+    if not get_config_value('use_single_flight'):
+        return run_job(job=job, container=container, priority=priority)
+    import kachery as ka
+    flight = SingleFlight(ka.get_object_hash(job.hash_object))
+    with phase('single_flight_wait'):
+        flight.acquire(is_done=lambda: _load_result(hash_object=job.hash_object) is not None)
+    try:
+        with phase('load_cached'):
+            result0 = _load_cached_result(job=job, result_serialized=_load_result(hash_object=job.hash_object))
+        if result0 is not None:
+            return result0
+        return run_job(job=job, container=container, priority=priority)
+    finally:
+        flight.release()
+
+def _allocate_resources(job: _Job, *, priority: int=0):
+    scheduler = get_scheduler()
+    if scheduler is None:
+        return contextlib.nullcontext()
+    return scheduler.allocate(get_function_resources(job.f), priority=priority)
+
+def _prepare_run(job: _Job) -> dict:
+    resolved_kwargs = _resolve_input_files(job)
+    for oname in job.output_file_keys:
+        unlink_if_shared(resolved_kwargs[oname])
+    return resolved_kwargs
+
+def _resolve_container(f, container):
+    if container is not None and hasattr(f, '_hither_containers'):
+        if container in getattr(f, '_hither_containers'):
+            container = getattr(f, '_hither_containers')[container]
+    return container
+
+def _create_console_capture(redirect: bool=True) -> ConsoleCapture:
+    return ConsoleCapture(
+        spool_threshold=get_config_value('console_spool_threshold'),
+        max_head=get_config_value('console_max_head'),
+        max_tail=get_config_value('console_max_tail'),
+        passthrough_max_rate=get_config_value('console_passthrough_max_rate'),
+        redirect=redirect,
+        # so that a spooled output can be moved into the kachery storage
+        spool_dir=get_staging_dir()
+    )
+
+def _finalize_job(*, job: _Job, cc: ConsoleCapture, returnval):
+    result = Result()
+    result.outputs = Outputs()
+    for oname in job.output_file_keys:
+        setattr(result.outputs, oname, job.kwargs[oname])
+        result._output_names.append(oname)
+    with phase('store_outputs'):
+        try:
+            runtime_info_serialized = cc.runtime_info(include_output=False)
+            runtime_info_serialized['stdout'] = _store_console_output(cc.stream('stdout'))
+            runtime_info_serialized['stderr'] = _store_console_output(cc.stream('stderr'))
+        finally:
+            cc.cleanup()
+        result._runtime_info_serialized = runtime_info_serialized
+        result.hash_object = job.hash_object
+        result.retval = returnval
+        result._output_urls = _handle_temporary_outputs({oname: getattr(result.outputs, oname) for oname in job.output_file_keys})
+        serialized_result = _serialize_result(result)
+    result._output_urls = dict(serialized_result['output_files'])
+    record = current_record()
+    if record is not None:
+        # the time spent storing the result itself is only seen by the hooks
+        serialized_result['runtime_info']['phases'] = dict(record.phases)
+        serialized_result['runtime_info']['resources'] = dict(record.resources)
+        result._runtime_info_serialized = serialized_result['runtime_info']
+    with phase('store_result'):
+        _store_result(serialized_result=serialized_result)
+    return result
+
+def _store_console_output(stream) -> str:
     import kachery as ka
-    for output in outputs:
+    # If the output was spooled to disk, that file is moved into the storage
+    # under the hash computed while it was written (not read again)
+    path = stream.path()
+    if path is not None:
+        return store_file_by_move(path, sha1=stream.info()['sha1'])
+    return ka.store_text(stream.text())
+
+def _resolve_input_files(job: _Job) -> dict:
+    import kachery as ka
+    resolved_kwargs = dict(job.resolved_kwargs)
+    for iname in job.input_file_keys:
+        x = resolved_kwargs[iname]
+        if _is_hash_url(x):
+            y = ka.load_file(x)
+            if y is None:
+                raise Exception('Unable to load input file {}: {}'.format(iname, x))
+            resolved_kwargs[iname] = y
+    return resolved_kwargs
+
+def _handle_temporary_outputs(outputs: dict) -> dict:
+    # Temporary outputs are moved into the kachery storage (not copied).
+    # Returns their hash urls.
+    import kachery as ka
+    urls = dict()
+    for oname, output in outputs.items():
         if output._is_temporary:
-            old_path = output._path
-            new_path = ka.load_file(ka.store_file(old_path))
-            output._path = new_path
+            urls[oname] = store_file_by_move(output._path)
+            output._path = ka.load_file(urls[oname])
             output._is_temporary = False
-            os.unlink(old_path)
+    return urls
 
 def input_file(name: str, required=True):
     def wrap(f):
@@ -198,25 +406,110 @@ def parameter(name: str, required=True, default=None):
 
 def _load_result(*, hash_object):
     import kachery as ka
-    import loggery
     name0 = 'hither_result'
     hash0 = ka.get_object_hash(hash_object)
-    doc = loggery.find_one({'message.name': name0, 'message.hash': hash0})
+    index = get_result_index()
+    if index is not None:
+        doc0 = index.get(hash0)
+        if doc0 is not None:
+            return doc0
+    loggery = _import_loggery()
+    doc = loggery.find_one({'message.name': name0, 'message.hash': hash0}, {'message': 1})
     if doc is None:
         return None
+    if not _has_trusted_retval(doc['message']):
+        # the job is run again, which stores a newer result
+        return None
+    if index is not None:
+        index.put(hash0, doc['message'])
     return doc['message']
 
+def _load_results(*, hash_objects: List[dict]) -> List[Union[dict, None]]:
+    # Same as _load_result for each hash object, but with a single query for
+    # all of the results that are not in the local result index
+    import kachery as ka
+    hashes = [ka.get_object_hash(hash_object) for hash_object in hash_objects]
+    index = get_result_index()
+    found = dict()
+    if index is not None:
+        for hash0 in hashes:
+            doc0 = index.get(hash0)
+            if doc0 is not None:
+                found[hash0] = doc0
+    missing = sorted(set([h for h in hashes if h not in found]))
+    if len(missing) > 0:
+        loggery = _import_loggery()
+        # most recent first, so the first document for each hash wins
+        for doc in loggery.find({'message.name': 'hither_result', 'message.hash': {'$in': missing}}, {'message': 1}, sort=[('time', -1)], batch_size=1000):
+            hash0 = doc['message']['hash']
+            if hash0 not in found and _has_trusted_retval(doc['message']):
+                found[hash0] = doc['message']
+                if index is not None:
+                    index.put(hash0, doc['message'])
+    return [found.get(hash0, None) for hash0 in hashes]
+
 def _store_result(*, serialized_result):
-    import loggery
-    loggery.insert_one(message=serialized_result)
+    index = get_result_index()
+    if index is not None:
+        index.put(serialized_result['hash'], serialized_result)
+    loggery = _import_loggery()
+    loggery.insert_one(message=serialized_result, buffered=True)
+
+def _has_trusted_retval(result_serialized: dict) -> bool:
+    # Pickled retvals are only loaded if they were stored with the key of
+    # this hither directory (see _store_retval)
+    url = result_serialized.get('retval_url', None)
+    if url is None or result_serialized.get('retval_format', None) == 'json':
+        return True
+    if is_signed_object_url(url, result_serialized.get('retval_signature', None)):
+        return True
+    print('Warning: ignoring cached result {} with a retval that was not pickled by this host'.format(result_serialized.get('hash', None)))
+    return False
 
 class Result():
     def __init__(self):
         self.hash_object = None
-        self.runtime_info = None
         self.retval = None
+        # a large (or non-JSON) retval stored in kachery, loaded on first access
+        self._retval_stored: Union[StoredObject, None] = None
         self.outputs = Outputs()
+        self._runtime_info = None
         self._output_names = []
+        # hash urls of the output files (e.g., for passing them on without copying)
+        self._output_urls = dict()
+        # the serialized runtime info (with hash urls for stdout/stderr),
+        # loaded on first access
+        self._runtime_info_serialized = None
+        self._from_cache = False
+
+    @property
+    def runtime_info(self):
+        if self._runtime_info is None and self._runtime_info_serialized is not None:
+            self._runtime_info = _load_runtime_info(self._runtime_info_serialized)
+        return self._runtime_info
+
+    @runtime_info.setter
+    def runtime_info(self, value):
+        self._runtime_info = value
+        self._runtime_info_serialized = None
+
+    @property
+    def retval(self):
+        if self._retval_stored is not None and not self._retval_loaded:
+            self._retval = self._retval_stored.load()
+            self._retval_loaded = True
+        return self._retval
+
+    @retval.setter
+    def retval(self, value):
+        if isinstance(value, StoredObject):
+            self._retval_stored = value
+            self._retval = None
+            self._retval_loaded = False
+        else:
+            self._retval_stored = None
+            self._retval = value
+            self._retval_loaded = True
 
 def _serialize_result(result):
     import kachery as ka
@@ -225,43 +518,88 @@ def _serialize_result(result):
     )
     ret['name'] = 'hither_result'
 
-    ret['runtime_info'] = result.runtime_info
-    ret['runtime_info']['stdout'] = ka.store_text(ret['runtime_info']['stdout'])
-    ret['runtime_info']['stderr'] = ka.store_text(ret['runtime_info']['stderr'])
+    if result._runtime_info_serialized is not None:
+        # console output already stored
+        ret['runtime_info'] = dict(result._runtime_info_serialized)
+    else:
+        ret['runtime_info'] = dict(result.runtime_info)
+        ret['runtime_info']['stdout'] = ka.store_text(ret['runtime_info']['stdout'])
+        ret['runtime_info']['stderr'] = ka.store_text(ret['runtime_info']['stderr'])
 
     for oname in result._output_names:
         path = getattr(result.outputs, oname)._path
-        ret['output_files'][oname] = ka.store_file(path)
+        if _is_hash_url(path):
+            ret['output_files'][oname] = path
+        elif oname in result._output_urls:
+            ret['output_files'][oname] = result._output_urls[oname]
+        else:
+            # kept by the user, so not moved (see _handle_temporary_outputs)
+            ret['output_files'][oname] = store_file_by_copy(path)
 
-    ret['retval'] = result.retval
+    retval_stored = _store_retval(result)
+    if retval_stored is not None:
+        # kept out of the document (see Result.retval)
+        ret['retval'] = None
+        ret.update(retval_stored)
+    else:
+        ret['retval'] = result.retval
     ret['hash_object'] = result.hash_object
     ret['hash'] = ka.get_object_hash(result.hash_object)
     return ret
 
+def _store_retval(result) -> Union[dict, None]:
+    # Returns the fields of the result document for a retval that is too
+    # large to be inlined (or not JSON), or None. JSON retvals are stored as
+    # JSON text, which any host can load. Others are pickled and signed, since
+    # unpickling runs arbitrary code (see sign_object_url).
+    stored = result._retval_stored
+    if stored is not None and stored.format == 'json':
+        return dict(retval_url=stored.url, retval_format='json')
+    # a pickled retval here was written by a container run on this host
+    retval = result.retval
+    try:
+        txt: Union[str, None] = json.dumps(retval)
+    except (TypeError, ValueError):
+        txt = None
+    if txt is not None:
+        if len(txt) <= get_config_value('retval_inline_max_bytes'):
+            result.retval = retval
+            return None
+        import kachery as ka
+        stored = StoredObject(ka.store_text(txt), format='json')
+        result._retval_stored = stored
+        return dict(retval_url=stored.url, retval_format='json')
+    if stored is None:
+        stored = StoredObject(store_object(retval), format='pickle')
+        result._retval_stored = stored
+    return dict(retval_url=stored.url, retval_format='pickle', retval_signature=sign_object_url(stored.url))
+
 def _deserialize_result(obj):
-    import kachery as ka
+    # Nothing is loaded here. The outputs refer to the stored files by hash
+    # url and the console output is loaded on first access of runtime_info.
     result = Result()
-    
-    result.runtime_info = obj['runtime_info']
-    result.runtime_info['stdout'] = ka.load_text(result.runtime_info['stdout'])
-    result.runtime_info['stderr'] = ka.load_text(result.runtime_info['stderr'])
-    if result.runtime_info['stdout'] is None:
-        return None
-    if result.runtime_info['stderr'] is None:
-        return None
-    
+    result._runtime_info_serialized = obj['runtime_info']
+
     output_files = obj['output_files']
     for oname, path in output_files.items():
-        path2 = ka.load_file(path)
-        if path2 is None:
-            return None
-        setattr(result.outputs, oname, File(path2))
+        setattr(result.outputs, oname, File(path))
         result._output_names.append(oname)
-    
-    result.retval = obj['retval']
+    result._output_urls = dict(output_files)
+
+    if obj.get('retval_url', None) is not None:
+        result.retval = StoredObject(obj['retval_url'], format=obj.get('retval_format', 'pickle'))
+    else:
+        result.retval = obj['retval']
     result.hash_object = obj['hash_object']
     return result
 
+def _load_runtime_info(runtime_info_serialized: dict) -> dict:
+    import kachery as ka
+    ret = dict(runtime_info_serialized)
+    ret['stdout'] = ka.load_text(runtime_info_serialized['stdout'])
+    ret['stderr'] = ka.load_text(runtime_info_serialized['stderr'])
+    return ret
+
 
 class Outputs():
     def __init__(self):
@@ -276,12 +614,27 @@ class File():
         else:
             self._is_temporary = False
         self._path = path
+    def resolve(self) -> str:
+        """Return a local path for this file, loading it from kachery if it is a hash url"""
+        if self._path is not None and _is_hash_url(self._path):
+            import kachery as ka
+            path0 = ka.load_file(self._path)
+            if path0 is None:
+                raise Exception('Unable to load file: {}'.format(self._path))
+            return path0
+        return self._path
     def __str__(self):
         if self._path is not None:
             return 'hither.File({})'.format(self._path)
         else:
             return 'hither.File()'
 
+def _import_loggery():
+    # the index used by the result lookups is declared on first use
+    import loggery
+    loggery.declare_index([('message.name', 1), ('message.hash', 1), ('time', -1)])
+    return loggery
+
 def _is_hash_url(path):
     algs = ['sha1', 'md5']
     for alg in algs:
@@ -289,7 +642,17 @@ def _is_hash_url(path):
             return True
     return False
 
+def _hash_info_from_url(url):
+    # e.g., sha1://<hash>/file.txt -> dict(sha1=<hash>), or None for other
+    # urls (e.g., md5://), whose files are hashed after loading them
+    if url.startswith('sha1://'):
+        hash0 = url[len('sha1://'):].split('/')[0]
+        if hash0:
+            return dict(sha1=hash0)
+    return None
+
 def _make_temporary_file(prefix):
-    with tempfile.NamedTemporaryFile(prefix=prefix, delete=False) as tmpfile:
+    # in the staging directory, so that it can be moved into the kachery storage
+    with tempfile.NamedTemporaryFile(prefix=prefix, delete=False, dir=get_staging_dir()) as tmpfile:
         temp_file_name = tmpfile.name
     return temp_file_name
\ No newline at end of file
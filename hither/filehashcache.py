@@ -0,0 +1,134 @@
+import hashlib
+import os
+import threading
+from typing import List, Tuple, Union
+
+from .sqlitedb import SQLiteDB
+from .config import get_config_value, get_hither_dir
+
+_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS file_hashes (
+        path TEXT NOT NULL,
+        algorithm TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        inode INTEGER NOT NULL,
+        hash TEXT NOT NULL,
+        PRIMARY KEY (path, algorithm)
+    )
+    '''
+]
+
+_CHUNK_SIZE = 4 * 1024 * 1024
+_EVICT_EVERY_NUM_PUTS = 100
+
+
+class FileHashCache():
+    def __init__(self, path: str):
+        """A persistent cache of file hashes keyed by (path, size, mtime, inode)
+
+        An entry is only used if the stat metadata of the file still matches,
+        so a modified (or replaced) file is rehashed. The sqlite database may
+        be shared between processes. Beyond file_hash_cache_max_entries, the
+        entries that were hashed least recently are evicted.
+        """
+        self._db = SQLiteDB(path, schema=_SCHEMA)
+        # in-memory layer in front of the database
+        self._memory: dict = dict()
+        self._memory_lock = threading.Lock()
+        self._num_puts = 0
+
+    def get_file_hash(self, path: str, algorithm: str='sha1') -> str:
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        key = (path, algorithm)
+        stat_key = (st.st_size, st.st_mtime_ns, st.st_ino)
+        with self._memory_lock:
+            x = self._memory.get(key, None)
+        if x is not None and x[0] == stat_key:
+            return x[1]
+        conn = self._db.connection()
+        row = conn.execute(
+            'SELECT size, mtime_ns, inode, hash FROM file_hashes WHERE path = ? AND algorithm = ?',
+            (path, algorithm)
+        ).fetchone()
+        if row is not None and tuple(row[:3]) == stat_key:
+            hash0 = row[3]
+        else:
+            hash0 = compute_file_hash(path, algorithm=algorithm)
+            # if the file changed while we were hashing, don't remember the result
+            st2 = os.stat(path)
+            if (st2.st_size, st2.st_mtime_ns, st2.st_ino) != stat_key:
+                return hash0
+            conn.execute(
+                'INSERT OR REPLACE INTO file_hashes (path, algorithm, size, mtime_ns, inode, hash) VALUES (?, ?, ?, ?, ?, ?)',
+                (path, algorithm) + stat_key + (hash0,)
+            )
+            with self._memory_lock:
+                self._num_puts = self._num_puts + 1
+                evict_now = (self._num_puts % _EVICT_EVERY_NUM_PUTS == 0)
+            if evict_now:
+                self.evict()
+        with self._memory_lock:
+            self._memory[key] = (stat_key, hash0)
+        return hash0
+
+    def evict(self, *, max_entries: Union[int, None]=None) -> int:
+        """Remove the entries beyond max_entries that were hashed least
+        recently. Returns the number of entries removed."""
+        if max_entries is None:
+            max_entries = get_config_value('file_hash_cache_max_entries')
+        if max_entries is None:
+            return 0
+        # INSERT OR REPLACE assigns a new rowid, so rowids follow the order
+        # in which the files were hashed
+        cur = self._db.connection().execute('''
+            DELETE FROM file_hashes WHERE rowid <= (
+                SELECT rowid FROM file_hashes ORDER BY rowid DESC LIMIT 1 OFFSET ?
+            )
+        ''', (max_entries,))
+        with self._memory_lock:
+            self._memory.clear()
+        return cur.rowcount
+
+
+def compute_file_hash(path: str, algorithm: str='sha1', chunk_size: int=_CHUNK_SIZE) -> str:
+    # hashlib releases the GIL for large updates, so files can be hashed in parallel threads
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+_global_file_hash_cache: Union[FileHashCache, None] = None
+_global_file_hash_cache_lock = threading.Lock()
+
+def _get_file_hash_cache() -> FileHashCache:
+    global _global_file_hash_cache
+    path = os.path.join(get_hither_dir(), 'file_hashes.db')
+    with _global_file_hash_cache_lock:
+        if _global_file_hash_cache is None or _global_file_hash_cache._db.path() != path:
+            _global_file_hash_cache = FileHashCache(path)
+        return _global_file_hash_cache
+
+def get_file_hash(path: str, algorithm: str='sha1') -> str:
+    """Return the hash of a local file, reusing a previous result if the file is unchanged"""
+    return _get_file_hash_cache().get_file_hash(path, algorithm=algorithm)
+
+def evict_file_hashes(*, max_entries: Union[int, None]=None) -> int:
+    return _get_file_hash_cache().evict(max_entries=max_entries)
+
+def get_file_hashes(paths: List[str], algorithm: str='sha1', max_workers: Union[int, None]=None) -> List[str]:
+    """Hash several local files, in parallel threads when there is more than one"""
+    if max_workers is None:
+        max_workers = get_config_value('file_hash_max_workers')
+    if len(paths) <= 1 or max_workers <= 1:
+        return [get_file_hash(path, algorithm=algorithm) for path in paths]
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(paths))) as executor:
+        return list(executor.map(lambda path: get_file_hash(path, algorithm=algorithm), paths))
@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import threading
+import contextlib
+import contextvars
+from typing import Any, Callable, Dict, List, Union
+
+# Phases of an execution (seconds spent in each are recorded):
+#   hash_inputs, cache_lookup, load_cached, single_flight_wait,
+#   scheduler_wait, resolve_inputs, stage (source bundle and kwargs for a
+#   container run), container_start (until the function starts in the
+#   container), compute, container_exit, collect_outputs (return value and
+#   output files of a container run), store_outputs (into kachery) and
+#   store_result (into loggery)
+
+class ExecutionRecord():
+    def __init__(self, name: str):
+        """The timing breakdown and resource usage of one execution of a hither function"""
+        self.name = name
+        self.start_time = time.time()
+        self.phases: Dict[str, float] = dict()
+        self.resources: Dict[str, Any] = dict()
+        # the hither Result, once there is one
+        self.result: Any = None
+        self._lock = threading.Lock()
+
+    def add_phase_time(self, phase: str, elapsed: float) -> None:
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0) + elapsed
+
+    def add_resources(self, resources: dict) -> None:
+        with self._lock:
+            self.resources.update(resources)
+
+
+_current_record: contextvars.ContextVar = contextvars.ContextVar('hither_execution_record', default=None)
+
+def current_record() -> Union[ExecutionRecord, None]:
+    return _current_record.get()
+
+@contextlib.contextmanager
+def activate_record(record: Union[ExecutionRecord, None]):
+    """Record the phases in this thread (or asyncio task) into record"""
+    token = _current_record.set(record)
+    try:
+        yield record
+    finally:
+        _current_record.reset(token)
+
+@contextlib.contextmanager
+def phase(name: str):
+    """Add the time spent in the with block to the current record (if any)"""
+    record = _current_record.get()
+    if record is None:
+        yield
+        return
+    timer = time.time()
+    try:
+        yield
+    finally:
+        record.add_phase_time(name, time.time() - timer)
+
+def add_phase_time(name: str, elapsed: float) -> None:
+    record = _current_record.get()
+    if record is not None:
+        record.add_phase_time(name, elapsed)
+
+def add_resources(resources: dict) -> None:
+    record = _current_record.get()
+    if record is not None:
+        record.add_resources(resources)
+
+def with_record(record: Union[ExecutionRecord, None], fn: Callable, *args, **kwargs) -> Any:
+    # for running fn in another thread (e.g., in an executor)
+    with activate_record(record):
+        return fn(*args, **kwargs)
+
+
+class ResourceMeter():
+    def __init__(self, *, scope: str='thread'):
+        """Measure the cpu time, peak memory and I/O of a block of code
+
+        Example
+        -------
+        with ResourceMeter(scope='process') as meter:
+            compute()
+        print(meter.usage())
+
+        Parameters
+        ----------
+        scope : str, optional
+            'thread' (the current thread) or 'process' (the whole process,
+            including the child processes that it has waited for), by default
+            'thread'. The peak memory is always that of the process.
+        """
+        if scope not in ['thread', 'process']:
+            raise Exception('Invalid scope for ResourceMeter: {}'.format(scope))
+        self._scope = scope
+        self._start: Union[dict, None] = None
+        self._end: Union[dict, None] = None
+        self.start_time: Union[float, None] = None
+        self.end_time: Union[float, None] = None
+
+    def __enter__(self) -> 'ResourceMeter':
+        self._start = _resource_snapshot(self._scope)
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback) -> None:
+        self.end_time = time.time()
+        self._end = _resource_snapshot(self._scope)
+
+    def usage(self) -> dict:
+        """cpu_user_sec, cpu_system_sec, max_rss_bytes, read_bytes and
+        write_bytes (the ones that are available on this system)"""
+        assert self._start is not None and self._end is not None
+        ret: Dict[str, Any] = dict()
+        for k, v in self._end.items():
+            if v is None:
+                continue
+            if k == 'max_rss_bytes':
+                ret[k] = v
+            elif self._start.get(k, None) is not None:
+                ret[k] = v - self._start[k]
+        return ret
+
+    def write(self, path: str) -> None:
+        """Write the times and usage to a json file (see read_usage_file)"""
+        with open(path, 'w') as f:
+            json.dump(dict(start_time=self.start_time, end_time=self.end_time, resources=self.usage()), f)
+
+def read_usage_file(path: str) -> Union[dict, None]:
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+_hooks: List[Callable[[dict], None]] = []
+_hooks_lock = threading.Lock()
+
+def add_execution_hook(hook: Callable[[dict], None]) -> None:
+    """Call hook after every execution of a hither function
+
+    The hook receives a dict with name, hash, cached (whether the result
+    came from the cache), error (None on success), start_time, end_time,
+    phases (seconds spent in each phase of this execution) and resources
+    (cpu time, peak memory and I/O of the job, if it ran). Hooks are called
+    in the thread that ran the execution and must not raise.
+    """
+    with _hooks_lock:
+        _hooks.append(hook)
+
+def remove_execution_hook(hook: Callable[[dict], None]) -> None:
+    with _hooks_lock:
+        if hook in _hooks:
+            _hooks.remove(hook)
+
+@contextlib.contextmanager
+def record_execution(name: str):
+    """Record an execution and pass it to the hooks at the end of the block
+
+    Set record.result (the hither Result) within the block.
+    """
+    record = ExecutionRecord(name)
+    error: Union[str, None] = None
+    with activate_record(record):
+        try:
+            yield record
+        except BaseException as e:
+            error = _error_message(e)
+            raise
+        finally:
+            _call_hooks(record, error=error)
+
+def finish_record_with_future(record: ExecutionRecord, future) -> None:
+    """Pass the record to the hooks when the future (of a Result) is done"""
+    def _done(future):
+        e = future.exception()
+        if e is None:
+            record.result = future.result()
+        _call_hooks(record, error=_error_message(e) if e is not None else None)
+    future.add_done_callback(_done)
+
+def _error_message(e: BaseException) -> str:
+    return str(e) or type(e).__name__
+
+def _call_hooks(record: ExecutionRecord, *, error: Union[str, None]) -> None:
+    with _hooks_lock:
+        hooks = list(_hooks)
+    if len(hooks) == 0:
+        return
+    result = record.result
+    phases: Dict[str, float] = dict()
+    resources: Dict[str, Any] = dict()
+    hash0 = None
+    cached = False
+    if result is not None:
+        import kachery as ka
+        hash0 = ka.get_object_hash(result.hash_object)
+        cached = result._from_cache
+        if not cached and result._runtime_info_serialized is not None:
+            # e.g., recorded in another process
+            phases.update(result._runtime_info_serialized.get('phases', dict()))
+            resources.update(result._runtime_info_serialized.get('resources', dict()))
+    phases.update(record.phases)
+    resources.update(record.resources)
+    info = dict(
+        name=record.name,
+        hash=hash0,
+        cached=cached,
+        error=error,
+        start_time=record.start_time,
+        end_time=time.time(),
+        phases=phases,
+        resources=resources
+    )
+    for hook in hooks:
+        try:
+            hook(info)
+        except Exception as e:
+            print('Warning: error in hither execution hook: {}'.format(e))
+
+
+def _resource_snapshot(scope: str) -> dict:
+    try:
+        import resource
+    except ImportError:
+        # not available on this platform
+        return dict()
+    if scope == 'thread':
+        if not hasattr(resource, 'RUSAGE_THREAD'):
+            return dict()
+        usages = [resource.getrusage(resource.RUSAGE_THREAD)]
+    else:
+        usages = [resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)]
+    return dict(
+        cpu_user_sec=sum([u.ru_utime for u in usages]),
+        cpu_system_sec=sum([u.ru_stime for u in usages]),
+        # kilobytes on linux
+        max_rss_bytes=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        # blocks of 512 bytes read from and written to storage
+        read_bytes=sum([u.ru_inblock for u in usages]) * 512,
+        write_bytes=sum([u.ru_oublock for u in usages]) * 512
+    )
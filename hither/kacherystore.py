@@ -0,0 +1,119 @@
+import os
+import uuid
+import tempfile
+import threading
+from typing import Union
+
+from .config import get_config_value
+from .linkfile import clone_or_copy_file, move_file
+from .filehashcache import get_file_hash, compute_file_hash
+
+def get_staging_dir() -> Union[str, None]:
+    """Return the directory for the working files of container runs (None for the default temporary directory)
+
+    Unless the staging_dir config value is set, this is a directory in the
+    kachery storage if that is on a different device than the temporary
+    directory, so that output files can be renamed (rather than copied) into
+    the kachery storage.
+    """
+    staging_dir = get_config_value('staging_dir')
+    if staging_dir is None:
+        storage_dir = _get_kachery_storage_dir()
+        if storage_dir is None or _same_device(storage_dir, tempfile.gettempdir()):
+            return None
+        staging_dir = os.path.join(storage_dir, 'tmp_hither')
+    os.makedirs(staging_dir, exist_ok=True)
+    return staging_dir
+
+def store_file_by_move(path: str, *, sha1: Union[str, None]=None) -> str:
+    """Store a file in kachery by moving it into the storage (the file at path is removed)
+
+    Falls back to kachery's store_file (a copy) if the storage layout is not
+    the expected one. Returns the hash url.
+
+    Parameters
+    ----------
+    path : str
+        The file to store
+    sha1 : str or None, optional
+        The sha1 hash of the file, if it is already known (e.g., computed
+        while the file was written), so that the file is not read again
+    """
+    import kachery as ka
+    # not through the persistent hash cache, since the file at path is about
+    # to be removed
+    dest, url = _storage_path_and_url(path, sha1=sha1, cache_hash=False)
+    if dest is None:
+        url = ka.store_file(path)
+        os.unlink(path)
+        return url
+    if os.path.exists(dest):
+        os.unlink(path)
+    else:
+        # renamed into place so that the storage never has a partial file
+        tmp_dest = '{}.tmp.{}'.format(dest, uuid.uuid4().hex[:8])
+        move_file(path, tmp_dest)
+        os.replace(tmp_dest, dest)
+    return url
+
+def store_file_by_copy(path: str) -> str:
+    """Store a file in kachery, keeping the file at path (e.g., an output that the user keeps)
+
+    The data is shared only by a reflink (copy-on-write), so later changes to
+    the file do not affect the stored one. Returns the hash url.
+    """
+    import kachery as ka
+    dest, url = _storage_path_and_url(path)
+    if dest is None:
+        return ka.store_file(path)
+    if not os.path.exists(dest):
+        tmp_dest = '{}.tmp.{}'.format(dest, uuid.uuid4().hex[:8])
+        clone_or_copy_file(path, tmp_dest)
+        os.replace(tmp_dest, dest)
+    return url
+
+def _storage_path_and_url(path: str, *, sha1: Union[str, None]=None, cache_hash: bool=True):
+    storage_dir = _get_kachery_storage_dir()
+    if storage_dir is None:
+        return None, None
+    if sha1 is not None:
+        hash0 = sha1
+    elif cache_hash:
+        hash0 = get_file_hash(path, algorithm='sha1')
+    else:
+        hash0 = compute_file_hash(path, algorithm='sha1')
+    dest = _storage_path(storage_dir, hash0)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    return dest, 'sha1://{}/{}'.format(hash0, os.path.basename(path))
+
+def _storage_path(storage_dir: str, hash0: str) -> str:
+    return os.path.join(storage_dir, 'sha1', hash0[0:2], hash0[2:4], hash0[4:6], hash0)
+
+_storage_dir_lock = threading.Lock()
+_storage_dirs: dict = dict()
+
+def _get_kachery_storage_dir() -> Union[str, None]:
+    # The storage directory, if kachery stores its files where we expect.
+    # This is verified once (per storage directory) by storing a small file.
+    key = os.environ.get('KACHERY_STORAGE_DIR', None)
+    with _storage_dir_lock:
+        if key in _storage_dirs:
+            return _storage_dirs[key]
+    import kachery as ka
+    url = ka.store_text('hither kachery storage layout probe')
+    path = ka.load_file(url)
+    hash0 = url.split('://')[1].split('/')[0]
+    storage_dir = None
+    if path is not None:
+        suffix = '/' + _storage_path('', hash0)
+        if os.path.realpath(path).endswith(suffix):
+            storage_dir = os.path.realpath(path)[:-len(suffix)].rstrip('/')
+    with _storage_dir_lock:
+        _storage_dirs[key] = storage_dir
+    return storage_dir
+
+def _same_device(path1: str, path2: str) -> bool:
+    try:
+        return os.stat(path1).st_dev == os.stat(path2).st_dev
+    except OSError:
+        return False
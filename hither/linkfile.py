@@ -0,0 +1,67 @@
+import os
+import shutil
+import fcntl
+import errno
+
+# ioctl request code for cloning a file (reflink) on Linux (btrfs, xfs, ...)
+_FICLONE = 0x40049409
+
+def clone_or_copy_file(src: str, dst: str) -> str:
+    """Make dst have the same content as src, avoiding a data copy if possible
+
+    Tries a reflink (copy-on-write clone) and falls back to a regular copy.
+    Hard links are never used, because a later write to dst (e.g., by the
+    user) would modify src as well, which may be a file in the kachery
+    storage. Any existing file at dst is unlinked first. Returns the method
+    that was used.
+    """
+    if os.path.exists(dst):
+        if os.path.samefile(src, dst):
+            return 'same'
+        os.unlink(dst)
+    if _try_reflink(src, dst):
+        return 'reflink'
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+def move_file(src: str, dst: str) -> str:
+    """Move src to dst, by renaming it if both are on the same filesystem
+
+    Otherwise falls back to clone_or_copy_file and removes src. Returns the
+    method that was used ('rename' or see clone_or_copy_file).
+    """
+    try:
+        os.replace(src, dst)
+        return 'rename'
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    method = clone_or_copy_file(src, dst)
+    os.unlink(src)
+    return method
+
+def unlink_if_shared(path: str) -> None:
+    # If path is hard linked elsewhere (e.g., into the kachery storage by an
+    # earlier version of hither) then writing to it in place would modify the
+    # other copies as well
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    if st.st_nlink > 1:
+        os.unlink(path)
+
+def _try_reflink(src: str, dst: str) -> bool:
+    try:
+        with open(src, 'rb') as fsrc:
+            with open(dst, 'wb') as fdst:
+                try:
+                    fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+                    return True
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    if os.path.exists(dst):
+        os.unlink(dst)
+    return False
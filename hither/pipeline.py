@@ -0,0 +1,241 @@
+import os
+import threading
+from typing import Any, Dict, List, Set, Union
+
+_local = threading.local()
+
+def current_pipeline() -> Union['Pipeline', None]:
+    """Return the innermost active pipeline of the current thread (if any)"""
+    pipelines = getattr(_local, 'pipelines', None)
+    if pipelines:
+        return pipelines[-1]
+    return None
+
+
+class Pipeline():
+    def __init__(self, *, max_workers: Union[int, None]=None, force_run: bool=False, container=None, priority: int=0):
+        """Build a graph of hither jobs and run it with maximal parallelism
+
+        Within the with block, f.execute() does not run anything but returns
+        a PendingResult. Its retval (or items of it) and its output files may
+        be passed to other hither functions, which makes those jobs depend on
+        it. The graph runs when the block exits (or on run()).
+
+        Jobs run as soon as the jobs they depend on are done. The cache
+        lookups of all the jobs that become ready at the same time are done
+        with a single batched query, so cached parts of the graph are skipped
+        without running anything. Intermediate files are passed on by hash
+        url and are not copied.
+
+        Example
+        -------
+        with hither.Pipeline() as p:
+            r = append_files.execute(path1=a, path2=b, path_out=hither.File())
+            n = count_chars.execute(fname=r.outputs.path_out)
+        print(n.retval)
+
+        Parameters
+        ----------
+        max_workers : int or None, optional
+            Number of jobs that may run concurrently, by default the cpu count
+            (see also hither.set_config(use_scheduler=...))
+        force_run, container, priority : optional
+            Defaults for the _force_run, _container and _priority of the jobs
+        """
+        self._max_workers = max_workers if max_workers is not None else (os.cpu_count() or 1)
+        self._force_run = force_run
+        self._container = container
+        self._priority = priority
+        self._nodes: List['PendingResult'] = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        if not hasattr(_local, 'pipelines'):
+            _local.pipelines = []
+        _local.pipelines.append(self)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        _local.pipelines.remove(self)
+        if type is None:
+            self.run()
+
+    def add(self, f, kwargs: dict, *, force_run: Union[bool, None]=None, container=None, priority: Union[int, None]=None) -> 'PendingResult':
+        node = PendingResult(
+            f=f,
+            kwargs=dict(kwargs),
+            force_run=force_run if force_run else self._force_run,
+            container=container if container is not None else self._container,
+            priority=priority if priority else self._priority
+        )
+        with self._lock:
+            self._nodes.append(node)
+        return node
+
+    def run(self) -> None:
+        """Run the jobs that have not run yet. Raises the first error (if any)."""
+        from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+        from .batch import _submit_many
+        with self._lock:
+            nodes = [n for n in self._nodes if not n._future.done()]
+        waiting: Set[PendingResult] = set(nodes)
+        running: Dict[Future, PendingResult] = dict()
+        with ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix='hither-pipeline') as executor:
+            while len(waiting) > 0 or len(running) > 0:
+                ready = [n for n in waiting if all([d._future.done() for d in n._dependencies()])]
+                for n in ready:
+                    waiting.remove(n)
+                failed = [n for n in ready if any([d._future.exception() is not None for d in n._dependencies()])]
+                for n in failed:
+                    n._future.set_exception(Exception('Unable to run {}: a job that it depends on failed'.format(n._f._hither_name)))
+                to_submit = [n for n in ready if n not in failed]
+                if len(to_submit) > 0:
+                    # one batched cache lookup for everything that became ready
+                    futures = _submit_many(
+                        [(n._f, n._job_kwargs()) for n in to_submit],
+                        executor=executor, holders=None, use_processes=False, force_run=False, container=None, priority=0
+                    )
+                    for n, fut in zip(to_submit, futures):
+                        running[fut] = n
+                if len(failed) > 0 or any([fut.done() for fut in running.keys()]):
+                    done = [fut for fut in running.keys() if fut.done()]
+                elif len(running) > 0:
+                    done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                else:
+                    raise Exception('Unable to run pipeline: some jobs depend on jobs that are not part of it')
+                for fut in done:
+                    n = running.pop(fut)
+                    e = fut.exception()
+                    if e is not None:
+                        n._future.set_exception(e)
+                    else:
+                        n._future.set_result(fut.result())
+        for n in nodes:
+            e = n._future.exception()
+            if e is not None:
+                raise e
+
+
+class PendingResult():
+    def __init__(self, *, f, kwargs: dict, force_run: bool, container, priority: int):
+        """The (future) result of a job in a Pipeline
+
+        Before the pipeline has run, retval and outputs are placeholders that
+        may be passed to other hither functions of the pipeline. Afterwards
+        they are those of the Result (see result()).
+        """
+        self._f = f
+        self._kwargs = kwargs
+        self._force_run = force_run
+        self._container = container
+        self._priority = priority
+        from concurrent.futures import Future
+        self._future: Future = Future()
+
+    def done(self) -> bool:
+        return self._future.done()
+
+    def result(self):
+        if not self._future.done():
+            raise Exception('The pipeline has not run yet')
+        return self._future.result()
+
+    @property
+    def retval(self):
+        if self._future.done():
+            return self.result().retval
+        return _Placeholder(self, ('retval',))
+
+    @property
+    def outputs(self):
+        if self._future.done():
+            return self.result().outputs
+        return _OutputsPlaceholder(self)
+
+    @property
+    def runtime_info(self):
+        return self.result().runtime_info
+
+    def _dependencies(self) -> Set['PendingResult']:
+        ret: Set[PendingResult] = set()
+        _collect_dependencies(self._kwargs, ret)
+        return ret
+
+    def _job_kwargs(self) -> dict:
+        kwargs = dict(_resolve_placeholders(self._kwargs))
+        kwargs['_force_run'] = self._force_run
+        kwargs['_container'] = self._container
+        kwargs['_priority'] = self._priority
+        return kwargs
+
+
+class _Placeholder():
+    # A reference to the retval (or an item of it) or an output file of a
+    # pending result
+    def __init__(self, node: PendingResult, path: tuple):
+        self._node = node
+        self._path = path
+
+    def __getitem__(self, key):
+        if self._path[0] != 'retval':
+            raise Exception('Cannot index an output file placeholder')
+        return _Placeholder(self._node, self._path + (key,))
+
+    def _resolve(self) -> Any:
+        from .core import File
+        result = self._node.result()
+        if self._path[0] == 'output':
+            oname = self._path[1]
+            # passed on by hash url so that the file is not copied
+            if oname in result._output_urls:
+                return File(result._output_urls[oname])
+            return getattr(result.outputs, oname)
+        x = result.retval
+        for key in self._path[1:]:
+            x = x[key]
+        return x
+
+    def __str__(self):
+        return 'hither placeholder for {} of {}'.format('.'.join([str(p) for p in self._path]), self._node._f._hither_name)
+
+
+class _OutputsPlaceholder():
+    def __init__(self, node: PendingResult):
+        self._node = node
+
+    def __getattr__(self, oname: str) -> _Placeholder:
+        if oname.startswith('_'):
+            raise AttributeError(oname)
+        return _Placeholder(self._node, ('output', oname))
+
+
+def _collect_dependencies(x: Any, ret: Set[PendingResult]) -> None:
+    if isinstance(x, _Placeholder):
+        ret.add(x._node)
+    elif isinstance(x, dict):
+        for v in x.values():
+            _collect_dependencies(v, ret)
+    elif isinstance(x, (list, tuple)):
+        for v in x:
+            _collect_dependencies(v, ret)
+
+def _resolve_placeholders(x: Any) -> Any:
+    # placeholders (also within dicts, lists and tuples) are replaced by their values
+    dependencies: Set[PendingResult] = set()
+    _collect_dependencies(x, dependencies)
+    if len(dependencies) == 0:
+        return x
+    return _substitute_placeholders(x)
+
+def _substitute_placeholders(x: Any) -> Any:
+    if isinstance(x, _Placeholder):
+        if not x._node.done():
+            raise Exception('Cannot use a placeholder outside of its pipeline before the pipeline has run: {}'.format(x))
+        return x._resolve()
+    elif isinstance(x, dict):
+        return {k: _substitute_placeholders(v) for k, v in x.items()}
+    elif isinstance(x, list):
+        return [_substitute_placeholders(v) for v in x]
+    elif isinstance(x, tuple):
+        return tuple([_substitute_placeholders(v) for v in x])
+    return x
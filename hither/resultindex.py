@@ -0,0 +1,159 @@
+import json
+import time
+import os
+import threading
+from typing import Union
+
+from .sqlitedb import SQLiteDB
+from .config import get_config_value, get_hither_dir
+
+_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS results (
+        hash TEXT PRIMARY KEY,
+        name TEXT,
+        doc TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        created REAL NOT NULL,
+        last_access REAL NOT NULL,
+        pinned INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS results_last_access ON results (pinned, last_access)'
+]
+
+# Only record an access time if the previous one is older than this, so that
+# cache hits do not need to write to the database
+_ACCESS_TIME_RESOLUTION_SEC = 60
+_EVICT_EVERY_NUM_PUTS = 100
+
+
+class ResultIndex():
+    def __init__(self, path: str):
+        """A local persistent index of serialized hither results keyed by hash
+
+        It sits in front of loggery so that cache hits for results that are
+        known on this machine cost a single local lookup.
+        """
+        self._db = SQLiteDB(path, schema=_SCHEMA)
+        self._num_puts = 0
+        self._lock = threading.Lock()
+
+    def get(self, hash0: str) -> Union[dict, None]:
+        conn = self._db.connection()
+        row = conn.execute('SELECT doc, last_access FROM results WHERE hash = ?', (hash0,)).fetchone()
+        if row is None:
+            return None
+        doc, last_access = row
+        now = time.time()
+        if now - last_access > _ACCESS_TIME_RESOLUTION_SEC:
+            conn.execute('UPDATE results SET last_access = ? WHERE hash = ?', (now, hash0))
+        return json.loads(doc)
+
+    def put(self, hash0: str, doc: dict) -> bool:
+        try:
+            txt = json.dumps(doc)
+        except TypeError:
+            # not json serializable (e.g., a retval from an in-process run)
+            return False
+        now = time.time()
+        self._db.connection().execute('''
+            INSERT INTO results (hash, name, doc, size, created, last_access) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (hash) DO UPDATE SET doc = excluded.doc, size = excluded.size, last_access = excluded.last_access
+        ''', (hash0, doc.get('name', None), txt, len(txt), now, now))
+        with self._lock:
+            self._num_puts = self._num_puts + 1
+            evict_now = (self._num_puts % _EVICT_EVERY_NUM_PUTS == 0)
+        if evict_now:
+            self.evict()
+        return True
+
+    def remove(self, hash0: str) -> None:
+        self._db.connection().execute('DELETE FROM results WHERE hash = ?', (hash0,))
+
+    def pin(self, hash0: str, pinned: bool=True) -> bool:
+        cur = self._db.connection().execute('UPDATE results SET pinned = ? WHERE hash = ?', (1 if pinned else 0, hash0))
+        return cur.rowcount > 0
+
+    def evict(self, *, max_bytes: Union[int, None]=None, max_age_sec: Union[float, None]=None) -> int:
+        """Remove unpinned entries that are too old or least recently used
+        beyond the size budget. Returns the number of entries removed."""
+        if max_bytes is None:
+            max_bytes = get_config_value('result_index_max_bytes')
+        if max_age_sec is None:
+            max_age_sec = get_config_value('result_index_max_age_sec')
+        conn = self._db.connection()
+        num_removed = 0
+        if max_age_sec is not None:
+            cur = conn.execute('DELETE FROM results WHERE pinned = 0 AND last_access < ?', (time.time() - max_age_sec,))
+            num_removed = num_removed + cur.rowcount
+        if max_bytes is not None:
+            total_size = conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+            if total_size > max_bytes:
+                to_remove = []
+                for hash0, size in conn.execute('SELECT hash, size FROM results WHERE pinned = 0 ORDER BY last_access'):
+                    if total_size <= max_bytes:
+                        break
+                    to_remove.append((hash0,))
+                    total_size = total_size - size
+                conn.executemany('DELETE FROM results WHERE hash = ?', to_remove)
+                num_removed = num_removed + len(to_remove)
+        return num_removed
+
+    def stats(self) -> dict:
+        num_entries, total_size, num_pinned = self._db.connection().execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(pinned), 0) FROM results'
+        ).fetchone()
+        return dict(path=self._db.path(), num_entries=num_entries, total_size=total_size, num_pinned=num_pinned)
+
+
+_global_result_index: Union[ResultIndex, None] = None
+_global_result_index_lock = threading.Lock()
+
+def _after_fork_in_child() -> None:
+    # The sqlite connections and locks of the parent are not used in the child
+    global _global_result_index, _global_result_index_lock
+    _global_result_index = None
+    _global_result_index_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+def get_result_index() -> Union[ResultIndex, None]:
+    global _global_result_index
+    if not get_config_value('use_result_index'):
+        return None
+    path = os.path.join(get_hither_dir(), 'result_index.db')
+    with _global_result_index_lock:
+        if _global_result_index is None or _global_result_index._db.path() != path:
+            _global_result_index = ResultIndex(path)
+        return _global_result_index
+
+def pin_result(result_or_hash, pinned: bool=True) -> bool:
+    """Pin (or unpin) a result in the local result index so that it is never evicted
+
+    Parameters
+    ----------
+    result_or_hash : hither.Result or str
+        The result (or its hash)
+    pinned : bool, optional
+        Whether to pin or unpin, by default True
+    """
+    index = get_result_index()
+    if index is None:
+        return False
+    if isinstance(result_or_hash, str):
+        hash0 = result_or_hash
+    else:
+        import kachery as ka
+        hash0 = ka.get_object_hash(result_or_hash.hash_object)
+    return index.pin(hash0, pinned=pinned)
+
+def unpin_result(result_or_hash) -> bool:
+    return pin_result(result_or_hash, pinned=False)
+
+def evict_results(*, max_bytes: Union[int, None]=None, max_age_sec: Union[float, None]=None) -> int:
+    index = get_result_index()
+    if index is None:
+        return 0
+    return index.evict(max_bytes=max_bytes, max_age_sec=max_age_sec)
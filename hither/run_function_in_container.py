@@ -1,85 +1,179 @@
 import os
-from typing import Any
-import json
-import fnmatch
-import inspect
+import sys
+import time
+import uuid
+from typing import Any, Union
 import shutil
 from copy import deepcopy
 from .temporarydirectory import TemporaryDirectory
-from .shellscript import ShellScript
+from .shellscript import ShellScript, AsyncShellScript
+from .config import get_config_value
+from .consolecapture import ConsoleCapture, current_console_capture
+from .sourcebundle import get_source_bundle, bundle_pythonpath, BUNDLE_PATH_INSIDE_CONTAINER
+from .runtimes import ContainerRuntime, get_container_runtime
+from .serialization import write_object, read_or_store_object
+from .linkfile import move_file
+from .kacherystore import get_staging_dir
+from .instrumentation import phase, add_phase_time, add_resources, read_usage_file
 
 def run_function_in_container(*, name: str, function, container: str, keyword_args: dict, input_file_keys: list, output_file_keys: list, additional_files: list=[], local_modules: list=[]) -> Any:
-    # generate source code
-    with TemporaryDirectory(remove=True, prefix='tmp_hither_run_in_container_' + name) as temp_path:
+    if get_config_value('use_warm_workers'):
+        from .containerworker import run_function_in_warm_worker
+        return run_function_in_warm_worker(
+            name=name, function=function, container=container, keyword_args=keyword_args,
+            input_file_keys=input_file_keys, output_file_keys=output_file_keys,
+            additional_files=additional_files, local_modules=local_modules
+        )
+    return _run_function_in_new_container(
+        name=name, function=function, container=container, keyword_args=keyword_args,
+        input_file_keys=input_file_keys, output_file_keys=output_file_keys,
+        additional_files=additional_files, local_modules=local_modules
+    )
+
+def _run_function_in_new_container(*, name: str, function, container: str, keyword_args: dict, input_file_keys: list, output_file_keys: list, additional_files: list, local_modules: list) -> Any:
+    # without warm workers, or when all of them are busy (see containerworker)
+    with phase('stage'):
+        run = _ContainerRun(
+            name=name, function=function, container=container, keyword_args=keyword_args,
+            input_file_keys=input_file_keys, output_file_keys=output_file_keys,
+            additional_files=additional_files, local_modules=local_modules
+        )
+    try:
+        ss = ShellScript(run.outside_script(), keep_temp_files=False)
+        launch_time = time.time()
+        ss.start(**_output_streaming_kwargs(name))
+        retcode = ss.wait()
+        run.record_usage(launch_time=launch_time, exit_time=time.time())
+        return run.finalize(retcode)
+    finally:
+        run.cleanup()
+
+async def run_function_in_container_async(*, name: str, function, container: str, keyword_args: dict, input_file_keys: list, output_file_keys: list, additional_files: list=[], local_modules: list=[], console_capture: Union[ConsoleCapture, None]=None) -> Any:
+    """Like run_function_in_container, but awaits the container process instead of blocking
+
+    The output of the container goes to console_capture (if given). Staging
+    (which may build the container image), collecting the outputs and the
+    cleanup block, so they run in the default executor.
+    """
+    # imported here because asyncexecution imports this module
+    from .asyncexecution import _in_executor
+    with phase('stage'):
+        run = await _in_executor(
+            _ContainerRun,
+            name=name, function=function, container=container, keyword_args=keyword_args,
+            input_file_keys=input_file_keys, output_file_keys=output_file_keys,
+            additional_files=additional_files, local_modules=local_modules
+        )
+    try:
+        ss = AsyncShellScript(run.outside_script(), keep_temp_files=False)
+        launch_time = time.time()
+        await ss.start(**_output_streaming_kwargs(name, console_capture=console_capture))
+        retcode = await ss.wait()
+        run.record_usage(launch_time=launch_time, exit_time=time.time())
+        return await _in_executor(run.finalize, retcode=retcode)
+    finally:
+        await _in_executor(run.cleanup)
+
+class _ContainerRun():
+    # The working directory and scripts for a single run of a function in a
+    # container, independent of how the container process is waited on
+    def __init__(self, *, name: str, function, container: str, keyword_args: dict, input_file_keys: list, output_file_keys: list, additional_files: list, local_modules: list):
+        self._name = name
+        self._container = container
+        # on the same device as the kachery storage (if possible) so that the outputs are moved rather than copied
+        self._temp_dir = TemporaryDirectory(remove=True, prefix='tmp_hither_run_in_container_' + name, dir=get_staging_dir())
+        self._temp_path = self._temp_dir.__enter__()
         try:
-            function_source_fname = os.path.abspath(inspect.getsourcefile(function))
+            self._prepare(function=function, keyword_args=keyword_args, input_file_keys=input_file_keys, output_file_keys=output_file_keys, additional_files=additional_files, local_modules=local_modules)
         except:
-            raise('Unable to get source file for function {}. Cannot run in a container.'.format(name))
-
-        function_source_dirname = os.path.dirname(function_source_fname)
-        function_source_basename = os.path.basename(function_source_fname)
-        function_source_basename_noext = os.path.splitext(function_source_basename)[0]
-        code = _read_python_code_of_directory(
-            function_source_dirname,
-            additional_files=additional_files,
-            exclude_init=True
-        )
-        code['files'].append(dict(
-            name='__init__.py',
-            content='from .{} import {}'.format(
-                function_source_basename_noext, name)
-        ))
-        hither_dir = os.path.dirname(os.path.realpath(__file__))
-        code['dirs'].append(dict(
-            name='_local_modules',
-            content=dict(
-                files=[],
-                dirs=[
-                    dict(
-                        name=os.path.basename(local_module_path),
-                        content=_read_python_code_of_directory(os.path.join(function_source_dirname, local_module_path), exclude_init=False)
-                    )
-                    for local_module_path in local_modules + [hither_dir]
-                ]
-            )
-        ))
-
-        _write_python_code_to_directory(os.path.join(temp_path, 'function_src'), code)
+            self.cleanup()
+            raise
+
+    def outside_script(self) -> str:
+        return self._outside_script
+
+    def record_usage(self, *, launch_time: float, exit_time: float) -> None:
+        # the times and resource usage measured in the container (see run.py)
+        usage = read_usage_file(os.path.join(self._temp_path, 'usage.json'))
+        if usage is None:
+            add_phase_time('compute', exit_time - launch_time)
+            return
+        add_phase_time('container_start', usage['start_time'] - launch_time)
+        add_phase_time('compute', usage['end_time'] - usage['start_time'])
+        add_phase_time('container_exit', exit_time - usage['end_time'])
+        add_resources(usage['resources'])
+
+    def finalize(self, retcode: Union[int, None]) -> Any:
+        name = self._name
+        container = self._container
+        if retcode != 0:
+            raise Exception('Non-zero exit code ({}) running {} in container {}'.format(retcode, name, container))
+
+        with phase('collect_outputs'):
+            # large return values are not loaded here (see Result.retval)
+            retval = read_or_store_object(os.path.join(self._temp_path, 'retval.pkl'), max_read_bytes=get_config_value('retval_inline_max_bytes'))
+
+            for a, b in self._outputs_to_copy.items():
+                move_file(a, b)
+
+        return retval
+
+    def cleanup(self) -> None:
+        self._temp_dir.__exit__(None, None, None)
+
+    def _prepare(self, *, function, keyword_args: dict, input_file_keys: list, output_file_keys: list, additional_files: list, local_modules: list) -> None:
+        name = self._name
+        container = self._container
+        runtime = get_container_runtime()
+        bundle_path = get_source_bundle(name=name, function=function, additional_files=additional_files, local_modules=local_modules)
 
-        keyword_args_adjusted = deepcopy(keyword_args)
         binds = dict()
+        def path_inside(path_outside: str, path_inside: str, readonly: bool=False) -> str:
+            # without bind mounts, the job sees the host paths
+            if not runtime.uses_bind_mounts:
+                return path_outside
+            if path_outside in binds:
+                # e.g., the same file passed as two inputs
+                return binds[path_outside].split(':')[0]
+            binds[path_outside] = path_inside + (':ro' if readonly else '')
+            return path_inside
+
+        keyword_args_adjusted = deepcopy(keyword_args)
+        if runtime.uses_bind_mounts:
+            binds['$KACHERY_STORAGE_DIR'] = '/kachery-storage'
+        run_dir = path_inside(self._temp_path, '/run_in_container')
+        bundle_dir = path_inside(bundle_path, BUNDLE_PATH_INSIDE_CONTAINER, readonly=True)
         for iname in input_file_keys:
             if iname in keyword_args.keys():
                 fname_outside = keyword_args[iname]
                 _, ext = os.path.splitext(fname_outside)
-                fname_inside = '/inputs/{}{}'.format(iname, ext)
-                keyword_args_adjusted[iname] = fname_inside
-                binds[fname_outside] = fname_inside
-        outputs_tmp = os.path.join(temp_path, 'outputs')
+                keyword_args_adjusted[iname] = path_inside(fname_outside, '/inputs/{}{}'.format(iname, ext))
+        outputs_tmp = os.path.join(self._temp_path, 'outputs')
         os.mkdir(outputs_tmp)
-        binds[outputs_tmp] = '/outputs'
-        outputs_to_copy = dict()
+        outputs_dir = path_inside(outputs_tmp, '/outputs')
+        self._outputs_to_copy = dict()
         for oname in output_file_keys:
             if oname in keyword_args.keys():
                 fname_outside = keyword_args[oname]
                 _, ext = os.path.splitext(fname_outside)
-                fname_inside = '/outputs/{}{}'.format(oname, ext)
                 fname_temp = '{}/{}{}'.format(outputs_tmp, oname, ext)
-                keyword_args_adjusted[oname] = fname_inside
-                outputs_to_copy[fname_temp] = fname_outside
+                keyword_args_adjusted[oname] = '{}/{}{}'.format(outputs_dir, oname, ext)
+                self._outputs_to_copy[fname_temp] = fname_outside
 
         run_py_script = """
             #!/usr/bin/env python
 
             from function_src import {function_name}
+            from hither.serialization import read_object, write_object
+            from hither.instrumentation import ResourceMeter
             import sys
-            import json
 
             def main():
-                kwargs = json.loads('{keyword_args_json}')
-                retval = {function_name}(**kwargs)
-                with open('/run_in_container/retval.json', 'w') as f:
-                    json.dump(dict(retval=retval), f)
+                kwargs = read_object('{run_dir}/kwargs.pkl')
+                with ResourceMeter(scope='process') as meter:
+                    retval = {function_name}(**kwargs)
+                write_object(retval, '{run_dir}/retval.pkl')
+                meter.write('{run_dir}/usage.json')
 
             if __name__ == "__main__":
                 try:
@@ -89,102 +183,62 @@ def run_function_in_container(*, name: str, function, container: str, keyword_ar
                     sys.stderr.flush()
                     raise
         """.format(
-            keyword_args_json=json.dumps(keyword_args_adjusted),
-            function_name=name
+            function_name=name,
+            run_dir=run_dir
         )
+        # protocol 4, which can also be read by older versions of python in the container
+        write_object(keyword_args_adjusted, os.path.join(self._temp_path, 'kwargs.pkl'), protocol=4)
 
         # For unindenting
-        ShellScript(run_py_script).write(os.path.join(temp_path, 'run.py'))
+        ShellScript(run_py_script).write(os.path.join(self._temp_path, 'run.py'))
 
         env_vars_inside_container = dict(
-            KACHERY_STORAGE_DIR='/kachery-storage',
-            PYTHONPATH='/run_in_container/function_src/_local_modules'
+            PYTHONPATH=bundle_pythonpath(bundle_dir)
         )
+        if runtime.uses_bind_mounts:
+            env_vars_inside_container['KACHERY_STORAGE_DIR'] = '/kachery-storage'
 
         run_inside_script = """
             #!/bin/bash
             set -e
 
-            {env_vars_inside_container} python3 /run_in_container/run.py
+            {env_vars_inside_container} {python} {run_dir}/run.py
         """.format(
-            env_vars_inside_container=' '.join(['{}={}'.format(k, v) for k, v in env_vars_inside_container.items()])
+            env_vars_inside_container=' '.join(['{}={}'.format(k, v) for k, v in env_vars_inside_container.items()]),
+            python=runtime.python_executable,
+            run_dir=run_dir
         )
 
-        ShellScript(run_inside_script).write(os.path.join(temp_path, 'run.sh'))
-
-        run_outside_script = """
-            #!/bin/bash
-
-            singularity exec -e --contain \\
-                -B $KACHERY_STORAGE_DIR:/kachery-storage \\
-                -B {temp_path}:/run_in_container \\
-                {binds_str} \\
-                {container} \\
-                bash /run_in_container/run.sh
-        """.format(
-            binds_str=' '.join(['-B {}:{}'.format(a, b) for a, b in binds.items()]),
-            container=container,
-            temp_path=temp_path
-        )
-
-        ss = ShellScript(run_outside_script, keep_temp_files=False)
-        ss.start()
-        retcode = ss.wait()
-
-        if retcode != 0:
-            raise Exception('Non-zero exit code ({}) running {} in container {}'.format(retcode, name, container))
-
-        with open(os.path.join(temp_path, 'retval.json')) as f:
-            obj = json.load(f)
-        retval = obj['retval']
-
-        for a, b in outputs_to_copy.items():
-            shutil.copyfile(a, b)
-
-        return retval
-
-def _read_python_code_of_directory(dirname, exclude_init, additional_files=[]):
-    patterns = ['*.py'] + additional_files
-    files = []
-    dirs = []
-    for fname in os.listdir(dirname):
-        if os.path.isfile(dirname + '/' + fname):
-            matches = False
-            for pattern in patterns:
-                if fnmatch.fnmatch(fname, pattern):
-                    matches = True
-            if exclude_init and (fname == '__init__.py'):
-                matches = False
-            if matches:
-                with open(dirname + '/' + fname) as f:
-                    txt = f.read()
-                files.append(dict(
-                    name=fname,
-                    content=txt
-                ))
-        elif os.path.isdir(dirname + '/' + fname):
-            if (not fname.startswith('__')) and (not fname.startswith('.')):
-                content = _read_python_code_of_directory(
-                    dirname + '/' + fname, additional_files=additional_files, exclude_init=False)
-                if len(content['files']) + len(content['dirs']) > 0:
-                    dirs.append(dict(
-                        name=fname,
-                        content=content
-                    ))
-    return dict(
-        files=files,
-        dirs=dirs
+        ShellScript(run_inside_script).write(os.path.join(self._temp_path, 'run.sh'))
+
+        self._outside_script = _runtime_script(runtime=runtime, container=container, binds=binds, command='bash {}/run.sh'.format(run_dir))
+
+def _output_streaming_kwargs(name: str, console_capture: Union[ConsoleCapture, None]=None) -> dict:
+    # Stream the output of the container into the console capture of the
+    # calling thread (if any) and into a per-job log file (if configured)
+    cc = console_capture if console_capture is not None else current_console_capture()
+    if cc is not None:
+        on_stdout = lambda txt: cc.write('stdout', txt)
+        on_stderr = lambda txt: cc.write('stderr', txt)
+    else:
+        on_stdout = lambda txt: _write_and_flush(sys.stdout, txt)
+        on_stderr = lambda txt: _write_and_flush(sys.stderr, txt)
+    log_path = None
+    job_log_dir = get_config_value('job_log_dir')
+    if job_log_dir is not None:
+        os.makedirs(job_log_dir, exist_ok=True)
+        log_path = os.path.join(job_log_dir, '{}_{}_{}.log'.format(name, time.strftime('%Y%m%d-%H%M%S'), uuid.uuid4().hex[:8]))
+    return dict(on_stdout=on_stdout, on_stderr=on_stderr, log_path=log_path)
+
+def _write_and_flush(f, txt: str) -> None:
+    f.write(txt)
+    f.flush()
+
+def _runtime_script(*, runtime: ContainerRuntime, container: str, binds: dict, command: str) -> str:
+    return """
+        #!/bin/bash
+
+        {command}
+    """.format(
+        command=runtime.command(container=container, binds=binds, command=command)
     )
-
-def _write_python_code_to_directory(dirname: str, code: dict) -> None:
-    if os.path.exists(dirname):
-        raise Exception(
-            'Cannot write code to already existing directory: {}'.format(dirname))
-    os.mkdir(dirname)
-    for item in code['files']:
-        fname0 = dirname + '/' + item['name']
-        with open(fname0, 'w') as f:
-            f.write(item['content'])
-    for item in code['dirs']:
-        _write_python_code_to_directory(
-            dirname + '/' + item['name'], item['content'])
@@ -0,0 +1,111 @@
+import sys
+import threading
+from typing import Dict, Union
+
+from .config import get_config_value
+
+class ContainerRuntime():
+    """How hither starts a job process in a container
+
+    A runtime turns a command, a container reference and a set of bind mounts
+    into a shell command. If uses_bind_mounts is False, the job process sees
+    the host filesystem as is: the binds are not needed and hither passes the
+    host paths to the job.
+    """
+    uses_bind_mounts: bool = True
+    # the python interpreter used inside the container
+    python_executable: str = 'python3'
+
+    def command(self, *, container: str, binds: Dict[str, str], command: str) -> str:
+        """Return the shell command that runs command in the container
+
+        Parameters
+        ----------
+        container : str
+            The container reference (e.g., docker://python:3.7)
+        binds : dict
+            Maps host paths to paths inside the container. A path inside may
+            end with ':ro' for a read-only bind.
+        command : str
+            The command to run inside the container
+        """
+        raise NotImplementedError
+
+
+class SingularityRuntime(ContainerRuntime):
+    def command(self, *, container, binds, command):
+        from .containerimages import get_container_image
+        return 'singularity exec -e --contain {binds_str} {container} {command}'.format(
+            binds_str=' '.join(['-B {}:{}'.format(a, b) for a, b in binds.items()]),
+            container=get_container_image(container),
+            command=command
+        )
+
+
+class DockerRuntime(ContainerRuntime):
+    def __init__(self, executable: str='docker'):
+        self._executable = executable
+
+    def command(self, *, container, binds, command):
+        # --init so that the signals sent to stop the job reach the process
+        return '{executable} run --rm -i --init {user_args} {binds_str} {image} {command}'.format(
+            executable=self._executable,
+            user_args=self._user_args(),
+            binds_str=' '.join(['-v {}:{}'.format(a, b) for a, b in binds.items()]),
+            image=_docker_image(container),
+            command=command
+        )
+
+    def _user_args(self) -> str:
+        # so that the output files are owned by the user
+        return '--user $(id -u):$(id -g)'
+
+
+class PodmanRuntime(DockerRuntime):
+    def __init__(self, executable: str='podman'):
+        super().__init__(executable=executable)
+
+    def _user_args(self) -> str:
+        return '--userns=keep-id'
+
+
+class SubprocessRuntime(ContainerRuntime):
+    """Run the job in a fresh python process on the host (the container is ignored)
+
+    This gives process isolation and crash safety without the startup cost
+    of a container image.
+    """
+    uses_bind_mounts = False
+    python_executable = sys.executable
+
+    def command(self, *, container, binds, command):
+        return command
+
+
+_runtimes: Dict[str, ContainerRuntime] = dict(
+    singularity=SingularityRuntime(),
+    docker=DockerRuntime(),
+    podman=PodmanRuntime(),
+    subprocess=SubprocessRuntime()
+)
+_runtimes_lock = threading.Lock()
+
+def register_container_runtime(name: str, runtime: ContainerRuntime) -> None:
+    """Make a runtime available as hither.set_config(container_runtime=name)"""
+    with _runtimes_lock:
+        _runtimes[name] = runtime
+
+def get_container_runtime(name: Union[str, None]=None) -> ContainerRuntime:
+    if name is None:
+        name = get_config_value('container_runtime')
+    with _runtimes_lock:
+        if name not in _runtimes:
+            raise Exception('Unknown container runtime: {}'.format(name))
+        return _runtimes[name]
+
+def _docker_image(container: str) -> str:
+    if container.startswith('docker://'):
+        return container[len('docker://'):]
+    if '://' in container or container.endswith('.sif'):
+        raise Exception('Not a docker image: {}'.format(container))
+    return container
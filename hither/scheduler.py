@@ -0,0 +1,282 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import itertools
+from typing import TYPE_CHECKING, Callable, List, Union
+
+from .config import get_config_value
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
+_RESOURCE_NAMES = ['cores', 'ram_gb', 'scratch_gb', 'gpus']
+_DEFAULT_RESOURCES = dict(cores=1, ram_gb=0, scratch_gb=0, gpus=0)
+
+def resources(*, cores: float=1, ram_gb: float=0, scratch_gb: float=0, gpus: int=0):
+    """Declare the resources needed by a hither function
+
+    Example
+    -------
+    @hither.function('sort', '0.1.0')
+    @hither.resources(cores=4, ram_gb=8)
+    def sort(...):
+        ...
+    """
+    def wrap(f):
+        setattr(f, '_hither_resources', dict(
+            cores=cores,
+            ram_gb=ram_gb,
+            scratch_gb=scratch_gb,
+            gpus=gpus
+        ))
+        return f
+    return wrap
+
+def get_function_resources(f) -> dict:
+    return dict(getattr(f, '_hither_resources', _DEFAULT_RESOURCES))
+
+
+class _Waiter():
+    def __init__(self, *, resources: dict, priority: int, seq: int, on_grant: Callable[[], None]):
+        self.resources = resources
+        self.priority = priority
+        self.seq = seq
+        self.on_grant = on_grant
+        self.enqueue_time = time.time()
+        self.granted = False
+        self.cancelled = False
+
+
+class LocalScheduler():
+    def __init__(self, *, cores: Union[float, None]=None, ram_gb: Union[float, None]=None, scratch_gb: Union[float, None]=None, gpus: Union[int, None]=None, max_queue_length: Union[int, None]=None, max_backfill_wait_sec: float=60):
+        """Packs jobs onto the resources of the local machine
+
+        Jobs are granted in order of priority (higher first) and then
+        submission order. A job that does not fit may be overtaken by smaller
+        jobs that do (backfilling), but only until it has waited
+        max_backfill_wait_sec, after which the capacity is held for it.
+
+        Parameters
+        ----------
+        cores, ram_gb, scratch_gb, gpus : optional
+            The capacity. By default these are detected: cpu count, physical
+            memory, free space in the temporary directory and the number of
+            CUDA_VISIBLE_DEVICES.
+        max_queue_length : int or None, optional
+            If set, submit() blocks while this many jobs are waiting (backpressure)
+        max_backfill_wait_sec : float, optional
+            See above, by default 60
+        """
+        self._capacity = dict(
+            cores=cores if cores is not None else (os.cpu_count() or 1),
+            ram_gb=ram_gb if ram_gb is not None else _detect_ram_gb(),
+            scratch_gb=scratch_gb if scratch_gb is not None else _detect_scratch_gb(),
+            gpus=gpus if gpus is not None else _detect_gpus()
+        )
+        self._in_use = {k: 0 for k in _RESOURCE_NAMES}
+        self._max_queue_length = max_queue_length
+        self._max_backfill_wait_sec = max_backfill_wait_sec
+        self._waiters: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._queue_space = threading.Condition(self._lock)
+        self._local = threading.local()
+        self._num_granted = 0
+        self._total_wait_sec = 0.0
+
+    def capacity(self) -> dict:
+        return dict(self._capacity)
+
+    def acquire(self, resources: dict, *, priority: int=0, timeout: Union[float, None]=None) -> bool:
+        """Block until the resources are available. Returns False on timeout."""
+        event = threading.Event()
+        waiter = self._enqueue(resources, priority=priority, on_grant=event.set)
+        if not event.wait(timeout=timeout):
+            if self._cancel(waiter):
+                return False
+        return True
+
+    async def acquire_async(self, resources: dict, *, priority: int=0) -> None:
+        import asyncio
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        def on_grant():
+            loop.call_soon_threadsafe(lambda: fut.done() or fut.set_result(True))
+        waiter = self._enqueue(resources, priority=priority, on_grant=on_grant)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if not self._cancel(waiter):
+                self.release(resources)
+            raise
+
+    def release(self, resources: dict) -> None:
+        resources = _normalize_resources(resources)
+        with self._lock:
+            for k in _RESOURCE_NAMES:
+                self._in_use[k] = self._in_use[k] - resources[k]
+            granted = self._dispatch()
+        for waiter in granted:
+            waiter.on_grant()
+
+    def allocate(self, resources: dict, *, priority: int=0):
+        """Context manager that holds the resources for the duration of the block
+
+        Nested allocations in the same thread (e.g., a job run by submit()
+        calling f.execute()) do not allocate again.
+        """
+        return _Allocation(self, resources, priority=priority)
+
+    def submit(self, fn: Callable, resources: dict, *, priority: int=0) -> 'Future':
+        """Run fn() in a new thread once the resources are available"""
+        with self._lock:
+            while self._max_queue_length is not None and len(self._waiters) >= self._max_queue_length:
+                self._queue_space.wait()
+        from concurrent.futures import Future
+        fut: Future = Future()
+        def run():
+            self._local.depth = 1
+            try:
+                fut.set_result(fn())
+            except BaseException as e:
+                fut.set_exception(e)
+            finally:
+                self._local.depth = 0
+                self.release(resources)
+        def on_grant():
+            threading.Thread(target=run, name='hither-scheduled-job', daemon=True).start()
+        self._enqueue(resources, priority=priority, on_grant=on_grant)
+        return fut
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(
+                capacity=dict(self._capacity),
+                in_use=dict(self._in_use),
+                num_waiting=len(self._waiters),
+                num_granted=self._num_granted,
+                mean_wait_sec=self._total_wait_sec / self._num_granted if self._num_granted > 0 else 0
+            )
+
+    def _enqueue(self, resources: dict, *, priority: int, on_grant: Callable[[], None]) -> _Waiter:
+        resources = _normalize_resources(resources)
+        for k in _RESOURCE_NAMES:
+            if resources[k] > self._capacity[k]:
+                raise Exception('Job requires more {} ({}) than the scheduler has ({})'.format(k, resources[k], self._capacity[k]))
+        with self._lock:
+            waiter = _Waiter(resources=resources, priority=priority, seq=next(self._seq), on_grant=on_grant)
+            self._waiters.append(waiter)
+            self._waiters.sort(key=lambda w: (-w.priority, w.seq))
+            granted = self._dispatch()
+        for w in granted:
+            w.on_grant()
+        return waiter
+
+    def _cancel(self, waiter: _Waiter) -> bool:
+        # returns False if the waiter was granted in the meantime
+        with self._lock:
+            if waiter.granted:
+                return False
+            waiter.cancelled = True
+            self._waiters.remove(waiter)
+            self._queue_space.notify_all()
+            return True
+
+    def _dispatch(self) -> List[_Waiter]:
+        # must be called with the lock held; the returned waiters must be notified after releasing it
+        granted = []
+        available = {k: self._capacity[k] - self._in_use[k] for k in _RESOURCE_NAMES}
+        now = time.time()
+        for waiter in list(self._waiters):
+            if _fits(waiter.resources, available):
+                self._waiters.remove(waiter)
+                waiter.granted = True
+                for k in _RESOURCE_NAMES:
+                    self._in_use[k] = self._in_use[k] + waiter.resources[k]
+                    available[k] = available[k] - waiter.resources[k]
+                self._num_granted = self._num_granted + 1
+                self._total_wait_sec = self._total_wait_sec + (now - waiter.enqueue_time)
+                granted.append(waiter)
+            elif now - waiter.enqueue_time > self._max_backfill_wait_sec:
+                # hold the remaining capacity for this job so it cannot starve
+                break
+        if granted:
+            self._queue_space.notify_all()
+        return granted
+
+
+class _Allocation():
+    def __init__(self, scheduler: LocalScheduler, resources: dict, *, priority: int):
+        self._scheduler = scheduler
+        self._resources = resources
+        self._priority = priority
+        self._nested = False
+
+    def __enter__(self):
+        local = self._scheduler._local
+        self._nested = getattr(local, 'depth', 0) > 0
+        if not self._nested:
+            self._scheduler.acquire(self._resources, priority=self._priority)
+        local.depth = getattr(local, 'depth', 0) + 1
+        return self
+
+    def __exit__(self, type, value, traceback):
+        local = self._scheduler._local
+        local.depth = local.depth - 1
+        if not self._nested:
+            self._scheduler.release(self._resources)
+
+
+def _normalize_resources(resources: dict) -> dict:
+    ret = dict(_DEFAULT_RESOURCES)
+    for k, v in resources.items():
+        if k not in _RESOURCE_NAMES:
+            raise Exception('Unknown resource: {}'.format(k))
+        ret[k] = v
+    return ret
+
+def _fits(resources: dict, available: dict) -> bool:
+    for k in _RESOURCE_NAMES:
+        if resources[k] > available[k]:
+            return False
+    return True
+
+def _detect_ram_gb() -> float:
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+    except (ValueError, OSError, AttributeError):
+        return float('inf')
+
+def _detect_scratch_gb() -> float:
+    try:
+        return shutil.disk_usage(tempfile.gettempdir()).free / 1024 ** 3
+    except OSError:
+        return float('inf')
+
+def _detect_gpus() -> int:
+    x = os.environ.get('CUDA_VISIBLE_DEVICES', None)
+    if not x:
+        return 0
+    return len([a for a in x.split(',') if a.strip()])
+
+
+_global_scheduler: Union[LocalScheduler, None] = None
+_global_scheduler_lock = threading.Lock()
+
+def set_scheduler(scheduler: Union[LocalScheduler, None]) -> None:
+    """Set the scheduler used for hither jobs (None for the default one)"""
+    global _global_scheduler
+    with _global_scheduler_lock:
+        _global_scheduler = scheduler
+
+def get_scheduler() -> Union[LocalScheduler, None]:
+    """Return the active scheduler, or None if scheduling is disabled (see set_config(use_scheduler=...))"""
+    global _global_scheduler
+    if not get_config_value('use_scheduler'):
+        return None
+    with _global_scheduler_lock:
+        if _global_scheduler is None:
+            _global_scheduler = LocalScheduler()
+        return _global_scheduler
@@ -0,0 +1,178 @@
+import os
+import json
+import mmap
+import pickle
+import struct
+from typing import Any, List, Union
+
+# Only standard modules that are quick to import are imported at the top,
+# because this module is imported by the scripts that run in the containers.
+
+# File layout: magic, header length (uint64), JSON header, then the pickle
+# data and each out-of-band buffer, all aligned to 64 bytes. The header has
+# the offsets and sizes of the data and buffers, relative to the data start.
+_MAGIC = b'HITHER1\n'
+_ALIGNMENT = 64
+
+def write_object(obj: Any, path: str, *, protocol: Union[int, None]=None) -> None:
+    """Write a python object in a form that can be memory-mapped by read_object
+
+    With pickle protocol 5 (the default where available), large contiguous
+    buffers (e.g., numpy arrays) are written out-of-band as raw bytes.
+
+    Parameters
+    ----------
+    obj : any
+        A picklable object
+    path : str
+        The output file
+    protocol : int or None, optional
+        The pickle protocol, by default the highest available (up to 5). Use
+        a lower protocol for files read by older versions of python.
+    """
+    if protocol is None:
+        protocol = min(pickle.HIGHEST_PROTOCOL, 5)
+    buffers: list = []
+    if protocol >= 5:
+        data = pickle.dumps(obj, protocol=protocol, buffer_callback=buffers.append)
+        raws = [b.raw() for b in buffers]
+    else:
+        data = pickle.dumps(obj, protocol=protocol)
+        raws = []
+    segments = [memoryview(data)] + raws
+    offsets: List[List[int]] = []
+    offset = 0
+    for seg in segments:
+        offsets.append([offset, seg.nbytes])
+        offset = _align(offset + seg.nbytes)
+    header = json.dumps(dict(protocol=protocol, pickle=offsets[0], buffers=offsets[1:])).encode('utf-8')
+    data_start = _align(len(_MAGIC) + 8 + len(header))
+    with open(path, 'wb') as f:
+        f.write(_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for seg, (off, _) in zip(segments, offsets):
+            f.seek(data_start + off)
+            f.write(seg)
+
+def read_object(path: str) -> Any:
+    """Read an object written by write_object
+
+    The file is memory-mapped (copy on write), so out-of-band buffers such
+    as numpy arrays are not copied into memory. Plain pickle files are also
+    accepted.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            f.seek(0)
+            return pickle.load(f)
+        header_len = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_len).decode('utf-8'))
+        data_start = _align(len(_MAGIC) + 8 + header_len)
+        # the mapping stays valid after the file is closed (or removed) and
+        # lives as long as the objects that refer to its buffers
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    view = memoryview(mm)
+    off, size = header['pickle']
+    buffers = [view[data_start + o:data_start + o + s] for o, s in header['buffers']]
+    if len(buffers) > 0:
+        return pickle.loads(view[data_start + off:data_start + off + size], buffers=buffers)
+    return pickle.loads(view[data_start + off:data_start + off + size])
+
+def store_object(obj: Any) -> str:
+    """Store an object in kachery (see write_object) and return its url"""
+    import tempfile
+    from .kacherystore import get_staging_dir, store_file_by_move
+    with tempfile.NamedTemporaryFile(prefix='hither_object_', suffix='.pkl', delete=False, dir=get_staging_dir()) as tmpfile:
+        path = tmpfile.name
+    try:
+        write_object(obj, path)
+        return store_file_by_move(path)
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+
+def load_object(url: str) -> Any:
+    import kachery as ka
+    path = ka.load_file(url)
+    if path is None:
+        raise Exception('Unable to load object: {}'.format(url))
+    return read_object(path)
+
+def sign_object_url(url: str) -> str:
+    """Return a signature of a stored object (see is_signed_object_url)
+
+    Unpickling runs arbitrary code, so objects are only loaded from urls that
+    were signed with the key of this hither directory (e.g., not from
+    documents that were written to a shared database by someone else).
+    The url includes the hash of the content.
+    """
+    import hmac
+    import hashlib
+    return hmac.new(_get_signing_key(), url.encode('utf-8'), hashlib.sha256).hexdigest()
+
+def is_signed_object_url(url: str, signature: Union[str, None]) -> bool:
+    import hmac
+    if not signature:
+        return False
+    return hmac.compare_digest(sign_object_url(url), signature)
+
+def read_or_store_object(path: str, *, max_read_bytes: int) -> Any:
+    """Read an object written by write_object, or if the file is larger than
+    max_read_bytes, move the file into kachery and return a StoredObject"""
+    if os.path.getsize(path) > max_read_bytes:
+        from .kacherystore import store_file_by_move
+        return StoredObject(store_file_by_move(path))
+    return read_object(path)
+
+
+class StoredObject():
+    # A value that has been stored in kachery and is only loaded when needed,
+    # either pickled (see store_object) or as JSON text
+    def __init__(self, url: str, *, format: str='pickle'):
+        self.url = url
+        self.format = format
+
+    def load(self) -> Any:
+        if self.format == 'json':
+            import kachery as ka
+            txt = ka.load_text(self.url)
+            if txt is None:
+                raise Exception('Unable to load object: {}'.format(self.url))
+            return json.loads(txt)
+        return load_object(self.url)
+
+
+# (path, key) of the key that was read last
+_signing_key: Union[tuple, None] = None
+
+def _get_signing_key() -> bytes:
+    # A random key, created once per hither directory and readable only by
+    # the user. Linked into place so that concurrent processes agree on it.
+    global _signing_key
+    from .config import get_hither_dir
+    path = os.path.join(get_hither_dir(), 'object_signing_key')
+    if _signing_key is not None and _signing_key[0] == path:
+        return _signing_key[1]
+    if not os.path.exists(path):
+        tmp_path = '{}.tmp.{}'.format(path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.write(fd, os.urandom(32).hex().encode('utf-8'))
+        finally:
+            os.close(fd)
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp_path)
+    with open(path, 'rb') as f:
+        key = f.read().strip()
+    if len(key) == 0:
+        raise Exception('Empty object signing key: {}'.format(path))
+    _signing_key = (path, key)
+    return key
+
+def _align(n: int) -> int:
+    return (n + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
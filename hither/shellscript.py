@@ -4,7 +4,14 @@ import shutil
 import signal
 import os
 import time
-from typing import Optional, List, Any
+import codecs
+import selectors
+import threading
+from typing import TYPE_CHECKING, Optional, List, Any, Callable, Dict
+
+if TYPE_CHECKING:
+    # imported where it is used (it is slow to import)
+    import asyncio
 
 
 class ShellScript():
@@ -28,6 +35,7 @@ class ShellScript():
         self._dirs_to_remove: List[str] = []
         self._start_time: Optional[float] = None
         self._verbose = verbose
+        self._output_done: Optional[threading.Event] = None
 
     def __del__(self):
         self.cleanup()
@@ -44,7 +52,14 @@ class ShellScript():
             f.write(self._script)
         os.chmod(script_path, 0o744)
 
-    def start(self) -> None:
+    def start(self, *, on_stdout: Optional[Callable[[str], None]]=None, on_stderr: Optional[Callable[[str], None]]=None, log_path: Optional[str]=None) -> None:
+        """Start the script
+
+        If on_stdout, on_stderr or log_path is given, the output of the process
+        is piped and streamed line by line to the callbacks (and appended to
+        the log file) by a single shared reader thread. Otherwise the process
+        inherits the stdout and stderr of this process.
+        """
         if self._script_path is not None:
             script_path = self._script_path
         else:
@@ -56,17 +71,39 @@ class ShellScript():
         if self._verbose:
             print('RUNNING SHELL SCRIPT: ' + cmd)
         self._start_time = time.time()
-        self._process = subprocess.Popen(cmd)
+        if on_stdout is None and on_stderr is None and log_path is None:
+            self._process = subprocess.Popen(cmd)
+            return
+        self._process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0)
+        self._output_done = _get_output_pump().add(
+            stdout=self._process.stdout,
+            stderr=self._process.stderr,
+            on_stdout=on_stdout,
+            on_stderr=on_stderr,
+            log_path=log_path
+        )
 
     def wait(self, timeout=None) -> Optional[int]:
+        """Wait for the process to finish and all of its output to be delivered
+
+        Returns None on timeout (the process keeps running).
+        """
+        timer = time.time()
         if not self.isRunning():
-            return self.returnCode()
-        assert self._process is not None, "Unexpected self._process is None even though it is running."
-        try:
-            retcode = self._process.wait(timeout=timeout)
-            return retcode
-        except:
-            return None
+            retcode = self.returnCode()
+        else:
+            assert self._process is not None, "Unexpected self._process is None even though it is running."
+            try:
+                retcode = self._process.wait(timeout=timeout)
+            except:
+                return None
+        if self._output_done is not None:
+            # also if the process had already exited, the reader thread may
+            # still be delivering its output
+            remaining = None if timeout is None else max(0, timeout - (time.time() - timer))
+            if not self._output_done.wait(timeout=remaining):
+                return None
+        return retcode
 
     def cleanup(self) -> None:
         if self._keep_temp_files:
@@ -154,6 +191,232 @@ class ShellScript():
         return ii
 
 
+class AsyncShellScript(ShellScript):
+    def __init__(self, script: str, script_path: Optional[str]=None, keep_temp_files: bool=False, verbose: bool=False):
+        """A ShellScript that runs as an asyncio subprocess
+
+        Use from within a running event loop, e.g.
+        ```
+        ss = AsyncShellScript(script)
+        await ss.start()
+        retcode = await ss.wait(timeout=60)
+        ```
+        """
+        super().__init__(script, script_path=script_path, keep_temp_files=keep_temp_files, verbose=verbose)
+        self._async_process: Optional[asyncio.subprocess.Process] = None
+        self._reader_tasks: List[asyncio.Task] = []
+        self._log_file: Any = None
+
+    async def start(self, *, on_stdout: Optional[Callable[[str], None]]=None, on_stderr: Optional[Callable[[str], None]]=None, log_path: Optional[str]=None) -> None:
+        import asyncio
+        if self._script_path is not None:
+            script_path = self._script_path
+        else:
+            tempdir = tempfile.mkdtemp(prefix='tmp_shellscript')
+            script_path = os.path.join(tempdir, 'script.sh')
+            self._dirs_to_remove.append(tempdir)
+        self.write(script_path)
+        if self._verbose:
+            print('RUNNING SHELL SCRIPT: ' + script_path)
+        self._start_time = time.time()
+        if on_stdout is None and on_stderr is None and log_path is None:
+            self._async_process = await asyncio.create_subprocess_exec(script_path, start_new_session=True)
+            return
+        # in its own session, so that stop() can signal the whole process group
+        self._async_process = await asyncio.create_subprocess_exec(script_path, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=True)
+        self._log_file = open(log_path, 'a', encoding='utf-8') if log_path is not None else None
+        self._reader_tasks = [
+            asyncio.ensure_future(self._read_output(self._async_process.stdout, _LineBuffer(callback=on_stdout, log_file=self._log_file))),
+            asyncio.ensure_future(self._read_output(self._async_process.stderr, _LineBuffer(callback=on_stderr, log_file=self._log_file)))
+        ]
+
+    async def wait(self, timeout=None) -> Optional[int]:
+        """Wait for the process to finish and all of its output to be delivered
+
+        Returns None on timeout (the process keeps running). If the waiting
+        task is cancelled, the process is stopped.
+        """
+        import asyncio
+        assert self._async_process is not None, "Cannot wait on a script that was not started."
+        try:
+            await asyncio.wait_for(asyncio.shield(self._wait_all()), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+        except asyncio.CancelledError:
+            await self.stop()
+            raise
+        return self._async_process.returncode
+
+    async def stop(self, grace_period: float=2) -> None:
+        """Stop gracefully (SIGINT, then SIGTERM), then forcefully (SIGKILL)"""
+        import asyncio
+        if not self.isRunning():
+            return
+        assert self._async_process is not None
+        for signal0 in [signal.SIGINT, signal.SIGTERM]:
+            if not self._send_signal_to_group(signal0):
+                return
+            try:
+                await asyncio.wait_for(asyncio.shield(self._async_process.wait()), timeout=grace_period)
+                return
+            except asyncio.TimeoutError:
+                pass
+        await self.kill()
+
+    async def kill(self) -> None:
+        if not self.isRunning():
+            return
+        assert self._async_process is not None
+        if not self._send_signal_to_group(signal.SIGKILL):
+            return
+        await self._async_process.wait()
+
+    def isRunning(self) -> bool:
+        if self._async_process is None:
+            return False
+        return self._async_process.returncode is None
+
+    def isFinished(self) -> bool:
+        if self._async_process is None:
+            return False
+        return not self.isRunning()
+
+    def returnCode(self) -> Optional[int]:
+        if not self.isFinished():
+            raise Exception('Cannot get return code before process is finished.')
+        assert self._async_process is not None
+        return self._async_process.returncode
+
+    def _send_signal_to_group(self, sig) -> bool:
+        assert self._async_process is not None
+        try:
+            os.killpg(self._async_process.pid, sig)
+            return True
+        except ProcessLookupError:
+            return False
+
+    async def _wait_all(self) -> None:
+        import asyncio
+        assert self._async_process is not None
+        await self._async_process.wait()
+        if self._reader_tasks:
+            await asyncio.gather(*self._reader_tasks)
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+
+    async def _read_output(self, stream: 'asyncio.StreamReader', buffer: '_LineBuffer') -> None:
+        while True:
+            data = await stream.read(65536)
+            if not data:
+                buffer.feed(b'', final=True)
+                return
+            buffer.feed(data)
+
+
+class _LineBuffer():
+    # Decodes piped output incrementally and delivers it line by line to a
+    # callback and/or a log file
+    def __init__(self, *, callback: Optional[Callable[[str], None]], log_file: Any):
+        self._callback = callback
+        self._log_file = log_file
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._partial = ''
+
+    def feed(self, data: bytes, final: bool=False) -> None:
+        txt = self._partial + self._decoder.decode(data, final=final)
+        if final:
+            lines, self._partial = txt, ''
+        else:
+            ind = txt.rfind('\n')
+            lines, self._partial = txt[:ind + 1], txt[ind + 1:]
+        if not lines:
+            return
+        if self._log_file is not None:
+            self._log_file.write(lines)
+            self._log_file.flush()
+        if self._callback is not None:
+            try:
+                self._callback(lines)
+            except Exception as e:
+                print('Warning: error in shell script output callback: {}'.format(e))
+
+
+class _OutputPump():
+    # A single thread that reads the piped output of all running scripts
+    # using a selector, so that concurrent scripts do not each need a thread
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._pending: List[dict] = []
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+        self._thread = threading.Thread(target=self._run, name='hither-output-pump', daemon=True)
+        self._thread.start()
+
+    def add(self, *, stdout, stderr, on_stdout, on_stderr, log_path) -> threading.Event:
+        done = threading.Event()
+        job = dict(
+            log_file=open(log_path, 'a', encoding='utf-8') if log_path is not None else None,
+            num_open=2,
+            done=done
+        )
+        with self._lock:
+            for f, callback in [(stdout, on_stdout), (stderr, on_stderr)]:
+                os.set_blocking(f.fileno(), False)
+                self._pending.append(dict(
+                    file=f,
+                    buffer=_LineBuffer(callback=callback, log_file=job['log_file']),
+                    job=job
+                ))
+        os.write(self._wakeup_w, b'x')
+        return done
+
+    def _run(self) -> None:
+        while True:
+            for key, _ in self._selector.select():
+                if key.data is None:
+                    try:
+                        os.read(self._wakeup_r, 4096)
+                    except BlockingIOError:
+                        pass
+                    with self._lock:
+                        pending = self._pending
+                        self._pending = []
+                    for stream in pending:
+                        self._selector.register(stream['file'], selectors.EVENT_READ, stream)
+                    continue
+                stream = key.data
+                try:
+                    data = os.read(stream['file'].fileno(), 65536)
+                except BlockingIOError:
+                    continue
+                if data:
+                    stream['buffer'].feed(data)
+                else:
+                    stream['buffer'].feed(b'', final=True)
+                    self._selector.unregister(stream['file'])
+                    stream['file'].close()
+                    job = stream['job']
+                    job['num_open'] = job['num_open'] - 1
+                    if job['num_open'] == 0:
+                        if job['log_file'] is not None:
+                            job['log_file'].close()
+                        job['done'].set()
+
+
+_output_pump: Optional[_OutputPump] = None
+_output_pump_lock = threading.Lock()
+
+def _get_output_pump() -> _OutputPump:
+    global _output_pump
+    with _output_pump_lock:
+        if _output_pump is None:
+            _output_pump = _OutputPump()
+        return _output_pump
+
+
 def _rmdir_with_retries(dirname, num_retries, delay_between_tries=1):
     for retry_num in range(1, num_retries + 1):
         if not os.path.exists(dirname):
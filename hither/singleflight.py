@@ -0,0 +1,216 @@
+import os
+import time
+import uuid
+import threading
+from typing import Callable, Dict, List, Union
+
+from .config import get_config_value, get_hither_dir
+
+class SingleFlight():
+    def __init__(self, hash0: str):
+        """Make concurrent executions of the same job run only once
+
+        The first caller for a result hash runs the job while the others wait,
+        after which they find the stored result. Callers on the same host
+        (threads and processes) are coordinated by a lock file in the hither
+        directory, which is released automatically if the owner dies and
+        removed on release.
+
+        If the single_flight_lease_sec config value is set, callers on other
+        hosts (sharing the loggery database) are coordinated by lease messages.
+        The owner renews its lease while the job runs, by inserting a message
+        every lease_sec/3 seconds. If it stops doing so (e.g., because it
+        died), its lease expires and the next caller takes over. On release,
+        the caller deletes its own lease messages along with any that expired
+        (those of callers that died).
+
+        A flight is acquired before the scheduler resources of the job are
+        allocated (see _run_job_once), so that callers that wait for a job
+        running elsewhere do not keep runnable jobs from the resources.
+
+        Example
+        -------
+        flight = SingleFlight(hash0)
+        flight.acquire(is_done=lambda: _load_result(hash_object=hash_object) is not None)
+        try:
+            # load the result if it is there, otherwise run the job
+        finally:
+            flight.release()
+
+        Parameters
+        ----------
+        hash0 : str
+            The hash of the job (see hither_result messages)
+        """
+        self._hash = hash0
+        self._path = os.path.join(get_hither_dir('single_flight'), hash0 + '.lock')
+        self._lease_sec: Union[float, None] = get_config_value('single_flight_lease_sec')
+        self._id = uuid.uuid4().hex
+        self._since: Union[float, None] = None
+        self._file_lock = None
+        self._owns_lease = False
+        self._heartbeat_stop = threading.Event()
+        self._heartbeat_thread: Union[threading.Thread, None] = None
+
+    def acquire(self, *, is_done: Callable[[], bool]) -> None:
+        """Wait until this caller may run the job or is_done() returns True"""
+        # imported here because hither is also imported inside the containers
+        from etconf.filelock import FileLock
+        _acquire_thread_lock(self._path)
+        acquired = False
+        try:
+            file_lock = FileLock(self._path, exclusive=True)
+            file_lock.__enter__()
+            self._file_lock = file_lock
+            if self._lease_sec is not None:
+                self._acquire_lease(is_done=is_done)
+            acquired = True
+        finally:
+            if not acquired:
+                self._release_file_lock()
+
+    def release(self) -> None:
+        try:
+            if self._owns_lease or not get_config_value('use_result_index'):
+                # so that the other callers find the result when they look for
+                # it (raises if the result could not be written)
+                import loggery
+                loggery.flush()
+        finally:
+            try:
+                if self._owns_lease:
+                    self._heartbeat_stop.set()
+                    if self._heartbeat_thread is not None:
+                        self._heartbeat_thread.join()
+                    self._owns_lease = False
+                    self._end_lease()
+            finally:
+                self._release_file_lock()
+
+    def _release_file_lock(self) -> None:
+        if self._file_lock is not None:
+            # removed while it is still locked (see FileLock)
+            try:
+                os.unlink(self._path)
+            except FileNotFoundError:
+                pass
+            self._file_lock.__exit__(None, None, None)
+            self._file_lock = None
+        _release_thread_lock(self._path)
+
+    def _acquire_lease(self, *, is_done: Callable[[], bool]) -> None:
+        assert self._lease_sec is not None
+        self._since = time.time()
+        renew_interval = self._lease_sec / 3
+        poll_interval = min(1.0, renew_interval)
+        last_renewal = 0.0
+        while True:
+            if time.time() - last_renewal >= renew_interval:
+                # waiters renew their leases too, to keep their place in line
+                self._renew_lease(released=False)
+                last_renewal = time.time()
+            if self._lease_owner() == self._id:
+                break
+            if is_done():
+                self._end_lease()
+                return
+            time.sleep(poll_interval)
+        self._owns_lease = True
+        self._heartbeat_stop.clear()
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat, args=(renew_interval,), daemon=True)
+        self._heartbeat_thread.start()
+
+    def _heartbeat(self, interval: float) -> None:
+        while not self._heartbeat_stop.wait(interval):
+            try:
+                self._renew_lease(released=False)
+            except Exception as e:
+                print('Warning: unable to renew lease for {}: {}'.format(self._hash, str(e)))
+
+    def _renew_lease(self, *, released: bool) -> None:
+        # lease_hash rather than hash, so that the lookups of hither_result
+        # messages by hash never see these
+        loggery = _import_loggery()
+        loggery.insert_one(message=dict(
+            name='hither_lease',
+            lease_hash=self._hash,
+            owner=self._id,
+            since=self._since,
+            released=released
+        ))
+
+    def _end_lease(self) -> None:
+        # Deleting the messages of this caller releases its lease. Those that
+        # expired are deleted too, with a margin for the clocks of other hosts.
+        assert self._lease_sec is not None
+        loggery = _import_loggery()
+        try:
+            loggery.delete_many({
+                'message.name': 'hither_lease',
+                'message.lease_hash': self._hash,
+                'message.owner': self._id
+            })
+            loggery.delete_many({
+                'message.name': 'hither_lease',
+                'time': {'$lt': time.time() - 2 * self._lease_sec}
+            })
+        except Exception as e:
+            print('Warning: unable to delete lease messages for {}: {}'.format(self._hash, str(e)))
+            self._renew_lease(released=True)
+
+    def _lease_owner(self) -> Union[str, None]:
+        # The caller that has been waiting longest, among those whose latest
+        # lease message is recent and not a release
+        loggery = _import_loggery()
+        assert self._lease_sec is not None
+        docs = loggery.find({
+            'message.name': 'hither_lease',
+            'message.lease_hash': self._hash,
+            'time': {'$gte': time.time() - self._lease_sec}
+        }, {'message': 1}, sort=[('time', -1)])
+        latest: Dict[str, dict] = dict()
+        for doc in docs:
+            m = doc['message']
+            if m['owner'] not in latest:
+                latest[m['owner']] = m
+        live: List[tuple] = [(m['since'], m['owner']) for m in latest.values() if not m['released']]
+        if len(live) == 0:
+            return None
+        return min(live)[1]
+
+
+def _import_loggery():
+    import loggery
+    loggery.declare_index([('message.name', 1), ('message.lease_hash', 1), ('time', -1)])
+    return loggery
+
+_thread_locks: Dict[str, list] = dict()
+_thread_locks_lock = threading.Lock()
+
+def _acquire_thread_lock(path: str) -> None:
+    # The file lock is reentrant per thread, and an executor thread that
+    # acquired it for one task may be reused by another (see asyncexecution)
+    with _thread_locks_lock:
+        if path not in _thread_locks:
+            _thread_locks[path] = [threading.Lock(), 0]
+        entry = _thread_locks[path]
+        entry[1] = entry[1] + 1
+    entry[0].acquire()
+
+def _release_thread_lock(path: str) -> None:
+    with _thread_locks_lock:
+        entry = _thread_locks[path]
+        entry[0].release()
+        entry[1] = entry[1] - 1
+        if entry[1] == 0:
+            del _thread_locks[path]
+
+def _after_fork_in_child() -> None:
+    # The flights of the parent (e.g., those that the holder threads of
+    # execute_many acquire while the pool forks) are not held by the child
+    global _thread_locks_lock
+    _thread_locks_lock = threading.Lock()
+    _thread_locks.clear()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,234 @@
+import os
+import json
+import fnmatch
+import hashlib
+import inspect
+import shutil
+import threading
+import time
+import uuid
+from typing import Union
+
+from .config import get_config_value, get_hither_dir
+
+# Where the bundle directory is bind mounted (read only) inside the container
+BUNDLE_PATH_INSIDE_CONTAINER = '/hither_bundle'
+
+def bundle_pythonpath(bundle_path: str) -> str:
+    # the PYTHONPATH for running the function from a bundle at bundle_path
+    return '{0}:{0}/function_src/_local_modules'.format(bundle_path)
+
+BUNDLE_PYTHONPATH_INSIDE_CONTAINER = bundle_pythonpath(BUNDLE_PATH_INSIDE_CONTAINER)
+
+# dict(fingerprint, path, touch_time) by function
+_bundles: dict = dict()
+_bundles_lock = threading.Lock()
+
+# Bundles used more recently than this are never removed (a running
+# container may still import from them)
+_bundle_min_age_sec = 24 * 3600
+
+def get_source_bundle(*, name: str, function, additional_files: list=[], local_modules: list=[]) -> str:
+    """Return a directory containing the function_src package for a hither function
+
+    The source tree is walked once per process. After that, the bundle is
+    reused as long as the modification times and sizes of the files that
+    went into it are unchanged (the files of hither itself are not checked
+    again), so a file that is added without changing any of those is only
+    picked up after clear_source_bundle_cache(). The bundle directory is
+    named by the hash of its content and is written once to a shared staging
+    directory (~/.hither/source_bundles), so that identical bundles are
+    shared between runs and processes. The least recently used bundles
+    beyond the source_bundle_max_count config value are removed.
+    """
+    function_source_fname = _get_function_source_fname(name=name, function=function)
+    key = (function_source_fname, name, tuple(additional_files), tuple(local_modules))
+    with _bundles_lock:
+        entry = _bundles.get(key, None)
+    if entry is not None and _is_unchanged(entry['fingerprint']) and os.path.exists(entry['path']):
+        if time.time() - entry['touch_time'] > 600:
+            # the last use, for the LRU eviction
+            _touch(entry['path'])
+            with _bundles_lock:
+                _bundles[key] = dict(entry, touch_time=time.time())
+        return entry['path']
+    fingerprint = _source_fingerprint(function_source_fname=function_source_fname, additional_files=additional_files, local_modules=local_modules)
+    code = _generate_function_code(name=name, function=function, additional_files=additional_files, local_modules=local_modules)
+    code_hash = hashlib.sha1(json.dumps(code, sort_keys=True).encode('utf-8')).hexdigest()
+    bundle_path = os.path.join(get_hither_dir('source_bundles'), code_hash)
+    if not os.path.exists(bundle_path):
+        # write to a temporary location and rename so that concurrent writers never see a partial bundle
+        tmp_path = '{}.tmp.{}'.format(bundle_path, uuid.uuid4().hex)
+        os.mkdir(tmp_path)
+        _write_python_code_to_directory(os.path.join(tmp_path, 'function_src'), code)
+        try:
+            os.rename(tmp_path, bundle_path)
+        except OSError:
+            # another process got there first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        evict_source_bundles()
+    _touch(bundle_path)
+    with _bundles_lock:
+        _bundles[key] = dict(fingerprint=fingerprint, path=bundle_path, touch_time=time.time())
+    return bundle_path
+
+def clear_source_bundle_cache() -> None:
+    """Forget the bundles built by this process, so that the sources are read again"""
+    with _bundles_lock:
+        _bundles.clear()
+
+def evict_source_bundles(*, max_count: Union[int, None]=None) -> int:
+    """Remove the least recently used source bundles until at most max_count
+    remain (by default the source_bundle_max_count config value). Bundles used
+    within the last day are kept. Returns the number of bundles removed."""
+    if max_count is None:
+        max_count = get_config_value('source_bundle_max_count')
+    directory = get_hither_dir('source_bundles')
+    bundles = []
+    for fname in os.listdir(directory):
+        if len(fname) == 40 and '.' not in fname:
+            try:
+                bundles.append((os.stat(os.path.join(directory, fname)).st_mtime, fname))
+            except FileNotFoundError:
+                continue
+    bundles.sort()
+    num_removed = 0
+    for mtime, fname in bundles[:max(0, len(bundles) - max_count)]:
+        if time.time() - mtime < _bundle_min_age_sec:
+            break
+        # renamed first, so that a bundle is never seen partially removed
+        path = os.path.join(directory, fname)
+        trash_path = '{}.del.{}'.format(path, uuid.uuid4().hex)
+        try:
+            os.rename(path, trash_path)
+        except OSError:
+            continue
+        shutil.rmtree(trash_path, ignore_errors=True)
+        num_removed = num_removed + 1
+    return num_removed
+
+def _touch(path: str) -> None:
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def _get_function_source_fname(*, name: str, function) -> str:
+    try:
+        return os.path.abspath(inspect.getsourcefile(function))
+    except:
+        raise Exception('Unable to get source file for function {}. Cannot run in a container.'.format(name))
+
+def _generate_function_code(*, name: str, function, additional_files: list, local_modules: list) -> dict:
+    function_source_fname = _get_function_source_fname(name=name, function=function)
+
+    function_source_dirname = os.path.dirname(function_source_fname)
+    function_source_basename = os.path.basename(function_source_fname)
+    function_source_basename_noext = os.path.splitext(function_source_basename)[0]
+    code = _read_python_code_of_directory(
+        function_source_dirname,
+        additional_files=additional_files,
+        exclude_init=True
+    )
+    code['files'].append(dict(
+        name='__init__.py',
+        content='from .{} import {}'.format(
+            function_source_basename_noext, name)
+    ))
+    hither_dir = os.path.dirname(os.path.realpath(__file__))
+    code['dirs'].append(dict(
+        name='_local_modules',
+        content=dict(
+            files=[],
+            dirs=[
+                dict(
+                    name=os.path.basename(local_module_path),
+                    content=_read_python_code_of_directory(os.path.join(function_source_dirname, local_module_path), exclude_init=False)
+                )
+                for local_module_path in local_modules + [hither_dir]
+            ]
+        )
+    ))
+    return code
+
+def _source_fingerprint(*, function_source_fname: str, additional_files: list, local_modules: list) -> tuple:
+    # The paths, modification times and sizes of the files of the function
+    # and its local modules that go into the bundle (see
+    # _generate_function_code), taken before they are read
+    function_source_dirname = os.path.dirname(function_source_fname)
+    stats: list = []
+    _stat_python_code_of_directory(function_source_dirname, exclude_init=True, additional_files=additional_files, stats=stats)
+    for local_module_path in local_modules:
+        _stat_python_code_of_directory(os.path.join(function_source_dirname, local_module_path), exclude_init=False, additional_files=[], stats=stats)
+    return tuple(stats)
+
+def _is_unchanged(fingerprint: tuple) -> bool:
+    # one stat per file, without listing the directories again
+    for path, mtime_ns, size in fingerprint:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return False
+        if (st.st_mtime_ns, st.st_size) != (mtime_ns, size):
+            return False
+    return True
+
+def _stat_python_code_of_directory(dirname: str, *, exclude_init: bool, additional_files: list, stats: list) -> None:
+    patterns = ['*.py'] + additional_files
+    with os.scandir(dirname) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            if entry.is_file():
+                if _matches(entry.name, patterns, exclude_init=exclude_init):
+                    st = entry.stat()
+                    stats.append((entry.path, st.st_mtime_ns, st.st_size))
+            elif entry.is_dir():
+                if (not entry.name.startswith('__')) and (not entry.name.startswith('.')):
+                    _stat_python_code_of_directory(entry.path, exclude_init=False, additional_files=additional_files, stats=stats)
+
+def _matches(fname: str, patterns: list, *, exclude_init: bool) -> bool:
+    if exclude_init and (fname == '__init__.py'):
+        return False
+    for pattern in patterns:
+        if fnmatch.fnmatch(fname, pattern):
+            return True
+    return False
+
+def _read_python_code_of_directory(dirname, exclude_init, additional_files=[]):
+    patterns = ['*.py'] + additional_files
+    files = []
+    dirs = []
+    for fname in os.listdir(dirname):
+        if os.path.isfile(dirname + '/' + fname):
+            if _matches(fname, patterns, exclude_init=exclude_init):
+                with open(dirname + '/' + fname) as f:
+                    txt = f.read()
+                files.append(dict(
+                    name=fname,
+                    content=txt
+                ))
+        elif os.path.isdir(dirname + '/' + fname):
+            if (not fname.startswith('__')) and (not fname.startswith('.')):
+                content = _read_python_code_of_directory(
+                    dirname + '/' + fname, additional_files=additional_files, exclude_init=False)
+                if len(content['files']) + len(content['dirs']) > 0:
+                    dirs.append(dict(
+                        name=fname,
+                        content=content
+                    ))
+    return dict(
+        files=files,
+        dirs=dirs
+    )
+
+def _write_python_code_to_directory(dirname: str, code: dict) -> None:
+    if os.path.exists(dirname):
+        raise Exception(
+            'Cannot write code to already existing directory: {}'.format(dirname))
+    os.mkdir(dirname)
+    for item in code['files']:
+        fname0 = dirname + '/' + item['name']
+        with open(fname0, 'w') as f:
+            f.write(item['content'])
+    for item in code['dirs']:
+        _write_python_code_to_directory(
+            dirname + '/' + item['name'], item['content'])
@@ -0,0 +1,41 @@
+import os
+import sqlite3
+import threading
+from typing import List
+
+
+class SQLiteDB():
+    def __init__(self, path: str, schema: List[str]):
+        """A sqlite database file with one connection per thread
+
+        The database is opened in WAL mode so that readers in other processes
+        are not blocked by a writer.
+
+        Parameters
+        ----------
+        path : str
+            Path to the database file (parent directories are created)
+        schema : List[str]
+            SQL statements (e.g., CREATE TABLE IF NOT EXISTS ...) executed
+            once per connection
+        """
+        self._path = path
+        self._schema = schema
+        self._local = threading.local()
+
+    def path(self) -> str:
+        return self._path
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            dirname = os.path.dirname(self._path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            conn = sqlite3.connect(self._path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            for statement in self._schema:
+                conn.execute(statement)
+            self._local.conn = conn
+        return conn
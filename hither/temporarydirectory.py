@@ -5,13 +5,16 @@ import time
 
 
 class TemporaryDirectory():
-    def __init__(self, remove=True, prefix='tmp'):
+    def __init__(self, remove=True, prefix='tmp', dir=None):
         self._remove = remove
         self._prefix = prefix
+        self._dir = dir
 
     def __enter__(self) -> str:
         sha1_cache_dir = os.environ.get('SHA1_CACHE_DIR', os.environ.get('KBUCKET_CACHE_DIR', None))
-        if sha1_cache_dir:
+        if self._dir is not None:
+            dirpath = self._dir
+        elif sha1_cache_dir:
             dirpath = os.path.join(sha1_cache_dir, 'tmp')
             if not os.path.exists(dirpath):
                 os.mkdir(dirpath)
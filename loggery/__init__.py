@@ -1,2 +1,4 @@
 from .core import set_config
-from .core import insert_one, find_one
+from .core import insert_one, insert_many, find_one, find, count, delete_many, flush
+from .core import declare_index
+from .sync import push, pull
@@ -0,0 +1,42 @@
+import sys
+import json
+import argparse
+
+from .core import set_config
+from .sync import push, pull
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m loggery', description='loggery command line tools')
+    subparsers = parser.add_subparsers(dest='command')
+    parser_sync = subparsers.add_parser('sync', help='Push/pull new messages between the local store and a remote collection')
+    parser_sync.add_argument('direction', choices=['push', 'pull'])
+    parser_sync.add_argument('--preset', help='Preset configuration of the remote collection (e.g., default_readwrite)', default=None)
+    parser_sync.add_argument('--url', help='Url of the remote database', default=None)
+    parser_sync.add_argument('--database', help='Remote database name', default=None)
+    parser_sync.add_argument('--collection', help='Remote collection name', default=None)
+    parser_sync.add_argument('--local-url', help='Url of the local store (default: sqlite:// for ~/.loggery/local.db)', default='sqlite://')
+    parser_sync.add_argument('--query', help='Only sync messages matching this (JSON) query', default=None)
+    parser_sync.add_argument('--batch-size', help='Number of messages per bulk write', type=int, default=1000)
+    parser_sync.add_argument('--no-dedupe', help='Do not skip messages whose message.name and message.hash are already present', action='store_true')
+    parser_sync.add_argument('--checkpoint', help='Path of the checkpoint file (default: ~/.loggery/sync_checkpoints.json)', default=None)
+
+    args = parser.parse_args()
+    if args.command != 'sync':
+        parser.print_help()
+        sys.exit(1)
+
+    # the remote collection is given by the configuration
+    set_config(args.preset, url=args.url, database=args.database, collection=args.collection)
+    fn = push if args.direction == 'push' else pull
+    stats = fn(
+        local=dict(url=args.local_url),
+        query=json.loads(args.query) if args.query else None,
+        batch_size=args.batch_size,
+        dedupe_fields=None if args.no_dedupe else ['message.name', 'message.hash'],
+        checkpoint_path=args.checkpoint,
+        verbose=True
+    )
+    print(json.dumps(stats, indent=4))
+
+if __name__ == '__main__':
+    main()
@@ -1,44 +1,468 @@
 import os
-from typing import Union, Tuple, Optional, List, Dict
+from typing import Any, Union, Tuple, Optional, List, Dict, Iterator
 import json
 import hashlib
 import time
-import pymongo
+import atexit
+import re
+import sqlite3
+import threading
 from etconf import ETConf
 
-class _MongoClient:
+# Indexes ensured on every collection that is used (see declare_index)
+_declared_indexes: List[List[Tuple[str, int]]] = [
+    [('time', -1)]
+]
+
+class _Backend:
+    # Interface implemented by the storage backends (see _Client._get_backend).
+    # Documents have the form dict(time=..., message=...) and queries use
+    # dotted paths into the document (e.g., 'message.hash')
+    def insert_docs(self, docs: List[dict]) -> None:
+        raise NotImplementedError
+    def find(self, *, query: dict, projection: Optional[dict], sort: List[Tuple[str, int]], limit: Optional[int], batch_size: Optional[int]) -> Iterator[dict]:
+        raise NotImplementedError
+    def count(self, query: dict) -> int:
+        raise NotImplementedError
+    def delete(self, query: dict) -> int:
+        raise NotImplementedError
+    def ensure_index(self, keys: List[Tuple[str, int]]) -> None:
+        raise NotImplementedError
+
+class _MongoBackend(_Backend):
+    def __init__(self, collection):
+        self._collection = collection
+    def insert_docs(self, docs):
+        self._collection.insert_many(docs, ordered=False)
+    def find(self, *, query, projection, sort, limit, batch_size):
+        cursor = self._collection.find(query, projection).sort(sort)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        if batch_size is not None:
+            cursor = cursor.batch_size(batch_size)
+        try:
+            for doc in cursor:
+                yield doc
+        finally:
+            cursor.close()
+    def count(self, query):
+        return self._collection.count_documents(query)
+    def delete(self, query):
+        return self._collection.delete_many(query).deleted_count
+    def ensure_index(self, keys):
+        self._collection.create_index(keys, background=True)
+
+class _SQLiteBackend(_Backend):
+    # Embedded backend: a single SQLite database in WAL mode, which may be
+    # shared by several processes. Documents are stored as JSON and the
+    # declared indexes become expression indexes on json_extract(...).
+    def __init__(self, path: str, *, database: str, collection: str):
+        self._path = path
+        self._database = database
+        self._collection = collection
+        self._local = threading.local()
+    def insert_docs(self, docs):
+        rows = [(self._database, self._collection, doc['time'], json.dumps(doc)) for doc in docs]
+        conn = self._connection()
+        with conn:
+            conn.executemany('INSERT INTO messages (db, collection, time, doc) VALUES (?, ?, ?, ?)', rows)
+    def find(self, *, query, projection, sort, limit, batch_size):
+        where, params = self._where(query)
+        # With a filter, the unary + keeps the planner from choosing an index
+        # only because it provides the order (there are no statistics)
+        prefix = '+' if len(query) > 0 else ''
+        order = ', '.join(['{}{} {}'.format(prefix, _sql_field(k), 'DESC' if d < 0 else 'ASC') for k, d in sort])
+        # later inserts win ties (e.g., documents inserted with the same time)
+        tie_break = 'id DESC' if len(sort) == 0 or sort[-1][1] < 0 else 'id ASC'
+        sql = 'SELECT doc FROM messages WHERE {} ORDER BY {}'.format(where, ', '.join([x for x in [order, tie_break] if x]))
+        if limit is not None:
+            sql = sql + ' LIMIT {}'.format(int(limit))
+        cursor = self._connection().execute(sql, params)
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size or 1000)
+                if len(rows) == 0:
+                    break
+                for row in rows:
+                    yield _apply_projection(json.loads(row[0]), projection)
+        finally:
+            cursor.close()
+    def count(self, query):
+        where, params = self._where(query)
+        return self._connection().execute('SELECT COUNT(*) FROM messages WHERE {}'.format(where), params).fetchone()[0]
+    def delete(self, query):
+        where, params = self._where(query)
+        conn = self._connection()
+        with conn:
+            return conn.execute('DELETE FROM messages WHERE {}'.format(where), params).rowcount
+    def ensure_index(self, keys):
+        name = 'idx_' + hashlib.sha1(json.dumps(keys).encode('utf-8')).hexdigest()[:16]
+        self._connection().execute('CREATE INDEX IF NOT EXISTS {} ON messages (db, collection, {})'.format(
+            name, ', '.join(['{} {}'.format(_sql_field(k), 'DESC' if d < 0 else 'ASC') for k, d in keys])
+        ))
+    def _where(self, query: dict) -> Tuple[str, list]:
+        conditions = ['db = ?', 'collection = ?']
+        params: list = [self._database, self._collection]
+        for key, value in query.items():
+            field = _sql_field(key)
+            if isinstance(value, dict) and any(k.startswith('$') for k in value.keys()):
+                for op, arg in value.items():
+                    if op == '$in':
+                        if len(arg) == 0:
+                            conditions.append('0')
+                        else:
+                            conditions.append('{} IN ({})'.format(field, ', '.join(['?'] * len(arg))))
+                            params.extend([_sql_value(a) for a in arg])
+                    elif op in _SQL_COMPARISONS:
+                        conditions.append('{} {} ?'.format(field, _SQL_COMPARISONS[op]))
+                        params.append(_sql_value(arg))
+                    elif op == '$exists':
+                        conditions.append('json_type(doc, {}) IS {}NULL'.format(_json_path_literal(key), 'NOT ' if arg else ''))
+                    else:
+                        raise Exception('Unsupported query operator for the local loggery backend: {}'.format(op))
+            elif value is None:
+                conditions.append('{} IS NULL'.format(field))
+            else:
+                conditions.append('{} = ?'.format(field))
+                params.append(_sql_value(value))
+        return ' AND '.join(conditions), params
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            dirname = os.path.dirname(self._path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            conn = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    db TEXT NOT NULL,
+                    collection TEXT NOT NULL,
+                    time REAL NOT NULL,
+                    doc TEXT NOT NULL
+                )
+            ''')
+            self._local.connection = conn
+        return conn
+
+_SQL_COMPARISONS = {'$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}
+
+def _json_path_literal(key: str) -> str:
+    # inlined rather than bound, so that the expressions match those of the indexes
+    if not re.match(r'^[A-Za-z0-9_]+(\.[A-Za-z0-9_]+)*$', key):
+        raise Exception('Unsupported field for the local loggery backend: {}'.format(key))
+    return "'$.{}'".format(key)
+
+def _sql_field(key: str) -> str:
+    if key == 'time':
+        return 'time'
+    return 'json_extract(doc, {})'.format(_json_path_literal(key))
+
+def _sql_value(value):
+    # json_extract returns objects and arrays as (minified) JSON text
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, separators=(',', ':'))
+    return value
+
+def _apply_projection(doc: dict, projection: Optional[dict]) -> dict:
+    if not projection:
+        return doc
+    if all(projection.values()):
+        ret: dict = dict()
+        for key in projection.keys():
+            src = doc
+            dst = ret
+            parts = key.split('.')
+            for i, k in enumerate(parts):
+                if not isinstance(src, dict) or k not in src:
+                    break
+                if i == len(parts) - 1:
+                    dst[k] = src[k]
+                else:
+                    src = src[k]
+                    dst = dst.setdefault(k, dict())
+        return ret
+    for key in projection.keys():
+        parts = key.split('.')
+        d = doc
+        for k in parts[:-1]:
+            d = d.get(k, None) if isinstance(d, dict) else None
+        if isinstance(d, dict):
+            d.pop(parts[-1], None)
+    return doc
+
+def _sqlite_path_from_url(url: str) -> str:
+    # sqlite:///abs/path.db, sqlite://~/path.db, or sqlite:// for the default
+    path = url[len('sqlite://'):]
+    if not path:
+        return os.path.join(os.path.expanduser('~'), '.loggery', 'local.db')
+    return os.path.abspath(os.path.expanduser(path))
+
+class _Client:
+    # Registry of backends keyed by the resolved url, database and
+    # collection. Each MongoDB url gets one pymongo.MongoClient, which is
+    # thread safe and maintains its own connection pool, so the backends are
+    # shared by all threads and never recreated.
     def __init__(self):
-        self._url = None
-        self._client = None
+        self._backends: Dict[tuple, _Backend] = dict()
+        self._mongo_clients: Dict[tuple, Any] = dict()
+        self._num_ensured_indexes: Dict[tuple, int] = dict()
+        self._lock = threading.Lock()
     def insert_one(self, *, message, config):
-        db = self._get_db(config)
-        if not db:
-            return None
-        doc = dict(
-            time=time.time() - 0,
-            message=message
-        )
-        db.insert_one(doc)
-    def find_one(self, *, query, config):
-        db = self._get_db(config)
-        if not db:
+        self.insert_docs(docs=[dict(time=time.time() - 0, message=message)], config=config)
+    def insert_many(self, *, messages, config):
+        t = time.time() - 0
+        self.insert_docs(docs=[dict(time=t, message=message) for message in messages], config=config)
+    def insert_docs(self, *, docs, config):
+        if len(docs) == 0:
             return None
-        for doc in db.find(query).sort('time', direction=pymongo.DESCENDING):
+        self._get_backend(config).insert_docs(docs)
+    def find_one(self, *, query, projection=None, config):
+        for doc in self.find(query=query, projection=projection, limit=1, config=config):
             return doc
-    def _get_db(self, config):
-        if not config['url']:
-            return None
-        url = config['url']
-        if config['password'] is not None:
-            url = url.replace('${password}', config['password'])
-        if url != self._url:
-            if self._client is not None:
-                self._client.close()
-            self._client = pymongo.MongoClient(url, retryWrites=False)
-            self._url = url
-        return self._client[config['database']][config['collection']]
-
-_global_client = _MongoClient()
+        return None
+    def find(self, *, query, projection=None, sort=None, limit=None, batch_size=None, config):
+        backend = self._get_backend(config)
+        return backend.find(
+            query=query, projection=projection,
+            sort=sort if sort is not None else [('time', -1)],
+            limit=limit, batch_size=batch_size
+        )
+    def count(self, *, query, config):
+        return self._get_backend(config).count(query)
+    def delete_many(self, *, query, config):
+        return self._get_backend(config).delete(query)
+    def close(self):
+        with self._lock:
+            clients = list(self._mongo_clients.values())
+            self._mongo_clients.clear()
+            self._backends.clear()
+            self._num_ensured_indexes.clear()
+        for client in clients:
+            client.close()
+    def _get_backend(self, config) -> _Backend:
+        key = _backend_key(config)
+        backend = self._backends.get(key, None)
+        if backend is None:
+            with self._lock:
+                backend = self._backends.get(key, None)
+                if backend is None:
+                    backend = self._create_backend(key, config)
+                    self._backends[key] = backend
+        if self._num_ensured_indexes.get(key, 0) < len(_declared_indexes):
+            self._ensure_indexes(backend, key)
+        return backend
+    def _create_backend(self, key: tuple, config) -> _Backend:
+        # must be called with the lock held
+        kind, url, database, collection = key[:4]
+        if kind == 'sqlite':
+            return _SQLiteBackend(url, database=database, collection=collection)
+        client_key = (url,) + key[4:]
+        client = self._mongo_clients.get(client_key, None)
+        if client is None:
+            # imported on first use, so that the local backend does not pay for it
+            import pymongo
+            client = pymongo.MongoClient(
+                url,
+                retryWrites=False,
+                maxPoolSize=config['max_pool_size'],
+                connectTimeoutMS=_to_ms(config['connect_timeout_sec']),
+                serverSelectionTimeoutMS=_to_ms(config['server_selection_timeout_sec']),
+                socketTimeoutMS=_to_ms(config['socket_timeout_sec'])
+            )
+            self._mongo_clients[client_key] = client
+        return _MongoBackend(client[database][collection])
+    def _ensure_indexes(self, backend: _Backend, key: tuple):
+        with self._lock:
+            num_ensured = self._num_ensured_indexes.get(key, 0)
+            to_ensure = _declared_indexes[num_ensured:]
+            self._num_ensured_indexes[key] = num_ensured + len(to_ensure)
+        for keys in to_ensure:
+            try:
+                backend.ensure_index(keys)
+            except Exception as e:
+                # e.g., read-only credentials
+                print('Warning: loggery was unable to ensure index {}: {}'.format(keys, e))
+
+def _backend_key(config) -> tuple:
+    # without a url, messages go to the default embedded database
+    url = config['url'] or 'sqlite://'
+    if url.startswith('sqlite://'):
+        return ('sqlite', _sqlite_path_from_url(url), config['database'], config['collection'])
+    if config['password'] is not None:
+        url = url.replace('${password}', config['password'])
+    # the client options are included so that changing them takes effect
+    return (
+        'mongo', url, config['database'], config['collection'],
+        config['max_pool_size'], config['connect_timeout_sec'], config['server_selection_timeout_sec'], config['socket_timeout_sec']
+    )
+
+def _to_ms(sec: Optional[float]) -> Optional[int]:
+    if sec is None:
+        return None
+    return int(sec * 1000)
+
+_global_client = _Client()
+
+class _BufferedWriter:
+    # Collects messages and writes them with bulk inserts from a background
+    # thread, once max_messages are pending or the oldest has waited
+    # max_delay_sec (or on flush)
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending: List[Tuple[tuple, dict, dict]] = []
+        # the batch that the background thread is writing
+        self._in_flight: List[Tuple[tuple, dict, dict]] = []
+        self._oldest_time = None
+        self._num_enqueued = 0
+        # messages that were written or failed to be written
+        self._num_done = 0
+        # the first write error since it was last reported (see _raise_error)
+        self._error: Optional[Exception] = None
+        self._flush_requested = False
+        self._max_messages = 500
+        self._max_delay_sec = 1.0
+        self._thread: Optional[threading.Thread] = None
+    def enqueue(self, *, docs, config):
+        key = _writer_key(config)
+        with self._cond:
+            # an earlier write error is not raised here, since the caller's
+            # messages would then be lost (see flush)
+            self._max_messages = config['write_buffer_max_messages']
+            self._max_delay_sec = config['write_buffer_max_delay_sec']
+            for doc in docs:
+                self._pending.append((key, config, doc))
+            if self._oldest_time is None:
+                self._oldest_time = time.time()
+            self._num_enqueued = self._num_enqueued + len(docs)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='loggery-writer', daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+    def num_pending(self):
+        with self._cond:
+            return self._num_enqueued - self._num_done
+    def flush(self, timeout=None):
+        with self._cond:
+            target = self._num_enqueued
+            if self._num_done < target:
+                self._flush_requested = True
+                self._cond.notify_all()
+                if not self._cond.wait_for(lambda: self._num_done >= target, timeout=timeout):
+                    return False
+            self._raise_error()
+            return True
+    def wait_for_matching(self, *, query, config):
+        # Waits until the pending messages are written if any of them match
+        # the query (so that a read sees the writes of this process). Write
+        # errors are left for flush to report.
+        key = _writer_key(config)
+        with self._cond:
+            if not any([k == key and _matches_query(doc, query) for k, _, doc in self._pending + self._in_flight]):
+                return
+            target = self._num_enqueued
+            self._flush_requested = True
+            self._cond.notify_all()
+            self._cond.wait_for(lambda: self._num_done >= target)
+    def _raise_error(self):
+        # called with the condition held
+        if self._error is not None:
+            e = self._error
+            self._error = None
+            raise e
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if len(self._pending) > 0:
+                        if self._flush_requested or len(self._pending) >= self._max_messages:
+                            break
+                        remaining = self._oldest_time + self._max_delay_sec - time.time()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(timeout=remaining)
+                    else:
+                        self._cond.wait()
+                batch = self._pending
+                self._pending = []
+                self._in_flight = batch
+                self._oldest_time = None
+                self._flush_requested = False
+            groups: Dict[tuple, Tuple[dict, list]] = dict()
+            for key, config, doc in batch:
+                if key not in groups:
+                    groups[key] = (config, [])
+                groups[key][1].append(doc)
+            errors = []
+            for config, docs in groups.values():
+                try:
+                    _global_client.insert_docs(docs=docs, config=config)
+                except Exception as e:
+                    print('Warning: loggery was unable to write {} buffered messages: {}'.format(len(docs), e))
+                    errors.append(Exception('loggery was unable to write {} buffered messages: {}'.format(len(docs), e)))
+            with self._cond:
+                if len(errors) > 0 and self._error is None:
+                    self._error = errors[0]
+                self._num_done = self._num_done + len(batch)
+                self._in_flight = []
+                self._cond.notify_all()
+
+def _writer_key(config) -> tuple:
+    return (config['url'], config['password'], config['database'], config['collection'])
+
+def _matches_query(doc: dict, query: dict) -> bool:
+    # Whether a document matches a query, for the operators supported by the
+    # local backend. When in doubt (e.g., another operator), True.
+    for key, value in query.items():
+        x = doc
+        found = True
+        for k in key.split('.'):
+            if isinstance(x, dict) and k in x:
+                x = x[k]
+            else:
+                x = None
+                found = False
+                break
+        try:
+            if isinstance(value, dict) and any(k.startswith('$') for k in value.keys()):
+                for op, arg in value.items():
+                    if op == '$in':
+                        ok = x in arg
+                    elif op == '$exists':
+                        ok = found == bool(arg)
+                    elif op == '$gt':
+                        ok = found and x > arg
+                    elif op == '$gte':
+                        ok = found and x >= arg
+                    elif op == '$lt':
+                        ok = found and x < arg
+                    elif op == '$lte':
+                        ok = found and x <= arg
+                    else:
+                        ok = True
+                    if not ok:
+                        return False
+            elif x != value:
+                return False
+        except TypeError:
+            # e.g., comparing a string with a number
+            pass
+    return True
+
+_global_writer = _BufferedWriter()
+
+def _after_fork_in_child() -> None:
+    # The writer thread does not exist in the child (and its lock may be
+    # held), while the pending messages are written by the parent. The
+    # connections of the parent are not used in the child either. Reset in
+    # place, since other modules hold references (see sync).
+    _global_client.__init__()
+    _global_writer.__init__()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
 
 _global_config = ETConf(
     defaults=dict(
@@ -46,7 +470,13 @@ _global_config = ETConf(
         database='loggery',
         collection='default',
         password=None,
-        verbose=False
+        verbose=False,
+        write_buffer_max_messages=500,
+        write_buffer_max_delay_sec=1.0,
+        max_pool_size=100,
+        connect_timeout_sec=20.0,
+        server_selection_timeout_sec=30.0,
+        socket_timeout_sec=None
     ),
     config_dir=os.path.join(os.path.expanduser("~"), '.loggery'),
     preset_config_url='https://raw.githubusercontent.com/magland/experitools/config/config/loggery_2019a.json'
@@ -58,13 +488,82 @@ def set_config(
         database: Union[str, None]=None,
         collection: Union[str, None]=None,
         password: Union[str, None]=None,
-        verbose: Union[bool, None]=None
+        verbose: Union[bool, None]=None,
+        write_buffer_max_messages: Union[int, None]=None,
+        write_buffer_max_delay_sec: Union[float, None]=None,
+        max_pool_size: Union[int, None]=None,
+        connect_timeout_sec: Union[float, None]=None,
+        server_selection_timeout_sec: Union[float, None]=None,
+        socket_timeout_sec: Union[float, None]=None
 ) -> None:
-    _global_config.set_config(preset, url=url, database=database, collection=collection, password=password, verbose=verbose)
+    _global_config.set_config(
+        preset, url=url, database=database, collection=collection, password=password, verbose=verbose,
+        write_buffer_max_messages=write_buffer_max_messages, write_buffer_max_delay_sec=write_buffer_max_delay_sec,
+        max_pool_size=max_pool_size, connect_timeout_sec=connect_timeout_sec,
+        server_selection_timeout_sec=server_selection_timeout_sec, socket_timeout_sec=socket_timeout_sec
+    )
+
+def insert_one(message: dict, *, buffered: bool=False):
+    """Insert a message. If buffered, it is written later by a background
+    bulk insert (see flush). A failure to write buffered messages is printed
+    as a warning when it happens and raised by the next flush."""
+    if buffered:
+        return insert_many([message], buffered=True)
+    return _global_client.insert_one(message=message, config=_global_config.get_config(copy=False))
+
+def insert_many(messages: List[dict], *, buffered: bool=False):
+    """Insert several messages with a single bulk write (or buffer them)"""
+    config = _global_config.get_config(copy=False)
+    if buffered:
+        t = time.time() - 0
+        _global_writer.enqueue(docs=[dict(time=t, message=message) for message in messages], config=config)
+        return None
+    return _global_client.insert_many(messages=messages, config=config)
+
+def flush(timeout: Optional[float]=None) -> bool:
+    """Wait until all previously buffered messages have been written.
+    Returns False on timeout. Raises an exception if buffered messages could
+    not be written (since the last flush)."""
+    return _global_writer.flush(timeout=timeout)
+
+def find_one(query, projection: Optional[dict]=None):
+    """Return the most recent document matching the query (or None)"""
+    config = _global_config.get_config(copy=False)
+    _global_writer.wait_for_matching(query=query, config=config)
+    return _global_client.find_one(query=query, projection=projection, config=config)
+
+def find(query, projection: Optional[dict]=None, *, sort: Optional[List[Tuple[str, int]]]=None, limit: Optional[int]=None, batch_size: Optional[int]=None):
+    """Iterate over the matching documents (most recent first unless sort is given)
+
+    The results are streamed from the server in batches of batch_size.
+    """
+    config = _global_config.get_config(copy=False)
+    _global_writer.wait_for_matching(query=query, config=config)
+    return _global_client.find(query=query, projection=projection, sort=sort, limit=limit, batch_size=batch_size, config=config)
+
+def count(query) -> int:
+    config = _global_config.get_config(copy=False)
+    _global_writer.wait_for_matching(query=query, config=config)
+    return _global_client.count(query=query, config=config)
+
+def delete_many(query) -> int:
+    """Delete the matching documents and return how many were deleted
+
+    Intended for messages that are only of use for a limited time (e.g.,
+    leases). Copies made by push/pull are not affected.
+    """
+    config = _global_config.get_config(copy=False)
+    _global_writer.wait_for_matching(query=query, config=config)
+    return _global_client.delete_many(query=query, config=config)
+
+def declare_index(keys: List[Tuple[str, int]]) -> None:
+    """Declare a (compound) index that loggery ensures on the collections it uses
 
-def insert_one(message: dict):
-    return _global_client.insert_one(message=message, config=_global_config.get_config())
+    Example: declare_index([('message.name', 1), ('message.hash', 1), ('time', -1)])
+    """
+    keys = [(k, d) for k, d in keys]
+    if keys not in _declared_indexes:
+        _declared_indexes.append(keys)
 
-def find_one(query):
-    return _global_client.find_one(query=query, config=_global_config.get_config())
+atexit.register(flush)
 
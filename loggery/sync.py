@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import hashlib
+from collections import Counter
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+from etconf.ettools import _read_json_file, _write_json_file
+from etconf.filelock import FileLock
+from .core import _global_client, _global_config, _backend_key, declare_index, flush
+
+_LOCAL = dict(url='sqlite://')
+
+def push(*, local: Optional[dict]=None, remote: Optional[dict]=None, query: Optional[dict]=None, batch_size: int=1000, dedupe_fields: Optional[List[str]]=['message.name', 'message.hash'], overlap_sec: float=300.0, checkpoint_path: Optional[str]=None, verbose: bool=False) -> dict:
+    """Copy the new messages of the local store to the remote collection
+
+    See sync(). local defaults to the default embedded database and remote
+    to the current configuration (see set_config).
+    """
+    return sync(
+        source=local if local is not None else _LOCAL, target=remote if remote is not None else dict(),
+        query=query, batch_size=batch_size, dedupe_fields=dedupe_fields, overlap_sec=overlap_sec, checkpoint_path=checkpoint_path, verbose=verbose
+    )
+
+def pull(*, local: Optional[dict]=None, remote: Optional[dict]=None, query: Optional[dict]=None, batch_size: int=1000, dedupe_fields: Optional[List[str]]=['message.name', 'message.hash'], overlap_sec: float=300.0, checkpoint_path: Optional[str]=None, verbose: bool=False) -> dict:
+    """Copy the new messages of the remote collection to the local store
+
+    See sync() and push().
+    """
+    return sync(
+        source=remote if remote is not None else dict(), target=local if local is not None else _LOCAL,
+        query=query, batch_size=batch_size, dedupe_fields=dedupe_fields, overlap_sec=overlap_sec, checkpoint_path=checkpoint_path, verbose=verbose
+    )
+
+def sync(*, source: dict, target: dict, query: Optional[dict]=None, batch_size: int=1000, dedupe_fields: Optional[List[str]]=['message.name', 'message.hash'], overlap_sec: float=300.0, checkpoint_path: Optional[str]=None, verbose: bool=False) -> dict:
+    """Incrementally copy messages from one collection to another
+
+    Messages are read in order of time, starting from the high-water mark
+    recorded in the checkpoint file by the previous sync of the same pair of
+    collections, and written in bulk batches. The checkpoint is updated after
+    each batch, so an interrupted sync resumes where it left off.
+
+    Buffered messages are stamped with the time at which they were enqueued,
+    so they may be committed to the source after messages with a later time
+    have been synced. Therefore the messages in a window of overlap_sec
+    before the high-water mark are read again, and those that are not yet in
+    the target (compared by time and content) are copied as well.
+
+    Parameters
+    ----------
+    source, target : dict
+        Overrides of the current configuration (url, database, collection,
+        password), e.g., dict(url='sqlite://') for the default embedded database
+    query : dict or None, optional
+        Only sync the messages matching this query
+    batch_size : int, optional
+        Number of messages per bulk write, by default 1000
+    dedupe_fields : list of str or None, optional
+        Messages whose values of these fields are already present together in
+        a message of the target are skipped, by default ['message.name',
+        'message.hash'] (e.g., a hither result stored by another host).
+        Messages that lack any of the fields are not deduplicated.
+    overlap_sec : float, optional
+        The window before the high-water mark that is read again, by default
+        300. Messages committed to the source later than this after their
+        time are missed.
+    checkpoint_path : str or None, optional
+        By default ~/.loggery/sync_checkpoints.json
+
+    Returns
+    -------
+    dict
+        num_read, num_written, num_duplicates and elapsed_sec
+    """
+    timer = time.time()
+    # buffered writes of this process should be included
+    flush()
+    source_config = _resolve(source)
+    target_config = _resolve(target)
+    if _backend_key(source_config)[:4] == _backend_key(target_config)[:4]:
+        raise Exception('The source and target of a loggery sync must be different collections')
+    if dedupe_fields is not None:
+        declare_index([(field, 1) for field in dedupe_fields])
+    if checkpoint_path is None:
+        checkpoint_path = os.path.join(os.path.expanduser('~'), '.loggery', 'sync_checkpoints.json')
+    os.makedirs(os.path.dirname(os.path.abspath(checkpoint_path)), exist_ok=True)
+    checkpoint_key = _checkpoint_key(source_config, target_config, query)
+    stats = dict(num_read=0, num_written=0, num_duplicates=0, elapsed_sec=0.0)
+    # only one sync at a time per checkpoint file
+    with FileLock(checkpoint_path + '.sync.lock', exclusive=True):
+        mark = _read_checkpoints(checkpoint_path).get(checkpoint_key, dict(time=None))['time']
+        since = mark - overlap_sec if mark is not None else None
+        # the messages up to the mark that are already in the target
+        synced = _fingerprints(config=target_config, query=query, since=since, until=mark) if mark is not None else Counter()
+        for batch in _read_batches(config=source_config, query=query, since=since, batch_size=batch_size):
+            new_docs = _remove_synced(batch, synced=synced, until=mark)
+            docs = _remove_duplicates(new_docs, config=target_config, dedupe_fields=dedupe_fields)
+            # duplicates up to the mark were already counted by an earlier sync
+            written = set([id(doc) for doc in docs])
+            num_recounted = len([doc for doc in new_docs if mark is not None and doc['time'] <= mark and id(doc) not in written])
+            stats['num_read'] = stats['num_read'] + len(new_docs) - num_recounted
+            stats['num_duplicates'] = stats['num_duplicates'] + len(new_docs) - len(docs) - num_recounted
+            _global_client.insert_docs(docs=docs, config=target_config)
+            stats['num_written'] = stats['num_written'] + len(docs)
+            checkpoints = _read_checkpoints(checkpoint_path)
+            checkpoints[checkpoint_key] = dict(time=max(batch[-1]['time'], mark) if mark is not None else batch[-1]['time'])
+            _write_json_file(checkpoints, checkpoint_path)
+            if verbose:
+                print('loggery sync: {} read, {} written, {} duplicates'.format(stats['num_read'], stats['num_written'], stats['num_duplicates']))
+    stats['elapsed_sec'] = time.time() - timer
+    return stats
+
+def _resolve(overrides: dict) -> dict:
+    config = dict(_global_config.get_config())
+    for k, v in overrides.items():
+        if k not in config:
+            raise Exception('Unknown loggery config parameter: {}'.format(k))
+        config[k] = v
+    return config
+
+def _checkpoint_key(source_config: dict, target_config: dict, query: Optional[dict]) -> str:
+    # hashed, so that no credentials are written to the checkpoint file
+    obj = dict(source=list(_backend_key(source_config)[:4]), target=list(_backend_key(target_config)[:4]), query=query)
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode('utf-8')).hexdigest()
+
+def _read_checkpoints(path: str) -> Dict[str, Any]:
+    if not os.path.exists(path):
+        return dict()
+    return _read_json_file(path) or dict()
+
+def _read_batches(*, config: dict, query: Optional[dict], since: Optional[float], batch_size: int) -> Iterator[List[dict]]:
+    query0 = dict(query or dict())
+    if since is not None:
+        query0['time'] = {'$gte': since}
+    batch: List[dict] = []
+    for doc in _global_client.find(query=query0, sort=[('time', 1)], batch_size=batch_size, config=config):
+        batch.append(dict(time=doc['time'], message=doc['message']))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+def _fingerprints(*, config: dict, query: Optional[dict], since: float, until: float) -> Counter:
+    # counted, since the same message may be inserted twice with the same time
+    query0 = dict(query or dict())
+    query0['time'] = {'$gte': since, '$lte': until}
+    return Counter([_fingerprint(doc) for doc in _global_client.find(query=query0, projection={'time': 1, 'message': 1}, config=config)])
+
+def _fingerprint(doc: dict) -> str:
+    obj = dict(time=doc['time'], message=doc['message'])
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def _remove_synced(docs: List[dict], *, synced: Counter, until: Optional[float]) -> List[dict]:
+    ret = []
+    for doc in docs:
+        if until is not None and doc['time'] <= until:
+            fingerprint = _fingerprint(doc)
+            if synced[fingerprint] > 0:
+                synced[fingerprint] = synced[fingerprint] - 1
+                continue
+        ret.append(doc)
+    return ret
+
+def _remove_duplicates(docs: List[dict], *, config: dict, dedupe_fields: Optional[List[str]]) -> List[dict]:
+    if dedupe_fields is None:
+        return docs
+    keys = [_dedupe_key(doc, dedupe_fields) for doc in docs]
+    query = dict()
+    for i, field in enumerate(dedupe_fields):
+        query[field] = {'$in': list(set([key[i] for key in keys if key is not None]))}
+    existing = set()
+    if any(key is not None for key in keys):
+        # the query matches a superset of the keys (each field separately)
+        for doc in _global_client.find(query=query, projection={field: 1 for field in dedupe_fields}, config=config):
+            existing.add(_dedupe_key(doc, dedupe_fields))
+    ret = []
+    for doc, key in zip(docs, keys):
+        if key is not None:
+            if key in existing:
+                continue
+            existing.add(key)
+        ret.append(doc)
+    return ret
+
+def _dedupe_key(doc: dict, fields: List[str]) -> Union[tuple, None]:
+    key = tuple([_get_field(doc, field) for field in fields])
+    if any(v is None for v in key):
+        return None
+    return key
+
+def _get_field(doc: dict, field: str) -> Union[Any, None]:
+    x: Any = doc
+    for k in field.split('.'):
+        if not isinstance(x, dict):
+            return None
+        x = x.get(k, None)
+    if isinstance(x, (dict, list)):
+        return None
+    return x
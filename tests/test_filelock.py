@@ -0,0 +1,58 @@
+import os
+import threading
+import subprocess
+import sys
+
+from etconf.filelock import FileLock
+
+
+def _try_lock_in_other_process(path, *, exclusive):
+    # exit code 0 if the lock was acquired within a short timeout
+    code = 'import sys; from etconf.filelock import FileLock; FileLock(sys.argv[1], exclusive={}, timeout=0.2).acquire()'.format(exclusive)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([p for p in sys.path if p]))
+    return subprocess.run([sys.executable, '-c', code, path], env=env, capture_output=True).returncode
+
+def test_exclusive_lock(tmp_path):
+    path = str(tmp_path / 'a.lock')
+    with FileLock(path, exclusive=True):
+        # reentrant in the same thread
+        with FileLock(path, exclusive=True):
+            pass
+        acquired = []
+        def other_thread():
+            try:
+                FileLock(path, exclusive=True, timeout=0.2).acquire()
+                acquired.append(True)
+            except TimeoutError:
+                acquired.append(False)
+        t = threading.Thread(target=other_thread)
+        t.start()
+        t.join()
+        assert acquired == [False]
+        assert _try_lock_in_other_process(path, exclusive=False) != 0
+    assert _try_lock_in_other_process(path, exclusive=True) == 0
+
+def test_shared_lock(tmp_path):
+    path = str(tmp_path / 'a.lock')
+    with FileLock(path, exclusive=False):
+        assert _try_lock_in_other_process(path, exclusive=False) == 0
+        assert _try_lock_in_other_process(path, exclusive=True) != 0
+
+def test_removed_while_locked(tmp_path):
+    path = str(tmp_path / 'a.lock')
+    lock = FileLock(path, exclusive=True)
+    lock.acquire()
+    waiter_done = threading.Event()
+    def waiter():
+        with FileLock(path, exclusive=True, timeout=10):
+            waiter_done.set()
+    t = threading.Thread(target=waiter)
+    t.start()
+    # the waiter locks the file that is created in place of the removed one
+    os.unlink(path)
+    lock.release()
+    t.join()
+    assert waiter_done.is_set()
+    # and the new file excludes the other processes
+    with FileLock(path, exclusive=True):
+        assert _try_lock_in_other_process(path, exclusive=True) != 0
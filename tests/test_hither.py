@@ -0,0 +1,125 @@
+import os
+import threading
+
+import pytest
+
+import hither
+
+
+# at the top level of this file (with the names of the hither functions),
+# so that they can run in a container
+@hither.function('add', '0.1.0')
+def add(x, y, log_path):
+    # one line per run, so that cache hits can be told apart from runs
+    import time
+    with open(log_path, 'a') as f:
+        f.write('run\n')
+    time.sleep(0.2)
+    return x + y
+
+@hither.function('getpid', '0.1.0')
+@hither.container(default='docker://hither/test-stub')
+def getpid(x):
+    import os
+    return dict(x=x, pid=os.getpid())
+
+@hither.function('append_files', '0.1.0')
+@hither.input_file('path1')
+@hither.input_file('path2')
+@hither.output_file('path_out')
+def append_files(path1, path2, path_out):
+    with open(path1, 'r') as f:
+        txt1 = f.read()
+    with open(path2, 'r') as f:
+        txt2 = f.read()
+    with open(path_out, 'w') as f:
+        f.write(txt1 + txt2)
+
+@hither.function('count_chars', '0.1.0')
+@hither.input_file('fname')
+def count_chars(fname):
+    with open(fname, 'r') as f:
+        return len(f.read())
+
+@pytest.fixture
+def scratch(tmp_path, monkeypatch):
+    # hither stores the results and files with kachery (neither is imported
+    # at the top level of this file, which is also imported by the jobs)
+    pytest.importorskip('kachery')
+    import loggery
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    monkeypatch.setenv('HITHER_DIR', str(tmp_path / 'hither'))
+    monkeypatch.setenv('KACHERY_STORAGE_DIR', str(tmp_path / 'kachery-storage'))
+    os.makedirs(os.environ['KACHERY_STORAGE_DIR'])
+    config0 = hither.get_config()
+    hither.set_config(hither_dir=os.environ['HITHER_DIR'])
+    loggery.set_config(url='sqlite://' + str(tmp_path / 'loggery.db'), database='test', collection='test')
+    try:
+        yield tmp_path
+        loggery.flush()
+    finally:
+        from hither.containerworker import shutdown_warm_workers
+        shutdown_warm_workers()
+        hither.clear_source_bundle_cache()
+        hither.set_config(**config0)
+
+def _num_runs(log_path):
+    if not os.path.exists(log_path):
+        return 0
+    with open(log_path, 'r') as f:
+        return len(f.readlines())
+
+def test_execute_and_cache_hit(scratch):
+    log_path = str(scratch / 'runs.txt')
+    assert add.execute(x=1, y=2, log_path=log_path).retval == 3
+    assert add.execute(x=1, y=2, log_path=log_path).retval == 3
+    assert _num_runs(log_path) == 1
+    assert add.execute(x=1, y=2, log_path=log_path, _force_run=True).retval == 3
+    assert _num_runs(log_path) == 2
+
+def test_concurrent_identical_jobs_run_once(scratch):
+    log_path = str(scratch / 'runs.txt')
+    results = [None] * 4
+    def run(i):
+        results[i] = add.execute(x=2, y=3, log_path=log_path).retval
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(results))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [5] * len(results)
+    assert _num_runs(log_path) == 1
+
+@pytest.mark.parametrize('use_processes', [False, True])
+def test_map(scratch, use_processes):
+    log_path = str(scratch / 'runs.txt')
+    add.execute(x=0, y=0, log_path=log_path)
+    results = add.map([dict(x=i, y=i, log_path=log_path) for i in range(4)], max_workers=2, use_processes=use_processes)
+    assert [r.retval for r in results] == [0, 2, 4, 6]
+    # the first one was cached
+    assert _num_runs(log_path) == 4
+
+def test_pipeline(scratch):
+    import kachery as ka
+    with hither.Pipeline(max_workers=2):
+        r = append_files.execute(path1=ka.store_text('abc'), path2=ka.store_text('de'), path_out=hither.File())
+        n = count_chars.execute(fname=r.outputs.path_out)
+    assert n.retval == 5
+    assert ka.load_text(r.outputs.path_out._path) == 'abcde'
+
+def test_subprocess_runtime(scratch):
+    hither.set_config(container_runtime='subprocess')
+    r1 = getpid.execute(x=1, _container='default')
+    r2 = getpid.execute(x=2, _container='default')
+    assert r1.retval['x'] == 1 and r2.retval['x'] == 2
+    # each job runs in a new process
+    assert len(set([os.getpid(), r1.retval['pid'], r2.retval['pid']])) == 3
+    assert getpid.execute(x=1, _container='default').retval == r1.retval
+
+def test_warm_workers(scratch):
+    hither.set_config(container_runtime='subprocess', use_warm_workers=True)
+    r1 = getpid.execute(x=1, _container='default')
+    r2 = getpid.execute(x=2, _container='default')
+    assert r1.retval['x'] == 1 and r2.retval['x'] == 2
+    # both jobs ran in the same worker
+    assert r1.retval['pid'] == r2.retval['pid'] != os.getpid()
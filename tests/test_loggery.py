@@ -0,0 +1,93 @@
+import os
+import time
+
+import pytest
+
+import loggery
+
+
+@pytest.fixture
+def db_url(tmp_path, monkeypatch):
+    # the sync checkpoints and the default embedded database are under ~/.loggery
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    url = 'sqlite://' + str(tmp_path / 'loggery.db')
+    loggery.set_config(url=url, database='test', collection='test', write_buffer_max_delay_sec=1.0)
+    yield url
+    loggery.flush()
+
+def _wait_until_written():
+    from loggery.core import _global_writer
+    timer = time.time()
+    while _global_writer.num_pending() > 0:
+        assert time.time() - timer < 10
+        time.sleep(0.01)
+
+def test_sqlite_backend(db_url):
+    loggery.insert_one(message=dict(name='a', x=1))
+    loggery.insert_many([dict(name='a', x=2), dict(name='b', x=3)])
+    assert loggery.count({'message.name': 'a'}) == 2
+    assert loggery.find_one({'message.name': 'a'})['message']['x'] == 2
+    docs = list(loggery.find({'message.x': {'$gte': 2}}, {'message.x': 1}, sort=[('message.x', 1)]))
+    assert [doc['message'] for doc in docs] == [dict(x=2), dict(x=3)]
+    assert loggery.delete_many({'message.name': 'a'}) == 2
+    assert loggery.count({}) == 1
+
+def test_buffered_insert(db_url):
+    for i in range(10):
+        loggery.insert_one(message=dict(name='buffered', i=i), buffered=True)
+    # reads wait for the matching buffered messages
+    assert loggery.count({'message.name': 'buffered'}) == 10
+    loggery.insert_one(message=dict(name='buffered', i=10), buffered=True)
+    assert loggery.flush() == True
+    assert loggery.find_one({'message.name': 'buffered'})['message']['i'] == 10
+
+def test_buffered_write_error(db_url, tmp_path):
+    # a database that cannot be created, since its parent is a file
+    (tmp_path / 'not_a_dir').write_text('')
+    loggery.set_config(url='sqlite://' + str(tmp_path / 'not_a_dir' / 'loggery.db'))
+    loggery.insert_one(message=dict(name='lost'), buffered=True)
+    _wait_until_written()
+    loggery.set_config(url=db_url)
+    # the messages inserted after the failure are still written...
+    loggery.insert_one(message=dict(name='kept'), buffered=True)
+    # ...and the failure is raised once, by the next flush
+    with pytest.raises(Exception):
+        loggery.flush()
+    assert loggery.flush() == True
+    assert loggery.count({'message.name': 'kept'}) == 1
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires os.fork')
+def test_buffered_insert_in_forked_process(db_url):
+    # the writer thread of this process is running before the fork
+    loggery.insert_one(message=dict(name='parent'), buffered=True)
+    loggery.flush()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            loggery.insert_one(message=dict(name='child'), buffered=True)
+            os._exit(0 if loggery.flush(timeout=10) else 1)
+        finally:
+            os._exit(1)
+    _, status = os.waitpid(pid, 0)
+    assert status == 0
+    assert loggery.count({'message.name': 'child'}) == 1
+
+def test_push_and_pull(db_url, tmp_path):
+    local = dict(url='sqlite://' + str(tmp_path / 'local.db'))
+    remote = dict(url=db_url)
+    loggery.set_config(url=local['url'])
+    loggery.insert_many([dict(name='result', hash='h{}'.format(i)) for i in range(5)])
+    stats = loggery.push(local=local, remote=remote)
+    assert stats['num_written'] == 5
+    # nothing new since the last push
+    assert loggery.push(local=local, remote=remote)['num_written'] == 0
+    loggery.set_config(url=db_url)
+    assert loggery.count({'message.name': 'result'}) == 5
+    # the results that the local store already has (by name and hash) are
+    # skipped, including the ones that were pushed
+    loggery.insert_many([dict(name='result', hash='h0'), dict(name='result', hash='h5')])
+    loggery.set_config(url=local['url'])
+    stats = loggery.pull(local=local, remote=remote)
+    assert stats['num_written'] == 1
+    assert stats['num_duplicates'] == 6
+    assert loggery.count({'message.name': 'result'}) == 6